@@ -55,6 +55,3 @@ class ApiIdentGetterResource:
             'references': [sym.__dict__ for sym in symbol_references],
             'documentations': [sym.__dict__ for sym in symbol_doccomments]
         }
-
-        query.close()
-
@@ -20,8 +20,8 @@
 import sys
 import os
 import json
+import itertools
 from urllib import parse
-from berkeleydb.db import DB_SET_RANGE
 import falcon
 
 from .lib import autoBytes, validFamily
@@ -60,29 +60,12 @@ class AutocompleteResource:
 
         response = []
 
-        i = 0
-        cur = db.db.cursor()
         query_bytes = autoBytes(parse.quote(ident_prefix))
-        # Find "the smallest key greater than or equal to the specified key"
-        # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbcget.html
-        # In practice this should mean "the key that starts with provided prefix"
-        # See docs about the default comparison function for B-Tree databases:
-        # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbset_bt_compare.html
-        key, _ = cur.get(query_bytes, DB_SET_RANGE)
-        while i <= 10:
-            if key.startswith(query_bytes):
-                # If found key starts with the prefix, add to response
-                # and move to the next key
-                i += 1
-                response.append(process(key.decode("utf-8")))
-                key, _ = cur.next()
-            else:
-                # If found key does not start with the prefix, stop
-                break
+        # Keys are iterated in sorted order, from the first one that starts
+        # with the prefix, in the databases or in their snapshot
+        for key in itertools.islice(db.iter_keys(query_bytes), 11):
+            response.append(process(key.decode("utf-8")))
 
         resp.status = falcon.HTTP_200
         resp.content_type = falcon.MEDIA_JSON
         resp.media = response
-
-        query.close()
-
@@ -20,13 +20,27 @@
 
 import berkeleydb
 import re
+import sys
+import zlib
+import array
+import mmap
+import struct
+import bisect
+import heapq
 from . import lib
+from . import storage
 import os
 import os.path
 import errno
+import contextlib
+import ctypes
+import shutil
+import subprocess
+import time
+import threading
+from collections import OrderedDict
 
 deflist_regex = re.compile(b'(\d*)(\w)(\d*)(\w),?')
-deflist_macro_regex = re.compile('\dM\d+(\w)')
 
 ##################################################################################
 
@@ -48,63 +62,214 @@ defTypeR = {
 
 defTypeD = {v: k for k, v in defTypeR.items()}
 
+# Position of each type in this string is its code in the binary DefList
+# format. Only append new types at the end, existing databases depend on it.
+defTypeCodes = 'cdeEflMmpstuvx'
+
 ##################################################################################
 
 maxId = 999999999
 
-class DefList:
+# Binary values start with a zero byte, which never appears in the old text
+# formats, followed by a format version byte.
+FORMAT_MAGIC = 0
+DEFLIST_VERSION = 1
+REFLIST_VERSION = 1
+VERSIONINDEX_VERSION = 1
+PATHTABLE_VERSION = 1
+STRINGTABLE_VERSION = 1
+SNAPSHOTTABLE_VERSION = 1
+VERSIONDELTA_VERSION = 1
+
+def write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def is_binary(data):
+    return len(data) > 1 and data[0] == FORMAT_MAGIC
+
+class PostingList:
+    '''Base class for the binary posting lists, which store entries
+        starting with a blob ID, kept sorted by blob ID.
+        A value can be split in several segments (see BsdDB.append),
+        which are merged on the fly when iterating.'''
+    version = None
+    dummy = None
+
+    def __init__(self, data=None):
+        self.last_id = 0
+        self.entries = b''
+        self.segments = []
+
+        if data is None:
+            return
+        elif is_binary(data):
+            if data[1] != self.version:
+                raise ValueError(f'unsupported {type(self).__name__} format version {data[1]}')
+            self.load(data)
+        else:
+            self.load_text(data)
+
+    def add_segment(self, data):
+        self.segments.append(type(self)(data))
+
+    def iter(self, dummy=False):
+        if self.segments:
+            yield from heapq.merge(self.iter_entries(), *[s.iter_entries() for s in self.segments],
+                                   key=lambda e: e[0])
+        else:
+            yield from self.iter_entries()
+        if dummy:
+            yield self.dummy
+
+    def append(self, id, *args):
+        if id < self.last_id:
+            # Out of order insertion, rebuild the entries around the new one
+            entries = list(self.iter_entries())
+            pos = bisect.bisect_right([e[0] for e in entries], id)
+            entries.insert(pos, (id, *args))
+            self.entries = b''
+            self.last_id = 0
+            for entry in entries:
+                self.append_entry(*entry)
+        else:
+            self.append_entry(id, *args)
+
+    def extend(self, other):
+        for entry in other.iter():
+            self.append(*entry)
+
+    def pack(self):
+        if self.segments:
+            merged = type(self)()
+            merged.extend(self)
+            return merged.pack()
+        return self.pack_entries()
+
+    def get_buffer(self):
+        if not isinstance(self.entries, bytearray):
+            self.entries = bytearray(self.entries)
+        return self.entries
+
+class DefList(PostingList):
     '''Stores associations between a blob ID, a type (e.g., "function"),
         a line number and a file family.
-        Also stores in which families the ident exists for faster tests.'''
-    def __init__(self, data=b'#'):
-        self.data, self.families = data.split(b'#')
+        Also stores in which families the ident exists for faster tests.
 
-    def iter(self, dummy=False):
-        # Get all element in a list of sublists and sort them
-        entries = deflist_regex.findall(self.data)
+        Entries are encoded as a delta-coded blob ID, a type/family code byte
+        and a line number, all varints.
+        The text format of older databases is still read, and converted
+        when the value is written back.'''
+    version = DEFLIST_VERSION
+    dummy = (maxId, None, None, None)
+
+    def __init__(self, data=None):
+        self.families = []
+        self.macros = []
+        super().__init__(data)
+
+    def load(self, data):
+        pos = 2
+        size, pos = read_varint(data, pos)
+        self.families = bytes(data[pos:pos+size]).decode().split(',') if size else []
+        pos += size
+        size, pos = read_varint(data, pos)
+        self.macros = bytes(data[pos:pos+size]).decode().split(',') if size else []
+        pos += size
+        self.last_id, pos = read_varint(data, pos)
+        self.entries = data[pos:]
+
+    def load_text(self, data):
+        entries_data, _ = data.split(b'#')
+        entries = deflist_regex.findall(entries_data)
         entries.sort(key=lambda x:int(x[0]))
         for id, type, line, family in entries:
-            id = int(id)
-            type = defTypeR [type.decode()]
-            line = int(line)
-            family = family.decode()
-            yield id, type, line, family
-        if dummy:
-            yield maxId, None, None, None
+            self.append(int(id), defTypeR[type.decode()], int(line), family.decode())
+
+    def add_segment(self, data):
+        super().add_segment(data)
+        for family in self.segments[-1].families:
+            self.add_family(family)
+        for family in self.segments[-1].macros:
+            self.add_macro(family)
+
+    def iter_entries(self):
+        data = self.entries
+        pos = 0
+        end = len(data)
+        id = 0
+        while pos < end:
+            delta, pos = read_varint(data, pos)
+            id += delta
+            code = data[pos]
+            line, pos = read_varint(data, pos+1)
+            yield id, defTypeR[defTypeCodes[code >> 3]], line, lib.families[code & 7]
 
     def append(self, id, type, line, family):
         if type not in defTypeD:
             return
-        p = str(id) + defTypeD[type] + str(line) + family
-        if self.data != b'':
-            p = ',' + p
-        self.data += p.encode()
+
+        super().append(id, type, line, family)
         self.add_family(family)
+        if type == 'macro':
+            self.add_macro(family)
 
-    def pack(self):
-        return self.data + b'#' + self.families
+    def append_entry(self, id, type, line, family):
+        buf = self.get_buffer()
+        write_varint(buf, id - self.last_id)
+        buf.append(defTypeCodes.index(defTypeD[type]) << 3 | lib.families.index(family))
+        write_varint(buf, line)
+        self.last_id = id
+
+    def pack_entries(self):
+        families = ','.join(self.families).encode()
+        macros = ','.join(self.macros).encode()
+        buf = bytearray((FORMAT_MAGIC, DEFLIST_VERSION))
+        write_varint(buf, len(families))
+        buf += families
+        write_varint(buf, len(macros))
+        buf += macros
+        write_varint(buf, self.last_id)
+        buf += self.entries
+        return bytes(buf)
 
     def add_family(self, family):
-        family = family.encode()
-        if not family in self.families.split(b','):
-            if self.families != b'':
-                family = b',' + family
-            self.families += family
+        if not family in self.families:
+            self.families.append(family)
+
+    def add_macro(self, family):
+        if not family in self.macros:
+            self.macros.append(family)
 
     def get_families(self):
-        return self.families.decode().split(',')
+        return self.families
 
     def get_macros(self):
-        return deflist_macro_regex.findall(self.data.decode()) or ''
+        return self.macros
 
 class PathList:
     '''Stores associations between a blob ID and a file path.
-        Inserted by update.py sorted by blob ID.'''
+        Inserted by update.py sorted by blob ID.
+        data can be a memoryview of a snapshot, which is not copied until
+        the whole list is walked.'''
     def __init__(self, data=b''):
         self.data = data
 
     def iter(self, dummy=False):
-        for p in self.data.split(b'\n')[:-1]:
+        for p in bytes(self.data).split(b'\n')[:-1]:
             id, path = p.split(b' ',maxsplit=1)
             id = int(id)
             path = path.decode()
@@ -119,44 +284,632 @@ class PathList:
     def pack(self):
         return self.data
 
-class RefList:
+# Arrays of 32-bit unsigned integers, stored in little-endian order
+def uint32_array(data=b''):
+    arr = array.array('I')
+    assert arr.itemsize == 4
+    arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def uint32_bytes(arr):
+    if sys.byteorder == 'big':
+        arr = array.array('I', arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+# Returns the count unsigned integers of type typecode ('I' or 'Q') stored in
+# little-endian order at position pos of map, without copying them if possible
+def mmap_array(map, pos, count, typecode):
+    arr = array.array(typecode)
+    size = count * arr.itemsize
+    if sys.byteorder == 'little':
+        return memoryview(map)[pos:pos + size].cast(typecode)
+    arr.frombytes(map[pos:pos + size])
+    arr.byteswap()
+    return arr
+
+class VersionIndex:
+    '''Index of the PathList of a version, to find the paths of some blob
+        IDs without walking the whole list.
+        Made of a bitmap of the blob IDs of the version, and of the sorted
+        array of its entries' blob IDs, with the offset of each entry in the
+        PathList data. Both are zlib-compressed.'''
+    def __init__(self, data=None):
+        self.bitmap = b''
+        self.idxes = uint32_array()
+        self.offsets = uint32_array()
+        if data is not None:
+            self.load(data)
+
+    def load(self, data):
+        if data[0] != FORMAT_MAGIC or data[1] != VERSIONINDEX_VERSION:
+            raise ValueError('unknown VersionIndex format')
+        count, pos = read_varint(data, 2)
+        size, pos = read_varint(data, pos)
+        self.bitmap = zlib.decompress(data[pos:pos+size])
+        arrays = zlib.decompress(data[pos+size:])
+        self.idxes = uint32_array(arrays[:count*4])
+        self.offsets = uint32_array(arrays[count*4:])
+
+    @classmethod
+    def build(cls, paths):
+        index = cls()
+        data = paths.data
+        bitmap = bytearray()
+        pos = 0
+        while pos < len(data):
+            idx = int(data[pos:data.index(b' ', pos)])
+            if idx >> 3 >= len(bitmap):
+                bitmap.extend(bytes((idx >> 3) + 1 - len(bitmap)))
+            bitmap[idx >> 3] |= 1 << (idx & 7)
+            index.idxes.append(idx)
+            index.offsets.append(pos)
+            pos = data.index(b'\n', pos) + 1
+        index.bitmap = bytes(bitmap)
+        return index
+
+    def contains(self, idx):
+        return idx >> 3 < len(self.bitmap) and self.bitmap[idx >> 3] >> (idx & 7) & 1
+
+    # Memory used by the index, roughly
+    def size(self):
+        return len(self.bitmap) + (len(self.idxes) + len(self.offsets)) * self.idxes.itemsize
+
+    # Yields the (id, path) entries of paths, the indexed PathList, with the
+    # given blob IDs, in the same order as paths.iter(). Only these entries
+    # are copied when paths is a memoryview.
+    def iter(self, paths, idxes):
+        data = paths.data
+        for idx in sorted(set(idx for idx in idxes if self.contains(idx))):
+            i = bisect.bisect_left(self.idxes, idx)
+            while i < len(self.idxes) and self.idxes[i] == idx:
+                # Entries are in the order of their offsets
+                end = self.offsets[i+1] if i + 1 < len(self.offsets) else len(data)
+                entry = bytes(data[self.offsets[i]:end - 1])
+                yield idx, entry[entry.index(b' ') + 1:].decode()
+                i += 1
+
+    def pack(self):
+        buf = bytearray((FORMAT_MAGIC, VERSIONINDEX_VERSION))
+        write_varint(buf, len(self.idxes))
+        bitmap = zlib.compress(self.bitmap)
+        write_varint(buf, len(bitmap))
+        buf += bitmap
+        buf += zlib.compress(uint32_bytes(self.idxes) + uint32_bytes(self.offsets))
+        return bytes(buf)
+
+class PathTable:
+    '''Sorted table of the paths of the files of a version, and of their
+        directories, without leading slash.
+        Entries are stored newline-terminated in one buffer, with the array
+        of their offsets, both zlib-compressed.'''
+    def __init__(self, data=None):
+        self.data = b''
+        self.offsets = uint32_array()
+        if data is not None:
+            self.load(data)
+
+    def load(self, data):
+        if data[0] != FORMAT_MAGIC or data[1] != PATHTABLE_VERSION:
+            raise ValueError('unknown PathTable format')
+        count, pos = read_varint(data, 2)
+        size, pos = read_varint(data, pos)
+        self.data = zlib.decompress(data[pos:pos+size])
+        self.offsets = uint32_array(zlib.decompress(data[pos+size:]))
+        assert len(self.offsets) == count
+
+    @classmethod
+    def build(cls, paths):
+        entries = set()
+        for _, path in paths.iter():
+            entries.add(os.path.dirname(path))
+            entries.add(path)
+
+        table = cls()
+        data = bytearray()
+        for entry in sorted(e.encode() for e in entries):
+            table.offsets.append(len(data))
+            data += entry + b'\n'
+        table.data = bytes(data)
+        return table
+
+    def get_entry(self, offset):
+        return self.data[offset:self.data.index(b'\n', offset)]
+
+    def contains(self, path):
+        path = path.encode()
+        i = bisect.bisect_left(self.offsets, path, key=self.get_entry)
+        return i < len(self.offsets) and self.get_entry(self.offsets[i]) == path
+
+    # Memory used by the table, roughly
+    def size(self):
+        return len(self.data) + len(self.offsets) * self.offsets.itemsize
+
+    def pack(self):
+        buf = bytearray((FORMAT_MAGIC, PATHTABLE_VERSION))
+        write_varint(buf, len(self.offsets))
+        data = zlib.compress(self.data)
+        write_varint(buf, len(data))
+        buf += data
+        buf += zlib.compress(uint32_bytes(self.offsets))
+        return bytes(buf)
+
+# Sort key of the entries of a PathList data, which is the order of
+# (blob ID, path): blob IDs with fewer digits come first
+def path_entry_key(entry):
+    return entry.find(b' '), entry
+
+class VersionDelta:
+    '''Stores the PathList of a version as the entries removed from and
+        added to the PathList of a base version, both sorted in PathList
+        order. Depth is the number of deltas to apply to the nearest version
+        stored as a full PathList, whose depth is 0.'''
+    def __init__(self, data=None):
+        self.base = b''
+        self.depth = 0
+        self.removed = b''
+        self.added = b''
+        if data is not None:
+            self.load(data)
+
+    @classmethod
+    def build(cls, base, base_paths, paths, depth):
+        base_entries = base_paths.data.split(b'\n')[:-1]
+        entries = paths.data.split(b'\n')[:-1]
+        base_set = set(base_entries)
+        entries_set = set(entries)
+
+        obj = cls()
+        obj.base = base
+        obj.depth = depth
+        obj.removed = b''.join(e + b'\n' for e in base_entries if e not in entries_set)
+        obj.added = b''.join(e + b'\n' for e in entries if e not in base_set)
+        return obj
+
+    def apply(self, base_paths):
+        removed = set(self.removed.split(b'\n')[:-1])
+        entries = (e for e in base_paths.data.split(b'\n')[:-1] if e not in removed)
+        added = self.added.split(b'\n')[:-1]
+        merged = heapq.merge(entries, added, key=path_entry_key)
+        return PathList(b''.join(e + b'\n' for e in merged))
+
+    def load(self, data):
+        if data[0] != FORMAT_MAGIC or data[1] != VERSIONDELTA_VERSION:
+            raise ValueError('unknown VersionDelta format')
+        self.depth, pos = read_varint(data, 2)
+        size, pos = read_varint(data, pos)
+        self.base = data[pos:pos+size]
+        size, pos = read_varint(data, pos+size)
+        entries = zlib.decompress(data[pos:])
+        self.removed = entries[:size]
+        self.added = entries[size:]
+
+    # Returns the depth of the packed delta data, without decoding the rest
+    @staticmethod
+    def read_depth(data):
+        if data[0] != FORMAT_MAGIC or data[1] != VERSIONDELTA_VERSION:
+            raise ValueError('unknown VersionDelta format')
+        return read_varint(data, 2)[0]
+
+    def pack(self):
+        buf = bytearray((FORMAT_MAGIC, VERSIONDELTA_VERSION))
+        write_varint(buf, self.depth)
+        write_varint(buf, len(self.base))
+        buf += self.base
+        write_varint(buf, len(self.removed))
+        buf += zlib.compress(self.removed + self.added)
+        return bytes(buf)
+
+# Versions are stored as deltas at most this deep, then as a full PathList
+VERSIONS_SNAPSHOT_INTERVAL = 16
+
+# Values of the versions table: full PathLists, in the text format of older
+# databases, or VersionDeltas
+def load_version(data):
+    if is_binary(data):
+        return VersionDelta(data)
+    return PathList(data)
+
+class VersionStore:
+    '''Table of the PathLists of the versions, which are stored as deltas
+        from the version they were indexed from when there is one.
+        get() returns full PathLists, rebuilt from the deltas, and keeps
+        the most recently used ones in memory, up to max_size bytes.
+        Values are decoded by get(), the table returns them packed.'''
+    def __init__(self, filename, readonly, shared=False, env=None, max_size=0):
+        self.db = BsdDB(filename, readonly, lambda x: x, shared=shared, env=env)
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.lock = threading.Lock()
+        self.depths = {} # Depths of the versions put or read by get_depth
+
+    def exists(self, version):
+        return self.db.exists(version)
+
+    def get_keys(self):
+        return self.db.get_keys()
+
+    def get(self, version):
+        version = lib.autoBytes(version)
+        with self.lock:
+            if version in self.cache:
+                self.cache.move_to_end(version)
+                return self.cache[version]
+
+        obj = self.db.get(version)
+        if obj is not None:
+            obj = load_version(obj)
+        if isinstance(obj, VersionDelta):
+            base_paths = self.get(obj.base)
+            if base_paths is None:
+                raise ValueError('missing base version ' + obj.base.decode() +
+                                 ' of ' + version.decode())
+            obj = obj.apply(base_paths)
+
+        if obj is not None:
+            self.add_to_cache(version, obj)
+        return obj
+
+    def add_to_cache(self, version, paths):
+        with self.lock:
+            if version in self.cache or len(paths.data) > self.max_size:
+                return
+            self.cache[version] = paths
+            self.cache_size += len(paths.data)
+            while self.cache_size > self.max_size:
+                _, old = self.cache.popitem(last=False)
+                self.cache_size -= len(old.data)
+
+    # Number of deltas between version and a full PathList. Only the header
+    # of the value is decoded.
+    def get_depth(self, version):
+        version = lib.autoBytes(version)
+        depth = self.depths.get(version)
+        if depth is None:
+            data = self.db.get(version)
+            depth = VersionDelta.read_depth(data) if data is not None and is_binary(data) else 0
+            self.depths[version] = depth
+        return depth
+
+    # Stores paths, the PathList of version, as a delta from the indexed
+    # version base if there is one, and if it isn't too deep already
+    def put(self, version, paths, base=None, sync=False):
+        version = lib.autoBytes(version)
+        obj = paths
+        depth = 0
+        if base is not None:
+            depth = self.get_depth(base) + 1
+            if depth <= VERSIONS_SNAPSHOT_INTERVAL:
+                obj = VersionDelta.build(lib.autoBytes(base), self.get(base), paths, depth)
+            else:
+                depth = 0
+
+        self.db.put(version, obj, sync=sync)
+        self.depths[version] = depth
+        self.add_to_cache(version, paths)
+
+    def sync(self):
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return len(self.db)
+
+class StringTable:
+    '''Immutable set of byte strings, stored in a file that is mapped in
+        memory, so that processes reading it share the same pages.
+        The file starts with a header: the format magic and version bytes,
+        two unused bytes, the number of strings and the number of hash
+        slots. Then come the offsets of the strings, sorted, in the data
+        part (one more than the number of strings, for the end of the last
+        one), the hash slots (index of a string plus one, 0 if unused),
+        and the concatenated strings.
+        All integers are 32-bit little-endian.
+        A table can also be read from position pos of a file that is
+        already mapped, as part of a snapshot (see SnapshotTable).'''
+    HEADER_SIZE = 12
+
+    def __init__(self, filename, map=None, pos=0):
+        self.own_mmap = map is None
+        if map is None:
+            with open(filename, 'rb') as f:
+                map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mmap = map
+
+        if self.mmap[pos] != FORMAT_MAGIC or self.mmap[pos+1] != STRINGTABLE_VERSION:
+            raise ValueError('unknown StringTable format: ' + filename)
+        self.count, self.num_slots = struct.unpack_from('<II', self.mmap, pos + 4)
+
+        pos += self.HEADER_SIZE
+        self.offsets = mmap_array(self.mmap, pos, self.count + 1, 'I')
+        pos += (self.count + 1) * 4
+        self.slots = mmap_array(self.mmap, pos, self.num_slots, 'I')
+        self.data_start = pos + self.num_slots * 4
+
+    def __len__(self):
+        return self.count
+
+    # Returns the string at position i in sorted order
+    def get(self, i):
+        return self.mmap[self.data_start + self.offsets[i]:self.data_start + self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.get(i)
+
+    # Returns the position of key in sorted order, or -1 if it is missing
+    def index(self, key):
+        key = lib.autoBytes(key)
+        if not self.num_slots:
+            return -1
+
+        slot = zlib.crc32(key) % self.num_slots
+        while True:
+            i = self.slots[slot] - 1
+            if i < 0:
+                return -1
+            if self.offsets[i+1] - self.offsets[i] == len(key) and self.get(i) == key:
+                return i
+            slot = (slot + 1) % self.num_slots
+
+    def __contains__(self, key):
+        return self.index(key) >= 0
+
+    # Returns the position of the first string that is not lower than key
+    def bisect(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Yields the strings that start with prefix, in sorted order
+    def iter_prefix(self, prefix):
+        prefix = lib.autoBytes(prefix)
+        for i in range(self.bisect(prefix), self.count):
+            s = self.get(i)
+            if not s.startswith(prefix):
+                break
+            yield s
+
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+            self.slots.release()
+        if self.own_mmap:
+            self.mmap.close()
+
+    # Writes the strings of keys to filename, replacing it atomically
+    @staticmethod
+    def write(filename, keys):
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(StringTable.pack(sorted(set(lib.autoBytes(key) for key in keys))))
+        os.replace(filename + '.tmp', filename)
+
+    # Returns the table of keys, which must be sorted and unique
+    @staticmethod
+    def pack(keys):
+        num_slots = len(keys) * 2
+
+        offsets = uint32_array()
+        slots = uint32_array(bytes(num_slots * 4))
+        pos = 0
+        for i, key in enumerate(keys):
+            offsets.append(pos)
+            pos += len(key)
+            # Linear probing, the table is at most half full
+            slot = zlib.crc32(key) % num_slots
+            while slots[slot]:
+                slot = (slot + 1) % num_slots
+            slots[slot] = i + 1
+        offsets.append(pos)
+
+        buf = bytearray((FORMAT_MAGIC, STRINGTABLE_VERSION, 0, 0))
+        buf += struct.pack('<II', len(keys), num_slots)
+        buf += uint32_bytes(offsets)
+        buf += uint32_bytes(slots)
+        for key in keys:
+            buf += key
+        return bytes(buf)
+
+class SnapshotTable:
+    '''Immutable copy of a table of a DB, written by export_snapshot, and
+        stored in a file that is mapped in memory, so that processes reading
+        it share the same pages. Values are returned as slices of the
+        mapping, without being copied.
+        The file starts with a header: the format magic and version bytes,
+        two unused bytes, the size of the generation token of the data it was
+        exported from (32-bit) and the size of the keys (64-bit). Then come
+        the token, the keys as a StringTable, the offsets of the values, in
+        the order of the keys (one more than the number of keys, for the end
+        of the last one), and the concatenated values.
+        Sections start on 8-byte boundaries. Offsets of the values are 64-bit,
+        all integers are little-endian.'''
+    HEADER_SIZE = 16
+
+    def __init__(self, filename, contentType):
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[0] != FORMAT_MAGIC or self.mmap[1] != SNAPSHOTTABLE_VERSION:
+            raise ValueError('unknown SnapshotTable format: ' + filename)
+        token_size, keys_size = struct.unpack_from('<IQ', self.mmap, 4)
+        self.ctype = contentType
+
+        pos = self.HEADER_SIZE
+        self.token = self.mmap[pos:pos + token_size].decode()
+        pos = align8(pos + token_size)
+        self.keys = StringTable(filename, self.mmap, pos)
+        pos = align8(pos + keys_size)
+        self.offsets = mmap_array(self.mmap, pos, len(self.keys) + 1, 'Q')
+        self.data_start = pos + (len(self.keys) + 1) * 8
+        self.view = memoryview(self.mmap)
+
+    def exists(self, key):
+        return key in self.keys
+
+    def get(self, key):
+        i = self.keys.index(key)
+        if i < 0:
+            return None
+        return self.ctype(self.view[self.data_start + self.offsets[i]:self.data_start + self.offsets[i+1]])
+
+    def get_keys(self):
+        return list(self.keys)
+
+    # Yields the keys that start with prefix, in sorted order
+    def iter_keys(self, prefix):
+        return self.keys.iter_prefix(prefix)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self.keys.close()
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        try:
+            self.view.release()
+            self.mmap.close()
+        except BufferError:
+            # Values are still used, the mapping is closed once they are
+            # garbage collected
+            pass
+
+    # Writes the values of keys in table to filename, replacing it atomically.
+    # get_value returns the packed value of a key.
+    @staticmethod
+    def write(filename, keys, get_value, token):
+        keys = sorted(set(lib.autoBytes(key) for key in keys))
+        token = token.encode()
+        keys_data = StringTable.pack(keys)
+
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(bytes((FORMAT_MAGIC, SNAPSHOTTABLE_VERSION, 0, 0)))
+            f.write(struct.pack('<IQ', len(token), len(keys_data)))
+            f.write(token)
+            f.write(bytes(align8(f.tell()) - f.tell()))
+            f.write(keys_data)
+            f.write(bytes(align8(f.tell()) - f.tell()))
+
+            # Values are written after the space of their offsets
+            offsets_pos = f.tell()
+            f.seek(offsets_pos + (len(keys) + 1) * 8)
+            offsets = array.array('Q', [0])
+            for key in keys:
+                value = get_value(key)
+                f.write(value)
+                offsets.append(offsets[-1] + len(value))
+
+            if sys.byteorder == 'big':
+                offsets.byteswap()
+            f.seek(offsets_pos)
+            f.write(offsets.tobytes())
+        os.replace(filename + '.tmp', filename)
+
+def align8(pos):
+    return (pos + 7) & ~7
+
+class RefList(PostingList):
     '''Stores a mapping from blob ID to list of lines
-        and the corresponding family.'''
-    def __init__(self, data=b''):
-        self.data = data
+        and the corresponding family.
+        Used for references, doc comments and DT compatible strings.
 
-    def iter(self, dummy=False):
-        # Split all elements in a list of sublists and sort them
-        entries = [x.split(b':') for x in self.data.split(b'\n')[:-1]]
+        Entries are encoded as a delta-coded blob ID, a family byte,
+        the number of lines and the delta-coded lines, all varints except
+        for the family.
+        The text format of older databases is still read, and converted
+        when the value is written back.'''
+    version = REFLIST_VERSION
+    dummy = (maxId, None, None)
+
+    def load(self, data):
+        self.last_id, pos = read_varint(data, 2)
+        self.entries = data[pos:]
+
+    def load_text(self, data):
+        entries = [x.split(b':') for x in data.split(b'\n')[:-1]]
         entries.sort(key=lambda x:int(x[0]))
         for b, c, d in entries:
-            b = int(b.decode())
-            c = c.decode()
-            d = d.decode()
-            yield b, c, d
-        if dummy:
-            yield maxId, None, None
+            self.append(int(b.decode()), c.decode(), d.decode())
 
-    def append(self, id, lines, family):
-        p = str(id) + ':' + lines + ':' + family + '\n'
-        self.data += p.encode()
+    def iter_entries(self):
+        data = self.entries
+        pos = 0
+        end = len(data)
+        id = 0
+        while pos < end:
+            delta, pos = read_varint(data, pos)
+            id += delta
+            family = lib.families[data[pos]]
+            count, pos = read_varint(data, pos+1)
+            lines = []
+            line = 0
+            for _ in range(count):
+                delta, pos = read_varint(data, pos)
+                # Deltas are zigzag-encoded, in case lines are not in order
+                line += -(delta >> 1) - 1 if delta & 1 else delta >> 1
+                lines.append(str(line))
+            yield id, ','.join(lines), family
 
-    def pack(self):
-        return self.data
+    def append_entry(self, id, lines, family):
+        buf = self.get_buffer()
+        lines = [int(l) for l in lines.split(',')]
+        write_varint(buf, id - self.last_id)
+        buf.append(lib.families.index(family))
+        write_varint(buf, len(lines))
+        prev = 0
+        for line in lines:
+            delta = line - prev
+            write_varint(buf, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+            prev = line
+        self.last_id = id
+
+    def pack_entries(self):
+        buf = bytearray((FORMAT_MAGIC, REFLIST_VERSION))
+        write_varint(buf, self.last_id)
+        buf += self.entries
+        return bytes(buf)
+
+# Posting values that grew over SEGMENT_SIZE bytes receive new entries in
+# separate segments, stored under "key\0<segment number>", instead of being
+# rewritten entirely. Segments are merged back by BsdDB.merge_segments.
+SEGMENT_SIZE = 16384
+SEGMENT_SEPARATOR = b'\0'
+
+def segment_key(key, num):
+    return key + SEGMENT_SEPARATOR + num.to_bytes(4, 'big')
 
 class BsdDB:
-    def __init__(self, filename, readonly, contentType, shared=False):
+    '''Table of a DB, stored by the backend of env (see elixir.storage),
+        or in a Berkeley DB file of its own if env is None.'''
+    def __init__(self, filename, readonly, contentType, shared=False, segmented=False, env=None):
         self.filename = filename
-        self.db = berkeleydb.db.DB()
-        flags = berkeleydb.db.DB_THREAD if shared else 0
-
-        if readonly:
-            flags |= berkeleydb.db.DB_RDONLY
-            self.db.open(filename, flags=flags)
-        else:
-            flags |= berkeleydb.db.DB_CREATE
-            self.db.open(filename, flags=flags, mode=0o644, dbtype=berkeleydb.db.DB_BTREE)
+        if env is None:
+            env = storage.BerkeleyDBEnv()
+        # Posting lists can be read from buffers, without copying values
+        buffers = isinstance(contentType, type) and issubclass(contentType, PostingList)
+        self.db = env.open_table(filename, readonly, shared, buffers)
         self.ctype = contentType
+        self.segmented = segmented
+        self.tails = {} # Last segment number of keys appended to by this process
+
+    # Returns True if key can be stored by the backend. Keys of segmented
+    # tables leave room for segment numbers: the segments of a value can
+    # always be stored along with it.
+    def valid_key(self, key):
+        key = lib.autoBytes(key)
+        if self.segmented:
+            key = segment_key(key, 0)
+        return self.db.valid_key(key)
 
     def exists(self, key):
         key = lib.autoBytes(key)
@@ -165,10 +918,38 @@ class BsdDB:
     def get(self, key):
         key = lib.autoBytes(key)
         p = self.db.get(key)
-        return self.ctype(p) if p is not None else None
+        if p is None:
+            return None
+
+        obj = self.ctype(p)
+        if self.segmented:
+            for _, seg in self.get_segments(key):
+                obj.add_segment(seg)
+        return obj
+
+    # Returns (key, value) pairs of the segments of key, in order
+    def get_segments(self, key):
+        prefix = key + SEGMENT_SEPARATOR
+        for rec in self.db.iter_range(prefix):
+            if not rec[0].startswith(prefix):
+                break
+            yield rec
 
     def get_keys(self):
-        return self.db.keys()
+        keys = self.db.keys()
+        if self.segmented:
+            keys = [k for k in keys if SEGMENT_SEPARATOR not in k]
+        return keys
+
+    # Yields the keys that start with prefix, in sorted order
+    def iter_keys(self, prefix):
+        prefix = lib.autoBytes(prefix)
+        for key, _ in self.db.iter_range(prefix):
+            if not key.startswith(prefix):
+                break
+            # Skip segments of posting lists being updated
+            if SEGMENT_SEPARATOR not in key:
+                yield key
 
     def put(self, key, val, sync=False):
         key = lib.autoBytes(key)
@@ -179,44 +960,550 @@ class BsdDB:
         if sync:
             self.db.sync()
 
+    # Adds the entries of the posting list val to the value of key.
+    # Only the last segment of the value is read and rewritten, a new one
+    # is started when it gets too big.
+    def append(self, key, val):
+        key = lib.autoBytes(key)
+
+        if key not in self.tails:
+            self.tails[key] = -1
+            for seg_key, _ in self.get_segments(key):
+                self.tails[key] = int.from_bytes(seg_key[len(key)+1:], 'big')
+
+        tail = self.tails[key]
+        tail_key = key if tail < 0 else segment_key(key, tail)
+        p = self.db.get(tail_key)
+
+        if p is None:
+            self.db.put(key, val.pack())
+        elif len(p) < SEGMENT_SIZE:
+            obj = self.ctype(p)
+            obj.extend(val)
+            self.db.put(tail_key, obj.pack())
+        else:
+            self.tails[key] = tail + 1
+            self.db.put(segment_key(key, tail + 1), val.pack())
+
+    # Merges back the segments of the values appended to by this process,
+    # only for values with at least min_segments segments
+    def merge_segments(self, min_segments=1):
+        tails = {}
+        for key, tail in self.tails.items():
+            if tail < 0:
+                continue
+            if tail + 1 < min_segments:
+                tails[key] = tail
+                continue
+            self.db.put(key, self.get(key).pack())
+            for seg_key, _ in list(self.get_segments(key)):
+                self.db.delete(seg_key)
+        self.tails = tails
+
+    # Removes the entries of the posting list of key with a blob ID of at
+    # least first_id, and merges its segments
+    def remove_entries(self, key, first_id):
+        key = lib.autoBytes(key)
+        obj = self.get(key)
+        if obj is None:
+            return
+
+        kept = self.ctype()
+        for entry in obj.iter():
+            if entry[0] < first_id:
+                kept.append(*entry)
+
+        for seg_key, _ in list(self.get_segments(key)):
+            self.db.delete(seg_key)
+        if kept.entries:
+            self.db.put(key, kept.pack())
+        else:
+            self.db.delete(key)
+        self.tails.pop(key, None)
+
+    # Puts (key, value) pairs in key order, which makes B-tree inserts sequential
+    def put_many(self, items, sync=False):
+        items = [(lib.autoBytes(key), lib.autoBytes(val)) for key, val in items]
+        self.db.put_many(sorted(((key, val if type(val) is bytes else val.pack()) for key, val in items),
+                                key=lambda item: item[0]))
+        if sync:
+            self.db.sync()
+
+    def delete(self, key):
+        key = lib.autoBytes(key)
+        if self.db.exists(key):
+            self.db.delete(key)
+
+    # Removes all the keys
+    def truncate(self):
+        self.db.truncate()
+        self.tails = {}
+
+    def sync(self):
+        self.db.sync()
+
     def close(self):
         self.db.close()
 
+    # Number of keys, segments excluded: segmented tables are read entirely
     def __len__(self):
-        return self.db.stat()["nkeys"]
+        if self.segmented:
+            return sum(1 for key in self.db.keys() if SEGMENT_SEPARATOR not in key)
+        return self.db.stat()['nkeys']
+
+# Rough memory used by a buffered posting list, besides its key and entries
+POSTING_BUFFER_OVERHEAD = 256
+
+class Journal:
+    '''Write-ahead list of the keys of the posting lists that are about to
+        be appended to, so that the entries appended by an interrupted run
+        of update.py can be found and removed.
+        Each line is the name of a table file and a key, in hexadecimal.
+        Lines are on disk before the posting lists are written.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'ab')
+
+    def add(self, table, keys):
+        name = os.path.basename(table.filename).encode()
+        self.file.write(b''.join(name + b' ' + key.hex().encode() + b'\n' for key in keys))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # Returns the keys of the journal, as a set by table file name
+    def get_keys(self):
+        keys = {}
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Interrupted while writing, the keys were not appended to yet
+                    break
+                name, key = line.split()
+                keys.setdefault(name.decode(), set()).add(bytes.fromhex(key.decode()))
+        return keys
+
+    def clear(self):
+        self.file.truncate(0)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+class PostingBuffer:
+    '''Accumulates entries of the posting lists of a BsdDB in memory, and
+        appends them to the database in key order once they use more than
+        max_size bytes, or when flushed.
+        lock, if any, is held while writing to the database.
+        journal, if any, gets the keys before they are written.'''
+    def __init__(self, db, max_size, lock=None, journal=None):
+        self.db = db
+        self.lock = lock if lock is not None else contextlib.nullcontext()
+        self.journal = journal
+        self.max_size = max_size
+        self.values = {}
+        self.size = 0
+
+    def exists(self, key):
+        return lib.autoBytes(key) in self.values
+
+    def append(self, key, *entry):
+        key = lib.autoBytes(key)
+        obj = self.values.get(key)
+        if obj is None:
+            obj = self.values[key] = self.db.ctype()
+            self.size += len(key) + POSTING_BUFFER_OVERHEAD
+
+        size = len(obj.entries)
+        obj.append(*entry)
+        self.size += len(obj.entries) - size
+
+        if self.size > self.max_size:
+            self.flush()
+
+    def flush(self):
+        if not self.values:
+            return
+        with self.lock:
+            keys = sorted(self.values)
+            if self.journal is not None:
+                self.journal.add(self.db, keys)
+            for key in keys:
+                self.db.append(key, self.values[key])
+        self.values = {}
+        self.size = 0
+
+# File of the data directory replaced each time update.py is done with it.
+# Long-lived readers compare its stamp to know when to reopen the databases.
+GENERATION_FILE = 'generation'
+
+# Returns a value that changes each time the data of dir is updated,
+# or None if it was never updated by a version of update.py that does it.
+# It also changes when dir is a symlink to a generation that is swapped.
+def get_generation(dir):
+    try:
+        st = os.stat(os.path.join(dir, GENERATION_FILE))
+    except FileNotFoundError:
+        return None
+    return (os.path.realpath(dir), st.st_ino, st.st_mtime_ns)
+
+# Marks the data of dir as updated. The file is replaced, not rewritten,
+# so that its inode changes even if its mtime does not.
+# It contains a token, given by export_snapshot when there is a snapshot of
+# the new data.
+def bump_generation(dir, token=None):
+    path = os.path.join(dir, GENERATION_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write((token or new_generation_token()) + '\n')
+    os.replace(path + '.tmp', path)
+
+def new_generation_token():
+    return str(time.time())
+
+# Returns the token of the current generation of the data of dir, or None
+def get_generation_token(dir):
+    try:
+        with open(os.path.join(dir, GENERATION_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+# The posting lists and versions can be exported to a snapshot, immutable
+# files read instead of the databases by read-only DB instances, as long as
+# the data is not updated again. Files are named like the tables, with the
+# .snap extension.
+SNAPSHOT_TABLES = ('definitions', 'references', 'doccomments', 'versions',
+                   'compatibledts', 'compatibledts_docs')
+
+def snapshot_filename(dir, name):
+    return os.path.join(dir, name + '.snap')
+
+# Returns the SnapshotTable of the table name in dir, or None if there is no
+# snapshot of the current generation of the data
+def open_snapshot_table(dir, name, contentType, token):
+    filename = snapshot_filename(dir, name)
+    if token is None or not os.path.exists(filename):
+        return None
+
+    table = SnapshotTable(filename, contentType)
+    if table.token != token:
+        table.close()
+        return None
+    return table
+
+def snapshot_is_current(dir, dtscomp=False):
+    token = get_generation_token(dir)
+    for name in SNAPSHOT_TABLES:
+        if name.startswith('compatibledts') and not dtscomp:
+            continue
+        table = open_snapshot_table(dir, name, bytes, token)
+        if table is None:
+            return False
+        table.close()
+    return True
+
+# Writes the snapshot of the tables of db, a DB opened for writing, and
+# returns the token of the generation it is for, to give to bump_generation
+def export_snapshot(db):
+    token = new_generation_token()
+    tables = {
+        'definitions': db.defs,
+        'references': db.refs,
+        'doccomments': db.docs,
+    }
+    if db.dtscomp:
+        tables['compatibledts'] = db.comps
+        tables['compatibledts_docs'] = db.comps_docs
+
+    for name, table in tables.items():
+        SnapshotTable.write(snapshot_filename(db.dir, name), table.get_keys(),
+                            lambda key: table.get(key).pack(), token)
+
+    # Versions are stored whole, not as deltas
+    SnapshotTable.write(snapshot_filename(db.dir, 'versions'), db.vers.get_keys(),
+                        lambda key: db.vers.get(key).pack(), token)
+    return token
+
+# With update.py --swap, the data directory is a symlink to its current
+# generation, a directory named like it, followed by .N. update.py writes to
+# a copy of the current generation, the .next directory, and then swaps the
+# symlink to it, so that readers never see the databases while they are
+# being written. The previous generation is kept until the next update, for
+# the readers that were opening it.
+
+def get_next_generation_dir(dir):
+    return os.path.normpath(dir) + '.next'
+
+# Returns the [(N, path)] generations of dir, oldest first
+def list_generations(dir):
+    parent, name = os.path.split(os.path.normpath(dir))
+    generations = []
+    for entry in os.listdir(parent or '.'):
+        base, sep, n = entry.rpartition('.')
+        if sep and base == name and n.isdigit():
+            generations.append((int(n), os.path.join(parent, entry)))
+    return sorted(generations)
+
+# Returns the data directory of which dir is a generation, or dir
+def get_generations_base(dir):
+    base, sep, n = os.path.normpath(dir).rpartition('.')
+    if sep and n.isdigit() and os.path.islink(base):
+        return base
+    return dir
+
+# Files that are only ever replaced, never modified: generations share them
+def is_replaced_file(name):
+    return (name == GENERATION_FILE or name.endswith('.snap') or
+            name.startswith('definitions-cache-') and name.endswith('.tab'))
+
+# Copies the files of generation src to the new directory dst. Files are
+# cloned if the file system supports it.
+def copy_generation(src, dst):
+    os.mkdir(dst)
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        # Skip the regions of Berkeley DB environments, LMDB locks, and temporary files
+        if (name.startswith('__db.') or name == storage.LMDB_LOCK_FILE or name.endswith('.tmp') or
+                not os.path.isfile(path)):
+            continue
+
+        if is_replaced_file(name):
+            os.link(path, os.path.join(dst, name))
+        else:
+            subprocess.run(('cp', '--reflink=auto', '--preserve=mode,timestamps', path, dst), check=True)
+
+# Returns the .next directory of dir, after creating it as a copy of the
+# current generation unless it was left by an interrupted update.
+# Generations older than the current one are removed.
+def prepare_next_generation(dir):
+    current = os.path.realpath(dir)
+    for n, path in list_generations(dir):
+        if os.path.realpath(path) != current:
+            shutil.rmtree(path)
+
+    next_dir = get_next_generation_dir(dir)
+    if not os.path.isdir(next_dir):
+        shutil.rmtree(next_dir + '.tmp', ignore_errors=True)
+        copy_generation(current, next_dir + '.tmp')
+        os.rename(next_dir + '.tmp', next_dir)
+    return next_dir
+
+# Exchanges paths a and b atomically. Returns False if the system can't,
+# exchanges need renameat2 (Linux 3.15) and a file system that supports it.
+def exchange_paths(a, b):
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except AttributeError:
+        return False
+
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 2
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            return False
+        raise OSError(err, os.strerror(err), a)
+    return True
+
+# Makes the .next directory of dir its current generation, and returns it
+def swap_generation(dir):
+    dir = os.path.normpath(dir)
+    generations = list_generations(dir)
+    n = generations[-1][0] + 1 if generations else 1
+    first = not os.path.islink(dir)
+    if first:
+        # The data directory becomes the previous generation
+        n += 1
+
+    new_dir = dir + '.' + str(n)
+    os.rename(get_next_generation_dir(dir), new_dir)
+
+    # Relative, so that the project directory can be moved
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(dir + '.link')
+    os.symlink(os.path.basename(new_dir), dir + '.link')
+
+    if not first:
+        os.replace(dir + '.link', dir)
+    elif exchange_paths(dir + '.link', dir):
+        # The data directory is replaced by the symlink at once, and is
+        # only renamed once readers no longer find it
+        os.rename(dir + '.link', dir + '.' + str(n - 1))
+    else:
+        # A symlink can't replace a directory: readers don't find the data
+        # until the symlink is renamed
+        os.rename(dir, dir + '.' + str(n - 1))
+        os.replace(dir + '.link', dir)
+    return new_dir
+
+# Size of the memory pool shared by the tables of a DB, in megabytes
+def get_cache_size():
+    return int(os.environ.get('ELIXIR_DB_CACHE_SIZE', 64)) * 1024 * 1024
+
+# Memory used to keep the PathLists of recently used versions, in megabytes
+def get_versions_cache_size():
+    return int(os.environ.get('ELIXIR_VERSIONS_CACHE_SIZE', 64)) * 1024 * 1024
+
+# Directory in which read-only DB instances of different processes share their
+# memory pool, or None if each instance has its own
+def get_env_dir():
+    return os.environ.get('ELIXIR_DB_ENV_DIR') or None
+
+# Returns True if dir is a generation of a data directory swapped in by
+# update.py --swap, whose files are never written again
+def is_swapped_generation(dir):
+    dir = os.path.realpath(dir)
+    return get_generations_base(dir) != dir
+
+# Returns the home directory of the environment shared by read-only instances
+# of the DB in dir. It depends on the generation of the data, since pages
+# cached by the memory pool would no longer match updated files.
+# Environments of previous generations are removed, processes still attached
+# to them keep their mapping of the memory pool.
+def get_shared_env_home(env_dir, dir):
+    name = get_generations_base(os.path.realpath(dir)).strip('/').replace('/', '_')
+    generation = get_generation(dir)
+    if generation is not None:
+        generation = '{}-{}'.format(*generation[1:])
+    home = os.path.join(env_dir, name + '.' + str(generation))
+
+    if not os.path.isdir(home):
+        os.makedirs(home, exist_ok=True)
+        for old in os.listdir(env_dir):
+            if old.startswith(name + '.') and old != os.path.basename(home):
+                shutil.rmtree(os.path.join(env_dir, old), ignore_errors=True)
+
+    return home
+
+# Size of the memory map of LMDB environments, the maximum size of their
+# data, in megabytes. Only the pages that are used take memory or disk space.
+def get_lmdb_map_size():
+    return int(os.environ.get('ELIXIR_LMDB_MAP_SIZE', 1024 * 1024)) * 1024 * 1024
+
+# Maximum number of threads of all processes reading an LMDB environment
+def get_lmdb_max_readers():
+    return int(os.environ.get('ELIXIR_LMDB_MAX_READERS', 1024))
+
+# Returns the storage backend of the data in dir, or None if there is no data
+def find_backend(dir):
+    if os.path.exists(os.path.join(dir, storage.LMDB_DATA_FILE)):
+        return 'lmdb'
+    if os.path.exists(os.path.join(dir, 'variables.db')):
+        return 'berkeleydb'
+    return None
+
+# Returns the storage backend of new data: $ELIXIR_DB_BACKEND, or Berkeley DB
+def get_default_backend():
+    backend = os.environ.get('ELIXIR_DB_BACKEND') or 'berkeleydb'
+    if backend not in storage.BACKENDS:
+        raise ValueError('unknown storage backend: ' + backend)
+    return backend
+
+# Opens the storage environment of the tables of a DB in dir, with the
+# backend of its data, or the given backend if it has no data yet
+def open_env(dir, readonly, shared, backend=None):
+    backend = find_backend(dir) or backend or get_default_backend()
+    if backend == 'lmdb':
+        return storage.LMDBEnv(dir, readonly, get_lmdb_map_size(), get_lmdb_max_readers())
+
+    env = berkeleydb.db.DBEnv()
+    cache_size = get_cache_size()
+    env.set_cachesize(cache_size // (1024**3), cache_size % (1024**3), 1)
+
+    flags = berkeleydb.db.DB_CREATE | berkeleydb.db.DB_INIT_MPOOL
+    if shared:
+        flags |= berkeleydb.db.DB_THREAD
+
+    # Writes are logged, and committed at each sync, so that a writer killed
+    # at any point leaves the tables as they were at its last sync once
+    # recovery has run, when the environment is opened again. Logs are
+    # written in the data directory.
+    if not readonly:
+        flags |= berkeleydb.db.DB_INIT_TXN | berkeleydb.db.DB_INIT_LOG | berkeleydb.db.DB_RECOVER
+        env.log_set_config(berkeleydb.db.DB_LOG_AUTO_REMOVE, 1)
+
+    env_dir = get_env_dir()
+    # The environment has no locking: pages cached by a shared memory pool
+    # would get out of sync with files that update.py writes while they are
+    # read, it is only used for generations that are no longer written
+    if readonly and env_dir is not None and is_swapped_generation(dir):
+        home = get_shared_env_home(env_dir, dir)
+    else:
+        # Memory pool in the heap of this process
+        home = dir
+        flags |= berkeleydb.db.DB_PRIVATE
+
+    env.open(home, flags, 0o644)
+    return storage.BerkeleyDBEnv(env, transactional=not readonly)
+
+def defs_table_filename(dir, family):
+    return dir + '/definitions-cache-' + family + '.tab'
 
 class DB:
-    def __init__(self, dir, readonly=True, dtscomp=False, shared=False):
+    # backend: storage backend of the tables, if dir has no data yet
+    # snapshot: if False, read-only instances don't read the snapshot
+    def __init__(self, dir, readonly=True, dtscomp=False, shared=False, backend=None, snapshot=True):
+        # Berkeley DB opens relative table paths from the home of the environment
+        dir = os.path.abspath(dir)
         if os.path.isdir(dir):
             self.dir = dir
         else:
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), dir)
 
+        self.env = open_env(dir, readonly, shared, backend)
+        env = self.env
         ro = readonly
 
-        self.vars = BsdDB(dir + '/variables.db', ro, lambda x: int(x.decode()), shared=shared)
+        # Read-only instances read the tables of the snapshot of the data
+        # instead of the databases, if it is up to date
+        token = get_generation_token(dir) if ro and snapshot else None
+        def open_posting_table(name, contentType):
+            table = open_snapshot_table(dir, name, contentType, token)
+            if table is None:
+                table = BsdDB(dir + '/' + name + '.db', ro, contentType, shared=shared, segmented=True, env=env)
+            return table
+
+        self.vars = BsdDB(dir + '/variables.db', ro, lambda x: int(x.decode()), shared=shared, env=env)
             # Key-value store of basic information
-        self.blob = BsdDB(dir + '/blobs.db', ro, lambda x: int(x.decode()), shared=shared)
+        self.blob = BsdDB(dir + '/blobs.db', ro, lambda x: int(x.decode()), shared=shared, env=env)
             # Map hash to sequential integer serial number
-        self.hash = BsdDB(dir + '/hashes.db', ro, lambda x: x, shared=shared)
+        self.hash = BsdDB(dir + '/hashes.db', ro, lambda x: x, shared=shared, env=env)
             # Map serial number back to hash
-        self.file = BsdDB(dir + '/filenames.db', ro, lambda x: x.decode(), shared=shared)
+        self.file = BsdDB(dir + '/filenames.db', ro, lambda x: x.decode(), shared=shared, env=env)
             # Map serial number to filename
-        self.vers = BsdDB(dir + '/versions.db', ro, PathList, shared=shared)
-        self.defs = BsdDB(dir + '/definitions.db', ro, DefList, shared=shared)
+        self.vers = open_snapshot_table(dir, 'versions', PathList, token)
+        if self.vers is None:
+            self.vers = VersionStore(dir + '/versions.db', ro, shared=shared, env=env,
+                                     max_size=get_versions_cache_size())
+        # Tables not created by older versions of update.py, None if missing
+        self.vers_index = None
+        if not ro or env.has_table(dir + '/versions-index.db'):
+            self.vers_index = BsdDB(dir + '/versions-index.db', ro, VersionIndex, shared=shared, env=env)
+        self.vers_paths = None
+        if not ro or env.has_table(dir + '/versions-paths.db'):
+            self.vers_paths = BsdDB(dir + '/versions-paths.db', ro, PathTable, shared=shared, env=env)
+        self.defs = open_posting_table('definitions', DefList)
         self.defs_cache = {}
         NOOP = lambda x: x
-        self.defs_cache['C'] = BsdDB(dir + '/definitions-cache-C.db', ro, NOOP, shared=shared)
-        self.defs_cache['K'] = BsdDB(dir + '/definitions-cache-K.db', ro, NOOP, shared=shared)
-        self.defs_cache['D'] = BsdDB(dir + '/definitions-cache-D.db', ro, NOOP, shared=shared)
-        self.defs_cache['M'] = BsdDB(dir + '/definitions-cache-M.db', ro, NOOP, shared=shared)
+        self.defs_cache['C'] = BsdDB(dir + '/definitions-cache-C.db', ro, NOOP, shared=shared, env=env)
+        self.defs_cache['K'] = BsdDB(dir + '/definitions-cache-K.db', ro, NOOP, shared=shared, env=env)
+        self.defs_cache['D'] = BsdDB(dir + '/definitions-cache-D.db', ro, NOOP, shared=shared, env=env)
+        self.defs_cache['M'] = BsdDB(dir + '/definitions-cache-M.db', ro, NOOP, shared=shared, env=env)
         assert sorted(self.defs_cache.keys()) == sorted(lib.CACHED_DEFINITIONS_FAMILIES)
-        self.refs = BsdDB(dir + '/references.db', ro, RefList, shared=shared)
-        self.docs = BsdDB(dir + '/doccomments.db', ro, RefList, shared=shared)
+        # Copies of the keys of defs_cache written by update.py, for readers
+        self.defs_tables = {}
+        for family in lib.CACHED_DEFINITIONS_FAMILIES:
+            filename = defs_table_filename(dir, family)
+            if ro and os.path.exists(filename):
+                self.defs_tables[family] = StringTable(filename)
+            else:
+                self.defs_tables[family] = None
+        self.refs = open_posting_table('references', RefList)
+        self.docs = open_posting_table('doccomments', RefList)
         self.dtscomp = dtscomp
         if dtscomp:
-            self.comps = BsdDB(dir + '/compatibledts.db', ro, RefList, shared=shared)
-            self.comps_docs = BsdDB(dir + '/compatibledts_docs.db', ro, RefList, shared=shared)
+            self.comps = open_posting_table('compatibledts', RefList)
+            self.comps_docs = open_posting_table('compatibledts_docs', RefList)
             # Use a RefList in case there are multiple doc comments for an identifier
 
     def close(self):
@@ -225,14 +1512,55 @@ class DB:
         self.hash.close()
         self.file.close()
         self.vers.close()
+        if self.vers_index is not None:
+            self.vers_index.close()
+        if self.vers_paths is not None:
+            self.vers_paths.close()
         self.defs.close()
         self.defs_cache['C'].close()
         self.defs_cache['K'].close()
         self.defs_cache['D'].close()
         self.defs_cache['M'].close()
+        for table in self.defs_tables.values():
+            if table is not None:
+                table.close()
         self.refs.close()
         self.docs.close()
         if self.dtscomp:
             self.comps.close()
             self.comps_docs.close()
+        self.env.close()
+
+    # Returns the tables of the databases, that are not read from the snapshot
+    def get_tables(self):
+        tables = [self.vars, self.blob, self.hash, self.file, self.vers, self.vers_index,
+                  self.vers_paths, self.defs, *self.defs_cache.values(), self.refs, self.docs]
+        if self.dtscomp:
+            tables += [self.comps, self.comps_docs]
+        tables = [table.db if isinstance(table, VersionStore) else table for table in tables]
+        return [table for table in tables if isinstance(table, BsdDB)]
+
+    # Writes the changes made to the tables to their files
+    def sync(self):
+        for table in self.get_tables():
+            table.sync()
+
+    def defs_tables_exist(self):
+        return all(os.path.exists(defs_table_filename(self.dir, family))
+                   for family in lib.CACHED_DEFINITIONS_FAMILIES)
+
+    # Writes the keys of defs_cache to the tables read by Query
+    def write_defs_tables(self):
+        for family, cache in self.defs_cache.items():
+            StringTable.write(defs_table_filename(self.dir, family), cache.get_keys())
+
+    # Returns (hits, misses, {table file: (hits, misses)}) of the memory pool.
+    # Shared environments count the accesses of all the processes using them.
+    def get_cache_stats(self):
+        return self.env.get_cache_stats()
+
+    # Ends the reads of the calling thread: posting lists it read from the
+    # databases are not valid anymore, the next reads see the latest data
+    def end_read(self):
+        self.env.end_read()
 
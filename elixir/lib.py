@@ -19,7 +19,10 @@
 #  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import re
 import logging
+import threading
+import contextlib
 import subprocess, os
 
 logger = logging.getLogger(__name__)
@@ -43,6 +46,126 @@ def run_cmd(*args, env=None):
         logger.error('command %s printed to stderr: \n%s', str(args), p.stderr.decode('utf-8'))
     return p.stdout, p.returncode
 
+class GitObjectReader:
+    '''Reads objects from a Git repository through long-lived
+        `git cat-file --batch` and `git cat-file --batch-check` processes,
+        instead of forking git for each object.
+        Object names are revisions like "v5.4:Makefile" or blob hashes.'''
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.batch = None
+        self.batch_check = None
+
+    def start(self, mode):
+        return subprocess.Popen(('git', '-C', self.repo_dir, 'cat-file', mode),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+
+    # Returns (hash, type, size) for each object name, or None if the object does not exist
+    def info_many(self, names):
+        if self.batch_check is None:
+            self.batch_check = self.start('--batch-check')
+
+        result = []
+        # Send requests in chunks, so that pipe buffers never fill up on both sides
+        for i in range(0, len(names), 256):
+            chunk = names[i:i+256]
+            self.batch_check.stdin.write(b''.join(autoBytes(n) + b'\n' for n in chunk))
+            self.batch_check.stdin.flush()
+            for _ in chunk:
+                result.append(self.parse_header(self.batch_check.stdout.readline()))
+        return result
+
+    def info(self, name):
+        return self.info_many((name,))[0]
+
+    # Returns (type, content) of the object, or None if it does not exist
+    def read(self, name):
+        if self.batch is None:
+            self.batch = self.start('--batch')
+
+        self.batch.stdin.write(autoBytes(name) + b'\n')
+        self.batch.stdin.flush()
+        header = self.parse_header(self.batch.stdout.readline())
+        if header is None:
+            return None
+
+        _, type, size = header
+        content = self.batch.stdout.read(size)
+        self.batch.stdout.read(1) # Newline after the content
+        return type, content
+
+    def parse_header(self, header):
+        if header == b'':
+            raise BrokenPipeError('git cat-file exited')
+        fields = header.split()
+        if len(fields) != 3 or fields[1] in (b'missing', b'ambiguous'):
+            return None
+        hash, type, size = fields
+        return hash.decode(), type.decode(), int(size)
+
+    def close(self):
+        for p in (self.batch, self.batch_check):
+            if p is not None:
+                p.stdin.close()
+                p.wait()
+        self.batch = None
+        self.batch_check = None
+
+class GitObjectReaderPool:
+    '''Pool of GitObjectReader of a repository, so that concurrent threads
+        each get their own processes.'''
+    def __init__(self, repo_dir, max_idle=8):
+        self.repo_dir = repo_dir
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reader(self):
+        with self.lock:
+            reader = self.idle.pop() if self.idle else None
+        if reader is None:
+            reader = GitObjectReader(self.repo_dir)
+
+        try:
+            yield reader
+        except:
+            # The reader may be in the middle of a response, do not reuse it
+            reader.close()
+            raise
+
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(reader)
+                reader = None
+        if reader is not None:
+            reader.close()
+
+git_reader_pools = {}
+git_reader_pools_lock = threading.Lock()
+
+# Returns the process-wide GitObjectReaderPool of a repository
+def getGitReaderPool(repo_dir):
+    with git_reader_pools_lock:
+        if repo_dir not in git_reader_pools:
+            git_reader_pools[repo_dir] = GitObjectReaderPool(repo_dir)
+        return git_reader_pools[repo_dir]
+
+# script.sh functions implemented in Python by GitObjectReader users.
+# Projects whose plugin overrides one of them keep going through script.sh.
+GIT_SCRIPT_FUNCTIONS = ('version_rev', 'denormalize', 'get_type', 'get_blob', 'get_file', 'get_dir')
+
+# Returns True if the script.sh plugin of project redefines one of functions
+def projectOverrides(project, functions):
+    try:
+        with open(os.path.join(CURRENT_DIR, 'projects', project + '.sh')) as f:
+            plugin = f.read()
+    except FileNotFoundError:
+        return False
+
+    return any(re.search(r'^\s*' + f + r'\s*\(\)', plugin, re.MULTILINE) for f in functions)
+
 # Invoke ./script.sh with the given arguments
 # Returns the list of output lines
 
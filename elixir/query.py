@@ -19,9 +19,11 @@
 #  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
 
 from .lib import script, scriptLines, decode
+from .tokenizer import tokenize
 from . import lib
 from . import data
 import os
+import threading
 from collections import OrderedDict
 from urllib import parse
 
@@ -43,9 +45,31 @@ class SymbolInstance(object):
     def __str__(self):
         return self.__repr__()
 
+# Query instances shared by all the requests handled by this process, by data directory
+queries = {}
+queries_lock = threading.Lock()
+
+# Shared instances acquired by the request handled by each thread
+acquired_queries = threading.local()
+
+# Path tables and indexes of recently used versions, shared by all Query
+# instances, by (data directory, data generation, version, kind of table)
+version_tables = OrderedDict()
+version_tables_size = 0
+version_tables_lock = threading.Lock()
+
+# Memory that can be used by version_tables, in bytes
+def get_version_tables_max_size():
+    return int(os.environ.get('ELIXIR_PATH_CACHE_SIZE', 64)) * 1024 * 1024
+
 # Returns a Query class instance or None if project data directory does not exist
 # basedir: absolute path to parent directory of all project data directories, ex. "/srv/elixir-data/"
 # project: name of the project, directory in basedir, ex. "linux"
+# The instance is shared with other requests and threads, and must not be closed:
+# it is acquired for the request handled by this thread, which must call
+# release_queries once done with it.
+# A new one is opened when update.py is done updating the project, or when
+# it swaps the data directory to a new generation.
 def get_query(basedir, project):
     datadir = basedir + '/' + project + '/data'
     repodir = basedir + '/' + project + '/repo'
@@ -53,15 +77,81 @@ def get_query(basedir, project):
     if not os.path.exists(datadir) or not os.path.exists(repodir):
         return None
 
-    return Query(datadir, repodir)
+    # If datadir is a symlink to the current generation of the data (see
+    # data.swap_generation), all the databases are opened from the generation
+    # it points to now, even if it is swapped while they are opened
+    current_dir = os.path.realpath(datadir)
+    generation = data.get_generation(current_dir)
+
+    with queries_lock:
+        query = queries.get(datadir)
+        if query is not None and query.generation == generation:
+            query.users += 1
+        else:
+            query = None
+
+    if query is None:
+        # Opened without holding the lock, requests for other projects and
+        # requests that can use the current instance don't wait for it
+        new = Query(current_dir, repodir, shared=True)
+
+        with queries_lock:
+            query = queries.get(datadir)
+            if query is None or query.generation != generation:
+                old = query
+                query = new
+                queries[datadir] = query
+
+                # The previous instance may still be used by running requests,
+                # its databases are closed once they have all released it
+                if old is not None:
+                    old.retired = True
+                    if old.users == 0:
+                        old.db.close()
+            query.users += 1
+
+        # Another thread opened the same generation first
+        if query is not new:
+            new.db.close()
+
+    if not hasattr(acquired_queries, 'queries'):
+        acquired_queries.queries = []
+    acquired_queries.queries.append(query)
+    return query
+
+# Releases the instances acquired by get_query for the request handled by
+# this thread, and ends its reads. Instances of previous generations are
+# closed once unused.
+def release_queries():
+    released = getattr(acquired_queries, 'queries', [])
+    acquired_queries.queries = []
+
+    for query in released:
+        query.db.end_read()
+
+    with queries_lock:
+        for query in released:
+            query.users -= 1
+            if query.users == 0 and query.retired:
+                query.db.close()
 
 class Query:
-    def __init__(self, data_dir, repo_dir):
+    def __init__(self, data_dir, repo_dir, shared=False):
         self.repo_dir = repo_dir
         self.data_dir = data_dir
+        self.shared = shared
+        # Requests using a shared instance, and whether get_query replaced it
+        self.users = 0
+        self.retired = False
+        self.generation = data.get_generation(data_dir)
         self.dts_comp_support = int(self.script('dts-comp'))
-        self.db = data.DB(data_dir, readonly=True, dtscomp=self.dts_comp_support)
-        self.file_cache = {}
+        self.db = data.DB(data_dir, readonly=True, dtscomp=self.dts_comp_support, shared=shared)
+
+        # Read Git objects directly, unless the project plugin customizes how
+        self.git = None
+        project = os.path.basename(os.path.dirname(repo_dir))
+        if not lib.projectOverrides(project, lib.GIT_SCRIPT_FUNCTIONS):
+            self.git = lib.getGitReaderPool(repo_dir)
 
     def script(self, *args):
         return script(*args, env=self.getEnv())
@@ -76,8 +166,14 @@ class Query:
             "LXR_DATA_DIR": self.data_dir,
         }
 
+    # Shared instances are owned by get_query
     def close(self):
-        self.db.close()
+        if not self.shared:
+            self.db.close()
+
+    # Returns the name of a path of a version for Git, like script.sh denormalize
+    def git_object_name(self, version, path):
+        return version + ':' + path[1:]
 
     # Check if a dts compatible string exists
     def dts_comp_exists(self, ident):
@@ -86,21 +182,61 @@ class Query:
         else:
             return False
 
+    # Returns the (idx, path) entries of the PathList of version, sorted by idx.
+    # If the version is indexed, only the entries with the blob ids of the
+    # given postings are returned, so that only them are walked.
+    def get_version_files(self, version, *postings):
+        paths = self.db.vers.get(version)
+        if self.db.vers_index is not None:
+            index = self.get_version_table(version, 'index', lambda: self.db.vers_index.get(version))
+            if index is not None:
+                return index.iter(paths, (entry[0] for entries in postings for entry in entries))
+        return paths.iter()
+
+    # Returns the table of version returned by build, a PathTable or a
+    # VersionIndex, from the cache shared by all instances.
+    # Tables that build does not find (None) are not cached.
+    def get_version_table(self, version, kind, build):
+        global version_tables_size
+
+        key = (self.data_dir, self.generation, version, kind)
+        with version_tables_lock:
+            table = version_tables.get(key)
+            if table is not None:
+                version_tables.move_to_end(key)
+                return table
+
+        table = build()
+        if table is None:
+            return None
+
+        with version_tables_lock:
+            if key not in version_tables:
+                version_tables[key] = table
+                version_tables_size += table.size()
+            # Keep at least the table that was just added
+            while version_tables_size > get_version_tables_max_size() and len(version_tables) > 1:
+                _, old = version_tables.popitem(last=False)
+                version_tables_size -= old.size()
+
+        return table
+
+    # Returns the PathTable of version
+    def get_path_table(self, version):
+        def build():
+            table = None
+            if self.db.vers_paths is not None:
+                table = self.db.vers_paths.get(version)
+            if table is None:
+                paths = self.db.vers.get(version)
+                table = data.PathTable.build(paths) if paths is not None else data.PathTable()
+            return table
+
+        return self.get_version_table(version, 'paths', build)
+
     # Returns True if file exists
     def file_exists(self, version, path):
-        if version not in self.file_cache:
-            version_cache = set()
-            last_dir = None
-            for _, path in self.db.vers.get(version).iter():
-                dirname, filename = os.path.split(path)
-                if dirname != last_dir:
-                    last_dir = dirname
-                    version_cache.add(dirname)
-                version_cache.add(path)
-
-            self.file_cache[version] = version_cache
-
-        return path.strip('/') in self.file_cache[version]
+        return self.get_path_table(version).contains(path.strip('/'))
 
     # Returns the contents of the specified file
     # Tokens are marked for further processing
@@ -112,8 +248,15 @@ class Query:
         if family != None:
             assert family in lib.CACHED_DEFINITIONS_FAMILIES, f"family {family} must have its definitions cached"
 
+            # Check the table of defined idents written by update.py, if any
+            defs_table = self.db.defs_tables[family]
+            if defs_table is not None:
+                is_defined = defs_table.__contains__
+            else:
+                is_defined = self.db.defs_cache[family].exists
+
             buffer = BytesIO()
-            tokens = self.scriptLines('tokenize-file', version, path, family)
+            tokens = tokenize(self.get_file_bytes(version, path), family)
             even = True
 
             prefix = b''
@@ -123,20 +266,59 @@ class Query:
             for tok in tokens:
                 even = not even
                 tok2 = prefix + tok
-                if even and self.db.defs_cache[family].exists(tok2):
+                if even and is_defined(tok2):
                     tok = b'\033[31m' + tok2 + b'\033[0m'
                 else:
                     tok = lib.unescape(tok)
                 buffer.write(tok)
             return decode(buffer.getvalue())
         else:
-            return decode(self.script('get-file', version, path))
+            return self.get_file_raw(version, path)
 
     # Returns the contents (trees or blobs) of the specified directory
     # Example: v3.1-rc10 /arch
     def get_dir_contents(self, version, path):
-        entries_str =  decode(self.script('get-dir', version, path))
-        return entries_str.split("\n")[:-1]
+        if self.git is None:
+            entries_str =  decode(self.script('get-dir', version, path))
+            return entries_str.split("\n")[:-1]
+
+        with self.git.reader() as reader:
+            obj = reader.read(self.git_object_name(version, path))
+            if obj is None or obj[0] != 'tree':
+                return []
+
+            # Parse the tree object: "<mode> <name>\0<20 bytes hash>" entries
+            tree = obj[1]
+            entries = []
+            pos = 0
+            while pos < len(tree):
+                space = tree.index(b' ', pos)
+                nul = tree.index(b'\0', space)
+                mode = tree[pos:space].decode().rjust(6, '0')
+                name = decode(tree[space+1:nul])
+                hash = tree[nul+1:nul+21].hex()
+                pos = nul + 21
+
+                if mode == '040000':
+                    type = 'tree'
+                elif mode == '160000':
+                    type = 'commit'
+                else:
+                    type = 'blob'
+                entries.append([type, name, hash, mode])
+
+            blobs = [e for e in entries if e[0] == 'blob']
+            for entry, info in zip(blobs, reader.info_many([e[2] for e in blobs])):
+                entry[2] = str(info[2]) if info is not None else '-'
+            for entry in entries:
+                if entry[0] != 'blob':
+                    entry[2] = '-'
+
+        # Same output as script.sh get-dir: hidden files are skipped,
+        # directories come first
+        lines = [' '.join(e) for e in sorted(entries, key=lambda e: e[1])]
+        lines = [l for l in lines if ' .' not in l]
+        return sorted(lines, key=lambda l: l.split(' ', 1)[0], reverse=True)
 
     # Returns indexed versions, as a tree of OrderedDict.
     # It has a depth of 3, for example: v3 v3.1 v3.1-rc10.
@@ -173,7 +355,12 @@ class Query:
     # > ./query.py type v3.1-rc10 /arch
     # tree
     def get_file_type(self, version, path):
-        return decode(self.script('get-type', version, path)).strip()
+        if self.git is None:
+            return decode(self.script('get-type', version, path)).strip()
+
+        with self.git.reader() as reader:
+            info = reader.info(self.git_object_name(version, path))
+        return info[1] if info is not None else ''
 
     # Returns identifier search results
     def search_ident(self, version, ident, family):
@@ -196,7 +383,17 @@ class Query:
         return sorted_tags[-1].decode()
 
     def get_file_raw(self, version, path):
-        return decode(self.script('get-file', version, path))
+        return decode(self.get_file_bytes(version, path))
+
+    def get_file_bytes(self, version, path):
+        if self.git is None:
+            return self.script('get-file', version, path)
+
+        with self.git.reader() as reader:
+            obj = reader.read(self.git_object_name(version, path))
+        if obj is None or obj[0] != 'blob':
+            return b''
+        return obj[1]
 
     def get_idents_comps(self, version, ident):
 
@@ -214,13 +411,16 @@ class Query:
         if not self.dts_comp_support or not self.db.comps.exists(ident):
             return symbol_c, symbol_dts, symbol_docs
 
-        files_this_version = self.db.vers.get(version).iter()
-        comps = self.db.comps.get(ident).iter(dummy=True)
+        comps = list(self.db.comps.get(ident).iter(dummy=True))
 
         if self.db.comps_docs.exists(ident):
-            comps_docs = self.db.comps_docs.get(ident).iter(dummy=True)
+            comps_docs = list(self.db.comps_docs.get(ident).iter(dummy=True))
         else:
-            comps_docs = data.RefList().iter(dummy=True)
+            comps_docs = list(data.RefList().iter(dummy=True))
+
+        files_this_version = self.get_version_files(version, comps, comps_docs)
+        comps = iter(comps)
+        comps_docs = iter(comps_docs)
 
         comps_idx, comps_lines, comps_family = next(comps)
         comps_docs_idx, comps_docs_lines, comps_docs_family = next(comps_docs)
@@ -267,20 +467,24 @@ class Query:
         if not self.db.vers.exists(version):
             return symbol_definitions, symbol_references, symbol_doccomments
 
-        files_this_version = self.db.vers.get(version).iter()
         this_ident = self.db.defs.get(ident)
-        defs_this_ident = this_ident.iter(dummy=True)
+        defs_this_ident = list(this_ident.iter(dummy=True))
         macros_this_ident = this_ident.get_macros()
         # FIXME: see why we can have a discrepancy between defs_this_ident and refs
         if self.db.refs.exists(ident):
-            refs = self.db.refs.get(ident).iter(dummy=True)
+            refs = list(self.db.refs.get(ident).iter(dummy=True))
         else:
-            refs = data.RefList().iter(dummy=True)
+            refs = list(data.RefList().iter(dummy=True))
 
         if self.db.docs.exists(ident):
-            docs = self.db.docs.get(ident).iter(dummy=True)
+            docs = list(self.db.docs.get(ident).iter(dummy=True))
         else:
-            docs = data.RefList().iter(dummy=True)
+            docs = list(data.RefList().iter(dummy=True))
+
+        files_this_version = self.get_version_files(version, defs_this_ident, refs, docs)
+        defs_this_ident = iter(defs_this_ident)
+        refs = iter(refs)
+        docs = iter(docs)
 
         # vers, defs, refs, and docs are all populated by update.py in order of
         # idx, and there is a one-to-one mapping between blob hashes and idx
@@ -0,0 +1,396 @@
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Storage backends of the tables of a DB (see data.BsdDB), which store
+# byte string values by byte string key, sorted by key.
+# An environment holds the tables of a data directory, and opens them:
+#
+#   env.open_table(filename, readonly, shared, buffers) -> table
+#   env.has_table(filename), env.get_cache_stats(), env.close()
+#   env.end_read(): ends the reads of the calling thread, the next ones see
+#       the latest data
+#
+# Tables only deal with bytes:
+#
+#   table.get(key), table.exists(key), table.put(key, value),
+#   table.put_many([(key, value)]), table.delete(key), table.truncate(),
+#   table.iter_range(key): (key, value) pairs from the first key that is
+#       not lower than key, in order
+#   table.keys(), table.stat(): {'nkeys': number of keys},
+#   table.valid_key(key): False if key can't be stored, such keys are never
+#       found and can't be put
+#   table.sync(), table.close()
+#
+# Values of tables opened with buffers=True, which are only read, may be
+# returned as buffers that stay valid until the thread that read them calls
+# env.end_read(), or the environment is closed, instead of copies.
+
+import os
+import threading
+
+import berkeleydb
+
+BACKENDS = ('berkeleydb', 'lmdb')
+
+class BerkeleyDBEnv:
+    '''Berkeley DB environment, in which each table is a B-tree file.
+        env is an open berkeleydb.db.DBEnv, or None for tables opened on
+        their own.
+        Transactional environments, used for writing by a single thread,
+        write in one transaction, committed by sync() and close(), after
+        which a checkpoint writes the changed pages to the files. Opening
+        the environment again after a crash runs recovery, which brings the
+        tables back to their state at the last commit.'''
+    name = 'berkeleydb'
+
+    def __init__(self, env=None, transactional=False):
+        self.env = env
+        self.transactional = transactional
+        self.txn = None
+
+    def open_table(self, filename, readonly, shared, buffers=False):
+        return BerkeleyDBTable(self, filename, readonly, shared)
+
+    def has_table(self, filename):
+        return os.path.exists(filename)
+
+    # Returns the write transaction of transactional environments, None
+    # for the others
+    def get_txn(self):
+        if not self.transactional:
+            return None
+        if self.txn is None:
+            self.txn = self.env.txn_begin()
+        return self.txn
+
+    # Returns (hits, misses, {table file: (hits, misses)}) of the memory pool.
+    # Shared environments count the accesses of all the processes using them.
+    def get_cache_stats(self):
+        stats, file_stats = self.env.memp_stat()
+        files = {}
+        for name, st in file_stats.items():
+            files[os.path.basename(name)] = (st['cache_hit'], st['cache_miss'])
+        return stats['cache_hit'], stats['cache_miss'], files
+
+    def end_read(self):
+        pass
+
+    def sync(self):
+        if self.txn is not None:
+            self.txn.commit()
+            self.txn = None
+            # Log files older than the checkpoint are removed
+            self.env.txn_checkpoint()
+
+    def close(self):
+        if self.env is not None:
+            self.sync()
+            self.env.close()
+
+class BerkeleyDBTable:
+    def __init__(self, env, filename, readonly, shared):
+        self.env = env
+        self.db = berkeleydb.db.DB(env.env)
+        flags = berkeleydb.db.DB_THREAD if shared else 0
+        # Relative paths would be opened from the home of the environment
+        filename = os.path.abspath(filename)
+
+        if readonly:
+            flags |= berkeleydb.db.DB_RDONLY
+            self.db.open(filename, flags=flags)
+        else:
+            flags |= berkeleydb.db.DB_CREATE
+            if env.transactional:
+                # Tables are created in a transaction of their own
+                flags |= berkeleydb.db.DB_AUTO_COMMIT
+            self.db.open(filename, flags=flags, mode=0o644, dbtype=berkeleydb.db.DB_BTREE)
+
+    def valid_key(self, key):
+        return True
+
+    def get(self, key):
+        return self.db.get(key, txn=self.env.get_txn())
+
+    def exists(self, key):
+        return self.db.exists(key, txn=self.env.get_txn())
+
+    def put(self, key, value):
+        self.db.put(key, value, txn=self.env.get_txn())
+
+    def put_many(self, items):
+        txn = self.env.get_txn()
+        for key, value in items:
+            self.db.put(key, value, txn=txn)
+
+    def delete(self, key):
+        self.db.delete(key, txn=self.env.get_txn())
+
+    def truncate(self):
+        self.db.truncate(txn=self.env.get_txn())
+
+    def iter_range(self, key):
+        cur = self.db.cursor(self.env.get_txn())
+        try:
+            # Find "the smallest key greater than or equal to the specified key"
+            # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbcget.html
+            # See docs about the default comparison function for B-Tree databases:
+            # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbset_bt_compare.html
+            rec = cur.set_range(key)
+            while rec is not None:
+                yield rec
+                rec = cur.next()
+        finally:
+            cur.close()
+
+    def keys(self):
+        return self.db.keys(self.env.get_txn())
+
+    def stat(self):
+        return {'nkeys': self.db.stat(txn=self.env.get_txn())['nkeys']}
+
+    def sync(self):
+        if self.env.transactional:
+            self.env.sync()
+        else:
+            self.db.sync()
+
+    # Handles can't be closed while a transaction that used them is active
+    def close(self):
+        self.env.sync()
+        self.db.close()
+
+# Files of an LMDB environment, in the data directory
+LMDB_DATA_FILE = 'data.mdb'
+LMDB_LOCK_FILE = 'lock.mdb'
+
+# LMDB environments opened by this process, by real path of their directory:
+# [environment, readonly, number of LMDBEnv using it]. LMDB can't open an
+# environment twice in a process, read-only LMDBEnv of the same directory,
+# e.g. of successive generations of its data, share it.
+lmdb_envs = {}
+lmdb_envs_lock = threading.Lock()
+
+# Write transactions of LMDB can only modify a limited number of pages: they
+# are committed once they wrote about this many bytes, counting a page for
+# each change
+LMDB_MAX_WRITE_SIZE = 128 * 1024 * 1024
+
+class LMDBEnv:
+    '''LMDB environment, with all the tables of a data directory in one
+        memory-mapped file, in which each table is a named database.
+        Writable environments, used by a single thread, read and write in one
+        transaction, committed and written to disk by sync() and close(), or
+        committed once it is too large: other processes only see the changes
+        once committed.
+        Read-only environments read the tables in one transaction per thread,
+        started when it first reads and ended by end_read(): readers never
+        wait for each other or for the writer, and keep reading the data as
+        it was then. Transactions keep the pages they read from being reused
+        by the writer, they should not last longer than a request.'''
+    name = 'lmdb'
+
+    def __init__(self, dir, readonly, map_size, max_readers):
+        # Optional dependency, only needed for data directories that use it
+        import lmdb
+
+        self.readonly = readonly
+        self.dir = os.path.realpath(dir)
+        self.local = threading.local()
+        # Read transactions of all threads, ended when closing
+        self.txns = set()
+        self.txns_lock = threading.Lock()
+        self.dbs = {}
+        with lmdb_envs_lock:
+            shared = lmdb_envs.get(self.dir)
+            if shared is None:
+                env = lmdb.open(dir, map_size=map_size, max_readers=max_readers, max_dbs=64,
+                                readonly=readonly, create=not readonly, readahead=False,
+                                sync=False, metasync=False)
+                shared = lmdb_envs[self.dir] = [env, readonly, 0]
+            elif not (readonly and shared[1]):
+                raise ValueError(dir + ' is already opened for writing by this process')
+            shared[2] += 1
+            self.env = shared[0]
+
+            # Tables opened after a transaction began can't be read by it: open
+            # them all before the first one, their names are the keys of the
+            # main database. Tables created since another LMDBEnv opened the
+            # environment are found too.
+            if readonly:
+                with self.env.begin() as txn:
+                    names = [bytes(name) for name in txn.cursor().iternext(values=False)]
+                for name in names:
+                    self.dbs[name] = self.env.open_db(name, create=False)
+        self.max_key_size = self.env.max_key_size()
+        self.page_size = self.env.stat()['psize']
+        self.write_txn = None
+        self.write_size = 0
+        self.committed = False # Changes committed since the last sync
+
+    # Returns the named database of a table
+    def open_db(self, name):
+        if name not in self.dbs:
+            if self.readonly:
+                self.dbs[name] = self.env.open_db(name, create=False)
+            else:
+                self.dbs[name] = self.env.open_db(name, txn=self.get_txn(), create=True)
+        return self.dbs[name]
+
+    def open_table(self, filename, readonly, shared, buffers=False):
+        return LMDBTable(self, os.path.basename(filename).encode(), buffers)
+
+    def has_table(self, filename):
+        if self.readonly:
+            return os.path.basename(filename).encode() in self.dbs
+        return self.get_txn().get(os.path.basename(filename).encode()) is not None
+
+    # Returns the transaction that tables read from: the read transaction of
+    # this thread, or the write transaction in writable environments
+    def get_txn(self):
+        if self.readonly:
+            return self.get_read_txn()
+        if self.write_txn is None:
+            self.write_txn = self.env.begin(write=True)
+        return self.write_txn
+
+    # Counts the bytes changed by the write transaction
+    def wrote(self, size):
+        self.write_size += size + self.page_size
+        if self.write_size >= LMDB_MAX_WRITE_SIZE:
+            self.commit()
+
+    def commit(self):
+        if self.write_txn is not None:
+            self.write_txn.commit()
+            self.write_txn = None
+            self.write_size = 0
+            self.committed = True
+
+    # Returns the read transaction of this thread, in read-only environments
+    def get_read_txn(self):
+        txn = getattr(self.local, 'txn', None)
+        if txn is None:
+            txn = self.local.txn = self.env.begin(buffers=True)
+            with self.txns_lock:
+                self.txns.add(txn)
+        return txn
+
+    # Ends the read transaction of this thread. Transactions can be ended
+    # from any thread: the environment is opened without thread-local storage.
+    def end_read(self):
+        txn = getattr(self.local, 'txn', None)
+        if txn is not None:
+            self.local.txn = None
+            with self.txns_lock:
+                self.txns.discard(txn)
+            txn.abort()
+
+    # Pages are read from the page cache of the system
+    def get_cache_stats(self):
+        return 0, 0, {}
+
+    def sync(self):
+        if not self.readonly:
+            self.commit()
+            if self.committed:
+                self.env.sync(True)
+                self.committed = False
+
+    def close(self):
+        self.sync()
+        # Other LMDBEnv may keep using the environment
+        with self.txns_lock:
+            for txn in self.txns:
+                txn.abort()
+            self.txns = set()
+
+        with lmdb_envs_lock:
+            shared = lmdb_envs[self.dir]
+            shared[2] -= 1
+            if shared[2] == 0:
+                del lmdb_envs[self.dir]
+                self.env.close()
+
+class LMDBTable:
+    def __init__(self, env, name, buffers):
+        self.env = env
+        self.buffers = buffers
+        self.db = env.open_db(name)
+
+    # Keys that LMDB can't store are empty or too long
+    def valid_key(self, key):
+        return 0 < len(key) <= self.env.max_key_size
+
+    def get(self, key):
+        if not self.valid_key(key):
+            return None
+        value = self.env.get_txn().get(key, db=self.db)
+        if value is not None and not self.buffers and not isinstance(value, bytes):
+            value = bytes(value)
+        return value
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, value):
+        self.put_many(((key, value),))
+
+    def put_many(self, items):
+        items = list(items)
+        for key, _ in items:
+            if not self.valid_key(key):
+                raise ValueError('invalid LMDB key: ' + repr(key[:64]))
+        for key, value in items:
+            self.env.get_txn().put(key, value, db=self.db)
+            self.env.wrote(len(key) + len(value))
+
+    def delete(self, key):
+        self.env.get_txn().delete(key, db=self.db)
+        self.env.wrote(len(key))
+
+    def truncate(self):
+        self.env.get_txn().drop(self.db, delete=False)
+        self.env.wrote(0)
+
+    # The write transaction may be committed by writes made while iterating,
+    # which stops the iteration with an error
+    def iter_range(self, key):
+        cur = self.env.get_txn().cursor(db=self.db)
+        if key:
+            found = cur.set_range(key)
+        else:
+            found = cur.first()
+        if not found:
+            return
+        for key, value in cur.iternext():
+            if not self.buffers and not isinstance(value, bytes):
+                value = bytes(value)
+            yield bytes(key), value
+
+    def keys(self):
+        return [bytes(key) for key in self.env.get_txn().cursor(db=self.db).iternext(values=False)]
+
+    def stat(self):
+        return {'nkeys': self.env.get_txn().stat(self.db)['entries']}
+
+    def sync(self):
+        self.env.sync()
+
+    # Named databases are closed with their environment
+    def close(self):
+        pass
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Python version of the `script.sh tokenize-file` pipeline.
+# Files are split into a list of tokens that alternate between text that
+# cannot contain identifiers (odd tokens, starting with the first one),
+# and candidate identifiers (even tokens).
+# Newlines are replaced by '\1' in the tokens, so that lines can be counted.
+
+import re
+
+# Comments, strings, includes and non-word characters are skipped
+regex_default = re.compile(rb'''((/\*.*?\*/|//.*?\x01|[^']"(\\.|.)*?"|# *include *<.*?>|\W)+)(\w+)?''')
+
+# Don't cut around '-' in devicetrees
+regex_devicetree = re.compile(rb'''((/\*.*?\*/|//.*?\x01|[^']"(\\.|.)*?"|# *include *<.*?>|[^\w-])+)([\w-]+)?''')
+
+# Returns the list of tokens of data, the content of a file of the given family
+def tokenize(data, family):
+    regex = regex_devicetree if family == 'D' else regex_default
+    result = regex.sub(rb'\1\n\4\n', data.replace(b'\n', b'\1'))
+    tokens = result.split(b'\n')
+
+    # Like script.sh, drop the last line of the result
+    if result.endswith(b'\n'):
+        return tokens[:-2]
+    else:
+        return tokens[:-1]
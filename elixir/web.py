@@ -38,7 +38,7 @@ from .filters import get_filters
 from .filters.utils import FilterContext
 from .autocomplete import AutocompleteResource
 from .api import ApiIdentGetterResource
-from .query import get_query
+from .query import get_query, release_queries
 from .web_utils import ProjectConverter, IdentConverter, validate_version, validate_project, validate_ident, \
         get_elixir_version_string, get_elixir_repo_url, RequestContext, Config
 
@@ -140,9 +140,6 @@ def get_project_error_page(req, resp, exception: ElixirProjectError):
     template = req.context.jinja_env.get_template('error.html')
     result = template.render(template_ctx)
 
-    if exception.query is not None:
-        exception.query.close()
-
     return result
 
 # Generate an error page from falcon exceptions
@@ -247,8 +244,6 @@ class SourceResource:
             resp.content_type = falcon.MEDIA_HTML
             resp.status, resp.text = generate_source_page(req.context, query, project, version, path)
 
-        query.close()
-
 # Handles source URLs without a path, ex. '/u-boot/v2023.10/source'.
 # Note lack of trailing slash
 class SourceWithoutPathResource(SourceResource):
@@ -300,8 +295,6 @@ class IdentPostRedirectResource:
         resp.status = falcon.HTTP_MOVED_PERMANENTLY
         resp.location = stringify_ident_path(project, version, post_family, post_ident)
 
-        query.close()
-
 # Handles ident URLs when family is specified in the URL, both POST and GET
 # See IdentPostRedirectResource for behavior on POST
 # Path parameters are asssumed to be unquoted by converters
@@ -334,8 +327,6 @@ class IdentResource(IdentPostRedirectResource):
         resp.content_type = falcon.MEDIA_HTML
         resp.status, resp.text = generate_ident_page(req.context, query, project, version, family, ident)
 
-        query.close()
-
 # Handles ident URLs when family is not specified in the URL
 # Also handles POST requests for ident URLs without family - IdentPostRedirectResource is
 # inherited from IdentResource
@@ -776,6 +767,11 @@ class RequestContextMiddleware:
             self.versions_cache_lock,
         )
 
+# Releases the Query instances used by a request, once its response is ready
+class QueryReleaseMiddleware:
+    def process_response(self, req, resp, resource, req_succeeded):
+        release_queries()
+
 # Serialies caught exceptions to JSON or HTML
 # See https://falcon.readthedocs.io/en/stable/api/app.html#falcon.App.set_error_serializer
 def error_serializer(req, resp, exception):
@@ -799,6 +795,7 @@ def get_application():
     app = falcon.App(middleware=[
         RawPathComponent(),
         RequestContextMiddleware(get_jinja_env()),
+        QueryReleaseMiddleware(),
     ])
 
     app.router_options.converters['project'] = ProjectConverter
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Finds the definitions of a batch of blobs, like `script.sh parse-defs` does
+# for one blob, but with one ctags run per family for the whole batch.
+# The doc comments of C blobs are found from the same ctags results.
+
+import os
+import re
+import subprocess
+import tempfile
+
+from find_doc_comments import FindDocComments
+
+# ctags options for each family, see parse_defs_* in script.sh
+ctags_options = {
+    'C': ('--kinds-c=+p+x', '--extras=-{anonymous}'),
+    'K': ('--language-force=kconfig', '--kinds-kconfig=c', '--extras-kconfig=-{configPrefixed}'),
+    'D': ('--language-force=dts',),
+}
+
+# Kinds of definitions that are not looked for by find-file-doc-comments.pl,
+# which runs ctags with --c-kinds=+p-m
+doc_comments_ignored_types = ('member', 'externvar')
+
+class FindDefinitions:
+    def __init__(self):
+        # Function macros, e.g., in .S files
+        self.regex_entry = re.compile(rb'^\s*ENTRY\((\w+)\)')
+        self.regex_syscall = re.compile(rb'^SYSCALL_DEFINE[0-9]\(\s*(\w+)\W')
+        self.doc_comments_parser = FindDocComments()
+
+    # Returns the (ident, type, line) definitions of lines in ctags -x format,
+    # by idx of the blob they were found in
+    def parse_ctags(self, output, dir, family):
+        defs = {}
+        prefix = os.fsencode(dir) + b'/'
+        for l in output.split(b'\n'):
+            if family == 'C' and (l.startswith(b'operator ') or l.startswith(b'CONFIG_')):
+                continue
+
+            fields = l.split(None, 3)
+            if len(fields) < 4 or not fields[3].startswith(prefix):
+                continue
+            ident, type, line, path = fields
+
+            if family == 'K':
+                ident = b'CONFIG_' + ident
+
+            idx = int(path[len(prefix):path.index(b'/', len(prefix))])
+            defs.setdefault(idx, []).append((ident, type.decode(), int(line)))
+        return defs
+
+    # Returns the definitions of the ENTRY() and SYSCALL_DEFINE macros of
+    # content, matched line by line like perl -ne does
+    def parse_macros(self, content):
+        entries = []
+        syscalls = []
+        lines = content.split(b'\n')
+        for num, line in enumerate(lines, 1):
+            if num < len(lines):
+                line += b'\n'
+            elif not line:
+                break
+
+            m = self.regex_entry.match(line)
+            if m:
+                entries.append((m.group(1), 'function', num))
+            m = self.regex_syscall.match(line)
+            if m:
+                syscalls.append((b'sys_' + m.group(1), 'function', num))
+        return entries + syscalls
+
+    # blobs: list of (idx, filename, content, family)
+    # Returns (defs, docs) for each blob, by idx
+    # defs: [(ident, type, line)], docs: [(ident, line)] or None if the
+    # family of the blob has no doc comments
+    def run(self, blobs):
+        tags = {}
+        with tempfile.TemporaryDirectory() as dir:
+            paths = {family: [] for family in ctags_options}
+            for idx, filename, content, family in blobs:
+                tags[idx] = []
+                if family not in ctags_options:
+                    continue
+
+                # Keep the name of the file, ctags guesses languages from it
+                os.mkdir(os.path.join(dir, str(idx)))
+                path = os.path.join(dir, str(idx), filename)
+                with open(path, 'wb') as f:
+                    f.write(content)
+                paths[family].append(path)
+
+            for family, family_paths in paths.items():
+                if not family_paths:
+                    continue
+
+                # File names are read from stdin, there may be too many for the command line
+                p = subprocess.run(('ctags', '-x', *ctags_options[family], '-L', '-'),
+                                   input=os.fsencode('\n'.join(family_paths) + '\n'),
+                                   stdout=subprocess.PIPE)
+                for idx, defs in self.parse_ctags(p.stdout, dir, family).items():
+                    tags[idx] += defs
+
+        result = {}
+        for idx, filename, content, family in blobs:
+            if family == 'C':
+                docs = self.doc_comments_parser.run(content,
+                            [tag for tag in tags[idx] if tag[1] not in doc_comments_ignored_types])
+                result[idx] = (tags[idx] + self.parse_macros(content), docs)
+            else:
+                result[idx] = (tags[idx], None)
+
+        return result
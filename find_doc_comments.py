@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  By Christopher White <cwhite@d3engineering.com>
+#  Copyright (c) 2019--2020 D3 Engineering, LLC.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Python version of find-file-doc-comments.pl, which finds the doc comments
+# of a file from the definitions ctags found in it. Here, the definitions
+# are given by the caller, so that ctags doesn't run again on the file.
+
+import re
+
+# Perl's \h, for byte strings
+h = rb'[\t \xa0]'
+
+class FindDocComments:
+    def __init__(self):
+        # Start of doc comment
+        self.regex_opener = re.compile(rb'^' + h + rb'*/\*\*(?:' + h + rb'|$)')
+        self.regex_define = re.compile(rb'^' + h + rb'*#' + h + rb'*define')
+        self.regex_identifier_start = re.compile(rb'^[a-z_]', re.I)
+        # Empty line, end of comment or continuation of comment
+        self.regex_skipped = re.compile(rb'^' + h + rb'*$|^' + h + rb'+\*/|^' + h + rb'+\*(?:' + h + rb'|$)')
+        self.comment_leader = rb'^' + h + rb'+\*' + h + rb'+(?:(?:struct|enum|union|typedef)' + h + rb'+)?'
+
+    # content: the content of a C file
+    # tags: [(ident, type, line)] definitions in content, in ctags order
+    # Returns the [(ident, line)] doc comments of the definitions
+    def run(self, content, tags):
+        # Index functions and types by line. Don't index anything by name,
+        # since there can be multiple names with different types/lines (#186).
+        definition_lines = {}
+        definition_types = {}
+        for ident, type, line in tags:
+            definition_lines[line] = ident
+            definition_types[line] = type
+
+        if not definition_lines:
+            return []
+
+        # Lines keep their newline, and indices match 1-based line numbers
+        source_lines = [None] + content.split(b'\n')
+        for i in range(1, len(source_lines) - 1):
+            source_lines[i] += b'\n'
+        if source_lines[-1] == b'':
+            del source_lines[-1]
+
+        # Work backwards through the file and look for doc comments
+        doc_comments = []
+        lineno = len(source_lines)
+        while True:
+            lineno -= 1
+            if lineno < 1:
+                break
+
+            if lineno not in definition_lines:
+                continue
+            definition_name = definition_lines[lineno]
+            definition_type = definition_types[lineno]
+
+            # Comment header: be liberal in what we accept, the type of the
+            # definition isn't checked against the type in the comment header.
+            this_doc_comment_header = re.compile(self.comment_leader + re.escape(definition_name) +
+                                                 rb'(?:' + h + rb'|\(|:|$)')
+
+            # Make sure we get back past the first line of multiline definitions
+            if definition_type == 'macro':
+                while lineno and not self.regex_define.search(source_lines[lineno]):
+                    lineno -= 1
+            elif definition_type == 'function':
+                # Try to handle the case of "int\nfoo()"
+                if re.search(rb'^' + h + rb'*' + re.escape(definition_name) + rb'\b', source_lines[lineno]):
+                    while lineno and self.regex_identifier_start.search(source_lines[lineno]):
+                        lineno -= 1
+
+            # Move to the first line that might be a doc comment
+            lineno -= 1
+
+            # If we ran off the beginning of the file, there's no doc comment
+            if lineno <= 0:
+                continue
+
+            # Find the last line that could be a doc comment header for this definition
+            while lineno and (self.regex_skipped.search(source_lines[lineno]) or
+                              this_doc_comment_header.search(source_lines[lineno])):
+                lineno -= 1
+
+            # Check the last line that matched, because we may have just
+            # skipped past this_doc_comment_header
+            lineno += 1
+
+            # Is it actually a header for this definition?
+            if not this_doc_comment_header.search(source_lines[lineno]):
+                continue
+
+            # We have found a header, confirm it's a doc comment
+            lineno -= 1
+            if lineno > 0 and self.regex_opener.search(source_lines[lineno]):
+                doc_comments.append((definition_name, lineno))
+
+        return doc_comments
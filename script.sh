@@ -135,6 +135,59 @@ list_blobs()
     sed -r "s/^\S* blob (\S*)\t(([^/]*\/)*(.*))$/$format/; /^\S* commit .*$/d"
 }
 
+list_parent_tags()
+{
+    # For each tag, the tags of its nearest tagged ancestor, following first
+    # parents: "<tag> <parent tag>...", computed in one pass over the history.
+    # awk reads the tags (N) and their refs (R, in the same order), the
+    # commits of the tags (T, annotated tags have a peeled object) and the
+    # tagged commits with the nearest decorated ancestors as parents (C).
+    {
+        echo "$tags" | sed 's/^/N /'
+        echo "$tags" | version_rev | sed 's/^/R /'
+        git for-each-ref --format='T %(objectname) %(*objectname) %(refname:strip=2)' refs/tags
+        git log --tags --simplify-by-decoration --parents --format='C %H %P'
+    } |
+    awk '
+        $1 == "N" && NF == 2 { name[++n] = $2 }
+        $1 == "R" && NF == 2 { tag[$2] = name[++r] }
+        $1 == "T" {
+            if (NF == 4) { commit = $3; ref = $4 } else { commit = $2; ref = $3 }
+            if (ref in tag)
+                tags[commit] = tags[commit] " " tag[ref]
+        }
+        $1 == "C" { parent[$2] = $3 }
+        END {
+            for (commit in tags) {
+                p = parent[commit]
+                while (p != "" && !(p in tags))
+                    p = parent[p]
+                if (p == "")
+                    continue
+                n = split(tags[commit], t, " ")
+                for (i = 1; i <= n; i++)
+                    print t[i] tags[p]
+            }
+        }'
+}
+
+list_ancestor_tags()
+{
+    # Tags of the ancestors of a version, itself included
+    v=`echo $opt1 | version_rev`
+    git tag --merged "$v" 2>/dev/null |
+    version_dir
+}
+
+diff_blobs()
+{
+    # Blobs changed between two versions, in raw diff-tree format:
+    # ":<old mode> <new mode> <old hash> <new hash> <status>\t<path>"
+    v1=`echo $opt1 | version_rev`
+    v2=`echo $opt2 | version_rev`
+    git diff-tree -r "$v1" "$v2"
+}
+
 untokenize()
 {
     tr -d '\n' |
@@ -271,6 +324,19 @@ case $cmd in
         list_blobs
         ;;
 
+    list-parent-tags)
+        tags=`get_tags`
+        list_parent_tags
+        ;;
+
+    list-ancestor-tags)
+        list_ancestor_tags
+        ;;
+
+    diff-blobs)
+        diff_blobs
+        ;;
+
     tokenize-file)
         tokenize_file
         ;;
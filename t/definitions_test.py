@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that FindDefinitions finds the same definitions in a batch of the
+# files in tree/ as `script.sh parse-defs` does on each of them
+
+import os
+import sys
+import unittest
+
+from utils import elixir_dir, TreeRepo
+sys.path.insert(0, elixir_dir)
+
+from elixir import lib
+from find_definitions import FindDefinitions
+
+class DefinitionsTest(unittest.TestCase):
+    def setUp(self):
+        self.repo = TreeRepo()
+        self.repo_dir = self.repo.repo_dir
+        self.files = self.repo.files
+        self.hashes = self.repo.hashes
+
+    def tearDown(self):
+        self.repo.cleanup()
+
+    def script_defs(self, hash, filename, family):
+        env = {**os.environ, 'LXR_REPO_DIR': self.repo_dir}
+        defs = []
+        for l in lib.scriptLines('parse-defs', hash, filename, family, env=env):
+            ident, type, line = l.split(b' ')
+            defs.append((ident, type.decode(), int(line.decode())))
+        return defs
+
+    def test_same_defs_as_script(self):
+        blobs = []
+        hashes = []
+        for path, hash in zip(self.files, self.hashes):
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            # Also check the devicetree and Kconfig variants on all files
+            for family in sorted({lib.getFileFamily(path) or 'C', 'D', 'K'}):
+                blobs.append((len(blobs), os.path.basename(path), content, family))
+                hashes.append(hash)
+
+        defs = FindDefinitions().run(blobs)
+        for (idx, filename, _, family), hash in zip(blobs, hashes):
+            with self.subTest(filename=filename, family=family):
+                self.assertEqual(defs[idx][0], self.script_defs(hash, filename, family))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that DefList values are the same once packed in the binary format
+# and loaded back, and that the text format of older databases is still read
+
+import sys
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+class DefListTest(unittest.TestCase):
+    def test_empty(self):
+        defs = data.DefList()
+        self.assertEqual(list(defs.iter()), [])
+        loaded = data.DefList(defs.pack())
+        self.assertEqual(list(loaded.iter()), [])
+        self.assertEqual(loaded.get_families(), [])
+        self.assertEqual(loaded.get_macros(), [])
+
+    def test_single_entry(self):
+        defs = data.DefList()
+        defs.append(7, 'function', 12, 'C')
+        loaded = data.DefList(defs.pack())
+        self.assertEqual(list(loaded.iter()), [(7, 'function', 12, 'C')])
+        self.assertEqual(list(loaded.iter(dummy=True))[-1], data.DefList.dummy)
+        self.assertEqual(loaded.get_families(), ['C'])
+
+    def test_binary_round_trip(self):
+        entries = [
+            (1, 'define', 3, 'C'),
+            (1, 'macro', 10, 'K'),
+            (200, 'struct', 100000, 'D'),
+            (70000, 'config', 1, 'K'),
+        ]
+        defs = data.DefList()
+        for entry in entries:
+            defs.append(*entry)
+        packed = defs.pack()
+        self.assertTrue(data.is_binary(packed))
+
+        loaded = data.DefList(packed)
+        self.assertEqual(list(loaded.iter()), entries)
+        self.assertEqual(loaded.get_families(), ['C', 'K', 'D'])
+        self.assertEqual(loaded.get_macros(), ['K'])
+        self.assertEqual(loaded.pack(), packed)
+
+    def test_out_of_order_append(self):
+        defs = data.DefList()
+        defs.append(5, 'function', 1, 'C')
+        defs.append(2, 'variable', 2, 'C')
+        defs.append(9, 'typedef', 3, 'C')
+        self.assertEqual([entry[0] for entry in data.DefList(defs.pack()).iter()], [2, 5, 9])
+
+    def test_unknown_type_ignored(self):
+        defs = data.DefList()
+        defs.append(1, 'unknown', 1, 'C')
+        self.assertEqual(list(defs.iter()), [])
+        self.assertEqual(defs.get_families(), [])
+
+    def test_text_format(self):
+        # Entries of the text format are not sorted
+        defs = data.DefList(b'12f34C,5M2K#C,K')
+        self.assertEqual(list(defs.iter()), [(5, 'macro', 2, 'K'), (12, 'function', 34, 'C')])
+        self.assertEqual(defs.get_families(), ['K', 'C'])
+        self.assertEqual(defs.get_macros(), ['K'])
+
+        # Converted when written back
+        loaded = data.DefList(defs.pack())
+        self.assertTrue(data.is_binary(defs.pack()))
+        self.assertEqual(list(loaded.iter()), list(defs.iter()))
+
+    def test_empty_text_format(self):
+        defs = data.DefList(b'#')
+        self.assertEqual(list(defs.iter()), [])
+        self.assertEqual(defs.get_families(), [])
+
+    def test_unsupported_version(self):
+        packed = bytearray(data.DefList().pack())
+        packed[1] = data.DEFLIST_VERSION + 1
+        with self.assertRaises(ValueError):
+            data.DefList(bytes(packed))
+
+if __name__ == '__main__':
+    unittest.main()
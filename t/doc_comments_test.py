@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that FindDocComments finds the same doc comments as
+# find-file-doc-comments.pl on the files in tree/, given the same ctags results
+
+import os
+import sys
+import subprocess
+import unittest
+
+elixir_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.insert(0, elixir_dir)
+
+from find_doc_comments import FindDocComments
+
+tree_dir = os.path.join(elixir_dir, 't', 'tree')
+
+class DocCommentsTest(unittest.TestCase):
+    def setUp(self):
+        self.files = []
+        for root, _, filenames in os.walk(tree_dir):
+            for filename in filenames:
+                self.files.append(os.path.join(root, filename))
+
+    # The definitions find-file-doc-comments.pl gets from ctags
+    def ctags_defs(self, path):
+        output = subprocess.run(('ctags', '-x', '--c-kinds=+p-m', '--language-force=C', path),
+                                stdout=subprocess.PIPE, check=True).stdout
+        defs = []
+        for l in output.split(b'\n'):
+            fields = l.split()
+            if len(fields) >= 3 and not l.startswith(b'operator '):
+                defs.append((fields[0], fields[1].decode(), int(fields[2])))
+        return defs
+
+    def script_docs(self, path):
+        output = subprocess.run((os.path.join(elixir_dir, 'find-file-doc-comments.pl'), path),
+                                stdout=subprocess.PIPE, check=True).stdout
+        docs = []
+        for l in output.split(b'\n')[:-1]:
+            ident, line = l.split(b' ')
+            docs.append((ident, int(line)))
+        return docs
+
+    def test_same_docs_as_script(self):
+        parser = FindDocComments()
+        for path in self.files:
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            with self.subTest(path=path):
+                # The script gives the doc comments in a random order
+                self.assertEqual(sorted(parser.run(content, self.ctags_defs(path))),
+                                 sorted(self.script_docs(path)))
+
+    def test_edge_cases(self):
+        parser = FindDocComments()
+        self.assertEqual(parser.run(b'', [(b'f', 'function', 1)]), [])
+        self.assertEqual(parser.run(b'int f(void);\n', []), [])
+        self.assertEqual(parser.run(b'/**\n * f() - x\n */\nint f(void)', [(b'f', 'function', 4)]),
+                         [(b'f', 1)])
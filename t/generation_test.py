@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that update.py --swap replaces the data directory by its next
+# generation, the first time when it is still a directory, and later when
+# it is a symlink to the current generation
+
+import os
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+class SwapGenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.dir = os.path.join(self.root.name, 'data')
+        os.mkdir(self.dir)
+        self.write('1')
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def write(self, value, dir=None):
+        with open(os.path.join(dir or self.dir, 'variables.db'), 'w') as f:
+            f.write(value)
+
+    def read(self):
+        with open(os.path.join(self.dir, 'variables.db')) as f:
+            return f.read()
+
+    def swap(self, value):
+        next_dir = data.prepare_next_generation(self.dir)
+        self.write(value, next_dir)
+        # Readers still see the current generation
+        self.assertEqual(self.read(), str(int(value) - 1))
+        return data.swap_generation(self.dir)
+
+    def test_first_swap(self):
+        new_dir = self.swap('2')
+        self.assertEqual(new_dir, self.dir + '.2')
+        self.assertEqual(os.readlink(self.dir), 'data.2')
+        self.assertEqual(self.read(), '2')
+        # The previous data directory is kept as the previous generation
+        self.assertEqual(data.list_generations(self.dir), [(1, self.dir + '.1'), (2, self.dir + '.2')])
+        self.assertEqual(sorted(os.listdir(self.root.name)), ['data', 'data.1', 'data.2'])
+        self.assertTrue(data.is_swapped_generation(self.dir))
+
+    def test_first_swap_without_exchange(self):
+        exchange_paths = data.exchange_paths
+        data.exchange_paths = lambda a, b: False
+        try:
+            self.swap('2')
+        finally:
+            data.exchange_paths = exchange_paths
+        self.assertEqual(os.readlink(self.dir), 'data.2')
+        self.assertEqual(self.read(), '2')
+        self.assertEqual(sorted(os.listdir(self.root.name)), ['data', 'data.1', 'data.2'])
+
+    def test_next_swaps(self):
+        self.swap('2')
+        self.assertEqual(self.swap('3'), self.dir + '.3')
+        self.assertEqual(os.readlink(self.dir), 'data.3')
+        self.assertEqual(self.read(), '3')
+        # Generations older than the previous one are removed
+        self.assertEqual(sorted(os.listdir(self.root.name)), ['data', 'data.2', 'data.3'])
+
+if __name__ == '__main__':
+    unittest.main()
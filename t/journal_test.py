@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that the keys written to the journal are read back, even after an
+# interrupted write, and that replaying them removes the entries appended
+# after a checkpoint, like update.py does when it resumes a tag
+
+import os
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+def new_refs(ids):
+    refs = data.RefList()
+    for id in ids:
+        refs.append(id, '1', 'C')
+    return refs
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'update-journal')
+        self.journal = data.Journal(self.filename)
+        self.refs = data.BsdDB(os.path.join(self.dir.name, 'references.db'), False, data.RefList,
+                               segmented=True)
+        self.defs = data.BsdDB(os.path.join(self.dir.name, 'definitions.db'), False, data.DefList,
+                               segmented=True)
+
+    def tearDown(self):
+        self.journal.close()
+        self.refs.close()
+        self.defs.close()
+        self.dir.cleanup()
+
+    def get_ids(self, table, key):
+        return [entry[0] for entry in table.get(key).iter()]
+
+    def test_empty(self):
+        self.assertEqual(self.journal.get_keys(), {})
+
+    def test_get_keys(self):
+        self.journal.add(self.refs, [b'a', b'b'])
+        self.journal.add(self.defs, [b'a'])
+        # Keys are hexadecimal, so they may contain spaces and new lines
+        self.journal.add(self.refs, [b'a', b'x y\n\0'])
+        self.assertEqual(self.journal.get_keys(), {
+            'references.db': {b'a', b'b', b'x y\n\0'},
+            'definitions.db': {b'a'},
+        })
+
+        # Still there when the journal is opened again
+        self.journal.close()
+        self.journal = data.Journal(self.filename)
+        self.assertEqual(len(self.journal.get_keys()['references.db']), 3)
+
+    def test_truncated_line(self):
+        self.journal.add(self.refs, [b'a'])
+        with open(self.filename, 'ab') as f:
+            f.write(b'references.db ' + b'b'.hex().encode())
+        self.assertEqual(self.journal.get_keys(), {'references.db': {b'a'}})
+
+    def test_clear(self):
+        self.journal.add(self.refs, [b'a'])
+        self.journal.clear()
+        self.assertEqual(self.journal.get_keys(), {})
+        self.assertEqual(os.path.getsize(self.filename), 0)
+
+        self.journal.add(self.refs, [b'b'])
+        self.assertEqual(self.journal.get_keys(), {'references.db': {b'b'}})
+
+    def test_replay(self):
+        # Entries of a previous tag, written before the checkpoint
+        self.refs.append(b'a', new_refs([0, 1]))
+        self.refs.append(b'c', new_refs([1]))
+        first_idx = 2
+
+        # Interrupted run, which appended to a new key and to an existing one
+        self.journal.add(self.refs, [b'a', b'b'])
+        self.refs.append(b'a', new_refs([2, 3]))
+        self.refs.append(b'b', new_refs([3]))
+
+        for key in self.journal.get_keys()['references.db']:
+            self.refs.remove_entries(key, first_idx)
+
+        self.assertEqual(self.get_ids(self.refs, b'a'), [0, 1])
+        self.assertFalse(self.refs.exists(b'b'))
+        self.assertEqual(self.get_ids(self.refs, b'c'), [1])
+
+        # Replaying twice changes nothing
+        for key in self.journal.get_keys()['references.db']:
+            self.refs.remove_entries(key, first_idx)
+        self.assertEqual(self.get_ids(self.refs, b'a'), [0, 1])
+
+    def test_remove_entries_deflist(self):
+        defs = data.DefList()
+        defs.append(1, 'function', 3, 'C')
+        defs.append(4, 'macro', 5, 'C')
+        self.defs.append(b'a', defs)
+        self.defs.remove_entries(b'a', 4)
+        self.assertEqual(list(self.defs.get(b'a').iter()), [(1, 'function', 3, 'C')])
+        # The family of the removed entry is not kept
+        self.assertEqual(self.defs.get(b'a').get_macros(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that the PathTable of a version has its files and directories,
+# before and after being packed and loaded back
+
+import sys
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+def new_paths(entries):
+    paths = data.PathList()
+    for id, path in entries:
+        paths.append(id, path.encode())
+    return paths
+
+class PathTableTest(unittest.TestCase):
+    def test_empty(self):
+        table = data.PathTable.build(data.PathList())
+        self.assertFalse(table.contains(''))
+        self.assertFalse(table.contains('a'))
+        loaded = data.PathTable(table.pack())
+        self.assertFalse(loaded.contains('a'))
+        self.assertEqual(loaded.pack(), table.pack())
+
+    def test_single_entry(self):
+        table = data.PathTable(data.PathTable.build(new_paths([(0, 'dir/file.c')])).pack())
+        self.assertTrue(table.contains('dir/file.c'))
+        self.assertTrue(table.contains('dir'))
+        self.assertFalse(table.contains('dir/'))
+        self.assertFalse(table.contains('dir/file'))
+        self.assertFalse(table.contains('file.c'))
+
+    def test_build(self):
+        paths = new_paths([
+            (1, 'Makefile'),
+            (2, 'include/linux/list.h'),
+            (3, 'include/uapi/linux/types.h'),
+            (3, 'lib/list.c'),
+        ])
+        table = data.PathTable.build(paths)
+        for loaded in (table, data.PathTable(table.pack())):
+            for path in ('Makefile', 'include/linux/list.h', 'include/uapi/linux/types.h',
+                         'lib/list.c', 'include/linux', 'include/uapi/linux', 'lib'):
+                self.assertTrue(loaded.contains(path), path)
+            # Like before, only the directories of files are added, not their parents
+            self.assertFalse(loaded.contains('include'))
+            self.assertFalse(loaded.contains('include/uapi'))
+            for path in ('makefile', 'Makefile/', 'include/linux/list', 'lib/list.c.orig', 'zzz'):
+                self.assertFalse(loaded.contains(path), path)
+
+        # Files at the root have an empty directory
+        self.assertTrue(table.contains(''))
+
+    def test_unknown_format(self):
+        packed = bytearray(data.PathTable().pack())
+        packed[1] = data.PATHTABLE_VERSION + 1
+        with self.assertRaises(ValueError):
+            data.PathTable(bytes(packed))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that PostingBuffer keeps entries in memory until it is full or
+# flushed, and then appends them to the database in key order
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+class PostingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.table = data.BsdDB(os.path.join(self.dir.name, 'references.db'), False, data.RefList,
+                                segmented=True)
+
+        # Records the keys appended to, in order
+        self.appended = []
+        append = self.table.append
+        def record_append(key, obj):
+            self.appended.append(key)
+            append(key, obj)
+        self.table.append = record_append
+
+    def tearDown(self):
+        self.table.close()
+        self.dir.cleanup()
+
+    def get_entries(self, key):
+        return list(self.table.get(key).iter())
+
+    def test_empty_flush(self):
+        buffer = data.PostingBuffer(self.table, 1 << 20)
+        buffer.flush()
+        self.assertEqual(self.appended, [])
+        self.assertEqual(self.table.get_keys(), [])
+
+    def test_single_entry(self):
+        buffer = data.PostingBuffer(self.table, 1 << 20)
+        buffer.append('ident', 1, '4', 'C')
+        self.assertTrue(buffer.exists(b'ident'))
+        self.assertFalse(self.table.exists(b'ident'))
+
+        buffer.flush()
+        self.assertFalse(buffer.exists(b'ident'))
+        self.assertEqual(buffer.size, 0)
+        self.assertEqual(self.get_entries(b'ident'), [(1, '4', 'C')])
+
+    def test_flush_in_key_order(self):
+        buffer = data.PostingBuffer(self.table, 1 << 20)
+        for key in (b'c', b'a', b'b', b'a'):
+            buffer.append(key, 1, '1', 'C')
+        buffer.flush()
+        self.assertEqual(self.appended, [b'a', b'b', b'c'])
+        self.assertEqual(len(self.get_entries(b'a')), 2)
+
+        # Appended to the lists already in the database
+        buffer.append(b'a', 2, '1', 'C')
+        buffer.flush()
+        self.assertEqual([entry[0] for entry in self.get_entries(b'a')], [1, 1, 2])
+
+    def test_full(self):
+        buffer = data.PostingBuffer(self.table, 2 * data.POSTING_BUFFER_OVERHEAD)
+        buffer.append(b'a', 1, '1', 'C')
+        self.assertEqual(self.appended, [])
+        # A new key is counted with the overhead of its list
+        buffer.append(b'b', 1, '1', 'C')
+        self.assertEqual(self.appended, [b'a', b'b'])
+        self.assertEqual(buffer.size, 0)
+
+        # New entries of the same key fill it too
+        buffer.append(b'a', 2, '1', 'C')
+        id = 3
+        while len(self.appended) == 2:
+            buffer.append(b'a', id, '1', 'C')
+            id += 1
+        self.assertEqual(self.appended, [b'a', b'b', b'a'])
+        self.assertEqual([entry[0] for entry in self.get_entries(b'a')], list(range(1, id)))
+
+    def test_lock_and_journal(self):
+        lock = threading.Lock()
+        journal = data.Journal(os.path.join(self.dir.name, 'journal'))
+        buffer = data.PostingBuffer(self.table, 1 << 20, lock, journal)
+
+        append = self.table.append
+        def check_append(key, obj):
+            self.assertTrue(lock.locked())
+            # The key is in the journal before the list is written
+            self.assertIn(key, journal.get_keys()['references.db'])
+            append(key, obj)
+        self.table.append = check_append
+
+        buffer.append(b'b', 1, '1', 'C')
+        buffer.append(b'a', 1, '1', 'C')
+        buffer.flush()
+        journal.close()
+        self.assertFalse(lock.locked())
+        self.assertEqual(journal.get_keys(), {'references.db': {b'a', b'b'}})
+
+if __name__ == '__main__':
+    unittest.main()
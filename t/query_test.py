@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that get_query shares Query instances between requests, and closes
+# those of previous generations of the data once requests release them
+
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from utils import elixir_dir, create_project
+sys.path.insert(0, elixir_dir)
+
+from elixir import data, query
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+class QueryRegistryTest(unittest.TestCase):
+    backend = 'berkeleydb'
+
+    def setUp(self):
+        self.basedir = tempfile.TemporaryDirectory()
+        self.data_dir = create_project(self.basedir.name, backend=self.backend)
+
+    def tearDown(self):
+        query.release_queries()
+        query.queries.clear()
+        self.basedir.cleanup()
+
+    def test_shared_instance(self):
+        q1 = query.get_query(self.basedir.name, 'testproj')
+        q2 = query.get_query(self.basedir.name, 'testproj')
+        self.assertIs(q1, q2)
+        self.assertEqual(q1.users, 2)
+        query.release_queries()
+        self.assertEqual(q1.users, 0)
+        self.assertIsNone(query.get_query(self.basedir.name, 'nonexistent'))
+
+    def test_previous_generation_closed_once_released(self):
+        old = query.get_query(self.basedir.name, 'testproj')
+        with mock.patch.object(old.db, 'close', wraps=old.db.close) as close:
+            data.bump_generation(self.data_dir)
+            new = query.get_query(self.basedir.name, 'testproj')
+            self.assertIsNot(new, old)
+            # Still used by the request that acquired it
+            close.assert_not_called()
+            self.assertEqual(len(old.db.vers), 0)
+
+            query.release_queries()
+            close.assert_called_once()
+            self.assertEqual(new.users, 0)
+            self.assertFalse(new.retired)
+
+    def test_unused_previous_generation_closed(self):
+        old = query.get_query(self.basedir.name, 'testproj')
+        query.release_queries()
+        with mock.patch.object(old.db, 'close', wraps=old.db.close) as close:
+            data.bump_generation(self.data_dir)
+            query.get_query(self.basedir.name, 'testproj')
+            close.assert_called_once()
+
+    def test_new_generation_while_used(self):
+        old = query.get_query(self.basedir.name, 'testproj')
+        self.assertEqual(len(old.db.vers), 0)
+        for _ in range(2):
+            data.bump_generation(self.data_dir)
+            new = query.get_query(self.basedir.name, 'testproj')
+            self.assertIsNot(new, old)
+            self.assertEqual(len(new.db.vers), 0)
+            self.assertEqual(len(old.db.vers), 0)
+        query.release_queries()
+
+    def test_opened_without_lock(self):
+        Query = query.Query
+        def new_query(*args, **kwargs):
+            self.assertFalse(query.queries_lock.locked())
+            return Query(*args, **kwargs)
+        with mock.patch.object(query, 'Query', side_effect=new_query):
+            query.get_query(self.basedir.name, 'testproj')
+
+    def test_opened_by_another_thread(self):
+        Query = query.Query
+        opened = []
+        def new_query(*args, **kwargs):
+            q = Query(*args, **kwargs)
+            opened.append(q)
+            if len(opened) == 1:
+                # Another request opens the same generation in the meantime
+                query.get_query(self.basedir.name, 'testproj')
+            return q
+
+        with mock.patch.object(query, 'Query', side_effect=new_query):
+            q = query.get_query(self.basedir.name, 'testproj')
+        self.assertEqual(len(opened), 2)
+        # The instance opened first is closed, the one installed is shared
+        self.assertIs(q, opened[1])
+        self.assertIs(query.queries[self.data_dir], q)
+        self.assertEqual(q.users, 2)
+        self.assertFalse(q.retired)
+
+@unittest.skipIf(lmdb is None, 'lmdb is not installed')
+class LMDBQueryRegistryTest(QueryRegistryTest):
+    backend = 'lmdb'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that RefList values are the same once packed in the binary format
+# and loaded back, and that the text format of older databases is still read
+
+import sys
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+class RefListTest(unittest.TestCase):
+    def test_empty(self):
+        refs = data.RefList()
+        self.assertEqual(list(refs.iter()), [])
+        self.assertEqual(list(data.RefList(refs.pack()).iter()), [])
+
+    def test_single_entry(self):
+        refs = data.RefList()
+        refs.append(3, '42', 'C')
+        loaded = data.RefList(refs.pack())
+        self.assertEqual(list(loaded.iter()), [(3, '42', 'C')])
+        self.assertEqual(list(loaded.iter(dummy=True))[-1], data.RefList.dummy)
+
+    def test_binary_round_trip(self):
+        entries = [
+            (0, '1', 'A'),
+            (5, '1,2,3,1000', 'C'),
+            (5, '7', 'K'),
+            (300, '20000,10', 'M'),
+        ]
+        refs = data.RefList()
+        for entry in entries:
+            refs.append(*entry)
+        packed = refs.pack()
+        self.assertTrue(data.is_binary(packed))
+        # Lines that are not in order are kept as they are
+        self.assertEqual(list(data.RefList(packed).iter()), entries)
+
+    def test_extend(self):
+        refs = data.RefList()
+        refs.append(1, '1', 'C')
+        refs.append(8, '2', 'C')
+        other = data.RefList()
+        other.append(4, '3', 'D')
+        refs.extend(other)
+        self.assertEqual([entry[0] for entry in data.RefList(refs.pack()).iter()], [1, 4, 8])
+
+    def test_text_format(self):
+        refs = data.RefList(b'12:3,4:C\n5:1:K\n')
+        self.assertEqual(list(refs.iter()), [(5, '1', 'K'), (12, '3,4', 'C')])
+        loaded = data.RefList(refs.pack())
+        self.assertTrue(data.is_binary(refs.pack()))
+        self.assertEqual(list(loaded.iter()), list(refs.iter()))
+
+    def test_empty_text_format(self):
+        self.assertEqual(list(data.RefList(b'').iter()), [])
+
+if __name__ == '__main__':
+    unittest.main()
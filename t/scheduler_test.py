@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks how utils/scheduler.py shares CPUs between projects, and the order
+# in which it updates them
+
+import importlib.util
+import os
+import tempfile
+import unittest
+
+from utils import elixir_dir
+
+# utils/scheduler.py is a script, and the utils module of the tests hides
+# the utils directory
+spec = importlib.util.spec_from_file_location('scheduler',
+                                              os.path.join(elixir_dir, 'utils', 'scheduler.py'))
+scheduler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(scheduler)
+
+class SplitTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(scheduler.split(8, 3), [3, 3, 2])
+        self.assertEqual(scheduler.split(9, 3), [3, 3, 3])
+        self.assertEqual(scheduler.split(7, 1), [7])
+
+    def test_fewer_than_count(self):
+        self.assertEqual(scheduler.split(2, 4), [1, 1, 0, 0])
+        self.assertEqual(scheduler.split(0, 2), [0, 0])
+
+    def test_empty(self):
+        self.assertEqual(scheduler.split(4, 0), [])
+
+class GetJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def add_projects(self, *names):
+        for name in names:
+            os.mkdir(os.path.join(self.root.name, name))
+
+    def get_names(self, priorities={}, last_summary={}):
+        return [job.name for job in scheduler.get_jobs(self.root.name, priorities, last_summary)]
+
+    def test_empty(self):
+        self.assertEqual(self.get_names(), [])
+
+    def test_single_project(self):
+        self.add_projects('linux')
+        # Files of the data path are not projects
+        with open(os.path.join(self.root.name, 'index-summary.json'), 'w') as f:
+            f.write('{}\n')
+        jobs = scheduler.get_jobs(self.root.name, {}, {})
+        self.assertEqual([job.name for job in jobs], ['linux'])
+        self.assertEqual(jobs[0].dir, os.path.join(self.root.name, 'linux'))
+        self.assertEqual((jobs[0].priority, jobs[0].last_duration), (0, None))
+
+    def test_order(self):
+        self.add_projects('linux', 'u-boot', 'musl', 'zephyr', 'new')
+        last_summary = {'projects': {
+            'linux': {'duration': 3000.0},
+            'u-boot': {'duration': 200.0},
+            'musl': {'duration': 10.0},
+            'zephyr': {'duration': 500.0},
+        }}
+        # New projects first, then the shortest ones
+        self.assertEqual(self.get_names(last_summary=last_summary),
+                         ['new', 'musl', 'u-boot', 'zephyr', 'linux'])
+        # Higher priorities before everything else
+        self.assertEqual(self.get_names({'linux': 1, 'zephyr': 1, 'musl': -1}, last_summary),
+                         ['zephyr', 'linux', 'new', 'u-boot', 'musl'])
+
+    def test_summary_without_projects(self):
+        self.add_projects('b', 'a')
+        self.assertEqual(self.get_names(last_summary={'duration': 1.0}), ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
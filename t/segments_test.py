@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that posting lists appended to by BsdDB.append are split in
+# segments once they reach SEGMENT_SIZE, read back whole, and merged back
+
+import os
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+def new_refs(ids):
+    refs = data.RefList()
+    for id in ids:
+        refs.append(id, '1,2,3,4,5,6,7,8,9,10', 'C')
+    return refs
+
+class SegmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.table = data.BsdDB(os.path.join(self.dir.name, 'references.db'), False, data.RefList,
+                                segmented=True)
+
+    def tearDown(self):
+        self.table.close()
+        self.dir.cleanup()
+
+    # Appends entries one at a time until key has count segments, and
+    # returns the ids appended
+    def append_segments(self, key, count, first_id=0):
+        id = first_id
+        while self.table.tails.get(key, -1) + 1 < count:
+            self.table.append(key, new_refs([id]))
+            id += 1
+        return list(range(first_id, id))
+
+    def get_ids(self, key):
+        return [entry[0] for entry in self.table.get(key).iter()]
+
+    def test_single_entry(self):
+        self.table.append(b'ident', new_refs([1]))
+        self.assertEqual(self.get_ids(b'ident'), [1])
+        self.assertEqual(list(self.table.get_segments(b'ident')), [])
+        self.table.merge_segments()
+        self.assertEqual(self.get_ids(b'ident'), [1])
+
+    def test_split(self):
+        ids = self.append_segments(b'ident', 1)
+        # The value was full before the segment was started
+        value = self.table.db.get(b'ident')
+        self.assertGreaterEqual(len(value), data.SEGMENT_SIZE)
+        self.assertLess(len(value), data.SEGMENT_SIZE + 64)
+        self.assertEqual([key for key, _ in self.table.get_segments(b'ident')],
+                         [data.segment_key(b'ident', 0)])
+        self.assertEqual(self.get_ids(b'ident'), ids)
+
+        # Segments are not keys of the table
+        self.table.append(b'other', new_refs([1]))
+        self.assertEqual(sorted(self.table.get_keys()), [b'ident', b'other'])
+        self.assertEqual(list(self.table.iter_keys(b'ident')), [b'ident'])
+        self.assertEqual(len(self.table), 2)
+
+    def test_tail_found_by_new_instance(self):
+        ids = self.append_segments(b'ident', 2)
+        self.table.close()
+        self.table = data.BsdDB(os.path.join(self.dir.name, 'references.db'), False, data.RefList,
+                                segmented=True)
+        self.table.append(b'ident', new_refs([ids[-1] + 1]))
+        self.assertEqual(self.get_ids(b'ident'), ids + [ids[-1] + 1])
+        self.assertEqual(len(list(self.table.get_segments(b'ident'))), 2)
+
+    def test_merge_segments(self):
+        ids = self.append_segments(b'ident', 3)
+        self.table.append(b'other', new_refs([1]))
+        self.table.merge_segments()
+        self.assertEqual(list(self.table.get_segments(b'ident')), [])
+        self.assertEqual(self.get_ids(b'ident'), ids)
+        self.assertEqual(self.get_ids(b'other'), [1])
+        self.assertEqual(self.table.tails, {})
+        self.assertEqual(len(self.table), 2)
+
+    def test_merge_segments_min_segments(self):
+        long_ids = self.append_segments(b'long', 3)
+        short_ids = self.append_segments(b'short', 1)
+        self.table.merge_segments(3)
+        self.assertEqual(list(self.table.get_segments(b'long')), [])
+        self.assertEqual(len(list(self.table.get_segments(b'short'))), 1)
+        self.assertEqual(self.get_ids(b'long'), long_ids)
+        self.assertEqual(self.get_ids(b'short'), short_ids)
+
+        # The tails of lists left split are still known
+        self.assertEqual(self.table.tails, {b'short': 0})
+        self.table.append(b'short', new_refs([short_ids[-1] + 1]))
+        self.assertEqual(self.get_ids(b'short'), short_ids + [short_ids[-1] + 1])
+
+    def test_remove_entries(self):
+        ids = self.append_segments(b'ident', 2)
+        first_id = ids[len(ids) // 2]
+        self.table.remove_entries(b'ident', first_id)
+        self.assertEqual(list(self.table.get_segments(b'ident')), [])
+        self.assertEqual(self.get_ids(b'ident'), ids[:len(ids) // 2])
+
+        # Removing all the entries removes the key
+        self.table.remove_entries(b'ident', 0)
+        self.assertFalse(self.table.exists(b'ident'))
+        self.table.remove_entries(b'missing', 0)
+
+if __name__ == '__main__':
+    unittest.main()
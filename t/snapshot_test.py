@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that the values written to a SnapshotTable are read back from the
+# mapped file, and that snapshots of another generation are not used
+
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+class SnapshotTableTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = data.snapshot_filename(self.dir.name, 'references')
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+        self.dir.cleanup()
+
+    def write(self, values, token='1'):
+        data.SnapshotTable.write(self.filename, values.keys(), values.get, token)
+
+    def open_table(self, contentType=bytes, token='1'):
+        table = data.open_snapshot_table(self.dir.name, 'references', contentType, token)
+        if table is not None:
+            self.tables.append(table)
+        return table
+
+    def test_empty(self):
+        self.write({})
+        table = self.open_table()
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.get_keys(), [])
+        self.assertIsNone(table.get(b'a'))
+        self.assertFalse(table.exists(b'a'))
+        self.assertEqual(list(table.iter_keys(b'')), [])
+
+    def test_single_entry(self):
+        self.write({b'ident': b'value'})
+        table = self.open_table()
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.get(b'ident'), b'value')
+        self.assertTrue(table.exists(b'ident'))
+        self.assertIsNone(table.get(b'iden'))
+
+    def test_write(self):
+        values = {
+            b'list_del': b'',
+            b'list_add': b'x' * 100000,
+            b'LIST_HEAD': b'\0\1\2',
+            b'a': b'1',
+        }
+        # Tokens of any size, the sections are still aligned
+        self.write(values, 'token')
+        table = self.open_table(token='token')
+        self.assertEqual(table.token, 'token')
+        for key, value in values.items():
+            self.assertEqual(table.get(key), value)
+        self.assertEqual(table.get_keys(), sorted(values))
+        self.assertEqual(list(table.iter_keys(b'list_')), [b'list_add', b'list_del'])
+        self.assertEqual(len(table), 4)
+
+    def test_reflist_values(self):
+        refs = data.RefList()
+        refs.append(1, '10,20', 'C')
+        refs.append(7, '1', 'M')
+        self.write({b'ident': refs.pack()})
+        table = self.open_table(data.RefList)
+        self.assertEqual(list(table.get(b'ident').iter()), list(refs.iter()))
+
+    def test_pathlist_values(self):
+        paths = data.PathList()
+        for id, path in ((1, b'Makefile'), (2, b'lib/list.c'), (20, b'include/list.h')):
+            paths.append(id, path)
+        self.write({b'v1': paths.pack()})
+        table = self.open_table(data.PathList)
+
+        # Read from the mapping, not copied
+        loaded = table.get(b'v1')
+        self.assertIsInstance(loaded.data, memoryview)
+        self.assertEqual(list(loaded.iter()), list(paths.iter()))
+        index = data.VersionIndex.build(paths)
+        self.assertEqual(list(index.iter(loaded, [20, 1])), [(1, 'Makefile'), (20, 'include/list.h')])
+
+    def test_stale_token(self):
+        self.write({b'a': b'1'}, token='1')
+        self.assertIsNone(self.open_table(token='2'))
+        self.assertIsNone(self.open_table(token=None))
+        self.assertIsNotNone(self.open_table(token='1'))
+
+        # Replaced by the snapshot of a new generation
+        self.write({b'a': b'2'}, token='2')
+        self.assertIsNone(self.open_table(token='1'))
+        self.assertEqual(self.open_table(token='2').get(b'a'), b'2')
+
+    def test_missing(self):
+        self.assertIsNone(self.open_table())
+
+    def test_close_while_used(self):
+        self.write({b'a': b'value'})
+        table = data.SnapshotTable(self.filename, memoryview)
+        value = table.get(b'a')
+        table.close()
+        self.assertEqual(bytes(value), b'value')
+
+if __name__ == '__main__':
+    unittest.main()
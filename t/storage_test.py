@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks the storage backends: the transaction of Berkeley DB writers, and
+# for LMDB, the keys it can store, the transactions of readers and of the
+# writer, and the BsdDB tables stored in it. A data directory can't be open
+# for writing and for reading by the same process, writes are made by
+# another one.
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data, storage
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+MAP_SIZE = 64 * 1024 * 1024
+
+# Puts items, (key, value) pairs of bytes, in the table of dir
+def write_in_process(dir, table, items):
+    code = ('import sys; sys.path.insert(0, {!r}); from elixir import storage; '
+            'env = storage.LMDBEnv({!r}, False, {}, 16); '
+            'env.open_table({!r}, False, False).put_many({!r}); '
+            'env.sync(); env.close()').format(elixir_dir, dir, MAP_SIZE, table, items)
+    subprocess.run((sys.executable, '-c', code), check=True)
+
+# Returns the value of key in the table of dir, read by another process
+def read_in_process(dir, table, key):
+    code = ('import sys; sys.path.insert(0, {!r}); from elixir import storage; '
+            'env = storage.LMDBEnv({!r}, True, {}, 16); '
+            'print(env.open_table({!r}, True, False).get({!r})); env.close()').format(
+                elixir_dir, dir, MAP_SIZE, table, key)
+    return subprocess.run((sys.executable, '-c', code), stdout=subprocess.PIPE,
+                          check=True).stdout.decode().strip()
+
+class BerkeleyDBTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'test.db')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_killed_writer(self):
+        # Killed after a sync and more writes
+        code = ('import os, sys; sys.path.insert(0, {!r}); from elixir import data; '
+                'env = data.open_env({!r}, False, False, "berkeleydb"); '
+                'table = data.BsdDB({!r}, False, lambda x: x, env=env); '
+                'table.put(b"a", b"1"); table.put(b"b", b"1"); table.sync(); '
+                'table.put(b"a", b"2"); table.delete(b"b"); table.put(b"c", b"2"); '
+                'os._exit(9)').format(elixir_dir, self.dir.name, self.filename)
+        self.assertEqual(subprocess.run((sys.executable, '-c', code)).returncode, 9)
+
+        # Recovered when opened for writing
+        env = data.open_env(self.dir.name, False, False, 'berkeleydb')
+        try:
+            self.assertTrue(env.transactional)
+            table = data.BsdDB(self.filename, False, lambda x: x, env=env)
+            self.assertEqual(table.get(b'a'), b'1')
+            self.assertEqual(table.get(b'b'), b'1')
+            self.assertIsNone(table.get(b'c'))
+
+            table.put(b'c', b'3')
+            table.sync()
+            table.close()
+        finally:
+            env.close()
+
+        env = data.open_env(self.dir.name, True, False, 'berkeleydb')
+        try:
+            self.assertFalse(env.transactional)
+            table = data.BsdDB(self.filename, True, lambda x: x, env=env)
+            self.assertEqual(table.get_keys(), [b'a', b'b', b'c'])
+            table.close()
+        finally:
+            env.close()
+
+@unittest.skipIf(lmdb is None, 'lmdb is not installed')
+class LMDBReadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        write_in_process(self.dir.name, 'test.db', [(b'a', b'1')])
+        self.env = storage.LMDBEnv(self.dir.name, True, MAP_SIZE, 16)
+        self.table = self.env.open_table('test.db', True, True)
+
+    def tearDown(self):
+        self.env.close()
+        self.dir.cleanup()
+
+    def test_end_read(self):
+        self.assertEqual(self.table.get(b'a'), b'1')
+        write_in_process(self.dir.name, 'test.db', [(b'a', b'2')])
+        # Same transaction
+        self.assertEqual(self.table.get(b'a'), b'1')
+        self.env.end_read()
+        self.assertEqual(self.table.get(b'a'), b'2')
+
+    def test_shared_environment(self):
+        self.assertEqual(self.table.get(b'a'), b'1')
+        write_in_process(self.dir.name, 'new.db', [(b'b', b'2')])
+        env = storage.LMDBEnv(self.dir.name, True, MAP_SIZE, 16)
+        try:
+            self.assertIs(env.env, self.env.env)
+            self.assertTrue(env.has_table('new.db'))
+            self.assertFalse(self.env.has_table('new.db'))
+            self.assertEqual(env.open_table('new.db', True, True).get(b'b'), b'2')
+        finally:
+            env.close()
+        # Still open
+        self.assertEqual(self.table.get(b'a'), b'1')
+        with self.assertRaises(ValueError):
+            storage.LMDBEnv(self.dir.name, False, MAP_SIZE, 16)
+
+@unittest.skipIf(lmdb is None, 'lmdb is not installed')
+class LMDBWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = storage.LMDBEnv(self.dir.name, False, MAP_SIZE, 16)
+
+    def tearDown(self):
+        self.env.close()
+        self.dir.cleanup()
+
+    def test_long_keys(self):
+        max_size = self.env.max_key_size
+        table = data.BsdDB('test.db', False, lambda x: x, env=self.env)
+        segmented = data.BsdDB('segmented.db', False, data.RefList, segmented=True, env=self.env)
+        self.assertTrue(table.valid_key(b'a' * max_size))
+        self.assertFalse(table.valid_key(b'a' * (max_size + 1)))
+        self.assertFalse(table.valid_key(b''))
+        # Room is left for segment numbers
+        self.assertTrue(segmented.valid_key(b'a' * (max_size - 5)))
+        self.assertFalse(segmented.valid_key(b'a' * (max_size - 4)))
+
+        with self.assertRaises(ValueError):
+            table.put_many([(b'b', b'1'), (b'a' * (max_size + 1), b'2')])
+        self.assertIsNone(table.get(b'a' * (max_size + 1)))
+        self.assertFalse(table.exists(b''))
+
+    def test_write_transaction(self):
+        table = self.env.open_table('test.db', False, False)
+        table.sync()
+        table.put_many([(b'a', b'1'), (b'b', b'2')])
+        table.delete(b'b')
+        # Read by the writer before being committed
+        self.assertEqual(table.get(b'a'), b'1')
+        self.assertEqual(list(table.iter_range(b'')), [(b'a', b'1')])
+        self.assertEqual(read_in_process(self.dir.name, 'test.db', b'a'), 'None')
+
+        table.sync()
+        self.assertEqual(read_in_process(self.dir.name, 'test.db', b'a'), "b'1'")
+        self.assertEqual(table.stat(), {'nkeys': 1})
+
+        # Large transactions are committed before syncing
+        value = b'x' * 1024 * 1024
+        for i in range(storage.LMDB_MAX_WRITE_SIZE // len(value) + 1):
+            table.put(b'c', value)
+        self.assertEqual(read_in_process(self.dir.name, 'test.db', b'c')[:6], "b'xxxx")
+
+@unittest.skipIf(lmdb is None, 'lmdb is not installed')
+class LMDBTableTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = storage.LMDBEnv(self.dir.name, False, MAP_SIZE, 16)
+        self.table = data.BsdDB('references.db', False, data.RefList, segmented=True, env=self.env)
+
+    def tearDown(self):
+        self.env.close()
+        self.dir.cleanup()
+
+    def get_ids(self, key):
+        return [entry[0] for entry in self.table.get(key).iter()]
+
+    def append(self, key, ids):
+        refs = data.RefList()
+        for id in ids:
+            refs.append(id, '1,2,3,4,5,6,7,8,9,10', 'C')
+        self.table.append(key, refs)
+
+    def test_empty(self):
+        self.assertEqual(self.table.get_keys(), [])
+        self.assertEqual(list(self.table.iter_keys(b'')), [])
+        self.assertEqual(len(self.table), 0)
+        self.table.merge_segments()
+
+    def test_segments(self):
+        ids = []
+        while self.table.tails.get(b'ident', -1) < 1:
+            self.append(b'ident', [len(ids)])
+            ids.append(len(ids))
+        self.append(b'iden', [0])
+        self.append(b'other', [0])
+
+        self.assertEqual(self.get_ids(b'ident'), ids)
+        self.assertEqual(len(list(self.table.get_segments(b'ident'))), 2)
+        self.assertEqual(self.table.get_keys(), [b'iden', b'ident', b'other'])
+        self.assertEqual(list(self.table.iter_keys(b'ide')), [b'iden', b'ident'])
+        self.assertEqual(len(self.table), 3)
+
+        self.table.merge_segments()
+        self.assertEqual(list(self.table.get_segments(b'ident')), [])
+        self.assertEqual(self.get_ids(b'ident'), ids)
+
+        self.table.remove_entries(b'ident', 1)
+        self.assertEqual(self.get_ids(b'ident'), [0])
+
+        # Read by another process once synced
+        self.env.sync()
+        self.assertEqual(read_in_process(self.dir.name, 'references.db', b'iden')[:2], "b'")
+
+if __name__ == '__main__':
+    unittest.main()
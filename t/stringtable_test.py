@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that the strings written to a StringTable file are found by hash
+# and in sorted order once the file is mapped
+
+import mmap
+import os
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+class StringTableTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'definitions-C.strings')
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+        self.dir.cleanup()
+
+    def open_table(self, keys):
+        data.StringTable.write(self.filename, keys)
+        table = data.StringTable(self.filename)
+        self.tables.append(table)
+        return table
+
+    def test_empty(self):
+        table = self.open_table([])
+        self.assertEqual(len(table), 0)
+        self.assertEqual(list(table), [])
+        self.assertEqual(table.index(b'a'), -1)
+        self.assertNotIn(b'', table)
+        self.assertEqual(table.bisect(b'a'), 0)
+        self.assertEqual(list(table.iter_prefix('')), [])
+
+    def test_single_entry(self):
+        table = self.open_table(['ident'])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(list(table), [b'ident'])
+        self.assertEqual(table.index('ident'), 0)
+        self.assertIn(b'ident', table)
+        self.assertNotIn(b'iden', table)
+        self.assertNotIn(b'identifier', table)
+        self.assertEqual(list(table.iter_prefix('id')), [b'ident'])
+        self.assertEqual(list(table.iter_prefix('ie')), [])
+
+    def test_write(self):
+        # Keys are sorted and duplicates removed
+        keys = [b'list_add', b'LIST_HEAD', b'list_del', b'', b'list_add', b'x' * 1000, b'a\0b']
+        table = self.open_table(keys)
+        expected = sorted(set(keys))
+        self.assertEqual(len(table), len(expected))
+        self.assertEqual(list(table), expected)
+        for i, key in enumerate(expected):
+            self.assertEqual(table.index(key), i)
+            self.assertIn(key, table)
+        for key in (b'list', b'list_ad', b'LIST_head', b'x' * 999, b'a'):
+            self.assertNotIn(key, table)
+
+        self.assertEqual(table.bisect(b'list'), expected.index(b'list_add'))
+        self.assertEqual(table.bisect(b'zzz'), len(expected))
+        self.assertEqual(list(table.iter_prefix(b'list_')), [b'list_add', b'list_del'])
+        self.assertEqual(list(table.iter_prefix(b'')), expected)
+
+    def test_many_collisions(self):
+        keys = [str(i).encode() for i in range(5000)]
+        table = self.open_table(keys)
+        for key in keys:
+            self.assertIn(key, table)
+        self.assertNotIn(b'5000', table)
+
+    def test_in_mapped_file(self):
+        # Tables that are part of a larger file, like in snapshots
+        with open(self.filename, 'wb') as f:
+            f.write(b'\1' * 8 + data.StringTable.pack([b'a', b'b']))
+        with open(self.filename, 'rb') as f:
+            map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table = data.StringTable(self.filename, map, 8)
+        self.assertEqual(list(table), [b'a', b'b'])
+        self.assertIn(b'b', table)
+        table.close()
+        # The mapping is not closed with the table
+        self.assertEqual(map[0], 1)
+        map.close()
+
+    def test_unknown_format(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'\0\xff' + data.StringTable.pack([])[2:])
+        with self.assertRaises(ValueError):
+            data.StringTable(self.filename)
+
+if __name__ == '__main__':
+    unittest.main()
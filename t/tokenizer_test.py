@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that elixir.tokenizer gives the same tokens as `script.sh tokenize-file`
+# on the files in tree/
+
+import os
+import sys
+import unittest
+
+from utils import elixir_dir, TreeRepo
+sys.path.insert(0, elixir_dir)
+
+from elixir import lib
+from elixir.tokenizer import tokenize
+
+class TokenizerTest(unittest.TestCase):
+    def setUp(self):
+        self.repo = TreeRepo()
+        self.repo_dir = self.repo.repo_dir
+        self.files = self.repo.files
+        self.hashes = self.repo.hashes
+
+    def tearDown(self):
+        self.repo.cleanup()
+
+    def script_tokens(self, hash, family):
+        env = {**os.environ, 'LXR_REPO_DIR': self.repo_dir}
+        return lib.scriptLines('tokenize-file', '-b', hash, family, env=env)
+
+    def test_same_tokens_as_script(self):
+        for path, hash in zip(self.files, self.hashes):
+            family = lib.getFileFamily(path) or 'C'
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            # Also check the devicetree variant on all files
+            for fam in sorted({family, 'D'}):
+                with self.subTest(path=path, family=fam):
+                    self.assertEqual(tokenize(content, fam), self.script_tokens(hash, fam))
+
+    def test_edge_cases(self):
+        for content in (b'', b'\n', b'ident', b'ident\n', b'a b', b'"string" x', b'/* c */\n// d\nint x;'):
+            with self.subTest(content=content):
+                hash = self.repo.add_blob(content)
+                self.assertEqual(tokenize(content, 'C'), self.script_tokens(hash, 'C'))
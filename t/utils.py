@@ -0,0 +1,68 @@
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers shared by the Python tests
+
+import os
+import subprocess
+import tempfile
+
+elixir_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+tree_dir = os.path.join(elixir_dir, 't', 'tree')
+
+class TreeRepo:
+    '''Bare Git repository of a temporary project, with the files in tree/
+        stored as blobs. files and hashes are the paths of the files and
+        the hashes of their blobs, in the same order.'''
+    def __init__(self):
+        self.proj_dir = tempfile.TemporaryDirectory()
+        self.repo_dir = os.path.join(self.proj_dir.name, 'testproj', 'repo')
+        subprocess.run(('git', 'init', '-q', '--bare', self.repo_dir), check=True)
+
+        self.files = []
+        for root, _, filenames in os.walk(tree_dir):
+            for filename in filenames:
+                self.files.append(os.path.join(root, filename))
+
+        hashes = subprocess.run(('git', '-C', self.repo_dir, 'hash-object', '-w', '--stdin-paths'),
+                                input='\n'.join(self.files).encode(), stdout=subprocess.PIPE, check=True)
+        self.hashes = hashes.stdout.decode().split()
+
+    # Returns the hash of a new blob with the given content
+    def add_blob(self, content):
+        hash = subprocess.run(('git', '-C', self.repo_dir, 'hash-object', '-w', '--stdin'),
+                              input=content, stdout=subprocess.PIPE, check=True)
+        return hash.stdout.decode().strip()
+
+    def cleanup(self):
+        self.proj_dir.cleanup()
+
+# Creates a project in basedir, with an empty bare repository and empty
+# databases, stored by the given backend, and returns its data directory
+def create_project(basedir, name='testproj', backend=None):
+    from elixir import data
+
+    repo_dir = os.path.join(basedir, name, 'repo')
+    data_dir = os.path.join(basedir, name, 'data')
+    subprocess.run(('git', 'init', '-q', '--bare', repo_dir), check=True)
+    os.makedirs(data_dir)
+    db = data.DB(data_dir, readonly=False, backend=backend)
+    db.close()
+    data.bump_generation(data_dir)
+    return data_dir
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that the VersionIndex of a PathList finds the paths of blob IDs,
+# before and after being packed and loaded back
+
+import sys
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+def new_paths(entries):
+    paths = data.PathList()
+    for id, path in entries:
+        paths.append(id, path.encode())
+    return paths
+
+class VersionIndexTest(unittest.TestCase):
+    def check_index(self, paths, index):
+        entries = list(paths.iter())
+        ids = set(id for id, _ in entries)
+        for id in range(max(ids, default=0) + 10):
+            self.assertEqual(bool(index.contains(id)), id in ids)
+        self.assertEqual(list(index.iter(paths, ids)), entries)
+
+    def test_empty(self):
+        paths = data.PathList()
+        index = data.VersionIndex.build(paths)
+        self.assertFalse(index.contains(0))
+        self.assertEqual(list(index.iter(paths, [0, 1])), [])
+
+        loaded = data.VersionIndex(index.pack())
+        self.assertFalse(loaded.contains(0))
+        self.assertEqual(list(loaded.iter(paths, [0])), [])
+
+    def test_single_entry(self):
+        paths = new_paths([(0, 'README')])
+        index = data.VersionIndex.build(paths)
+        self.check_index(paths, index)
+        self.check_index(paths, data.VersionIndex(index.pack()))
+
+    def test_build(self):
+        # Same blob at several paths, and IDs beyond a byte of the bitmap
+        paths = new_paths([
+            (1, 'a/b.c'),
+            (7, 'a/c.h'),
+            (8, 'Makefile'),
+            (8, 'copy/Makefile'),
+            (300, 'z/y.c'),
+        ])
+        index = data.VersionIndex.build(paths)
+        self.check_index(paths, index)
+        loaded = data.VersionIndex(index.pack())
+        self.check_index(paths, loaded)
+        self.assertEqual(loaded.pack(), index.pack())
+
+        # Entries are in PathList order whatever the order of the IDs given
+        self.assertEqual(list(loaded.iter(paths, [300, 8, 2, 8])),
+                         [(8, 'Makefile'), (8, 'copy/Makefile'), (300, 'z/y.c')])
+        self.assertEqual(list(loaded.iter(paths, [])), [])
+
+    def test_unknown_format(self):
+        packed = bytearray(data.VersionIndex().pack())
+        packed[1] = data.VERSIONINDEX_VERSION + 1
+        with self.assertRaises(ValueError):
+            data.VersionIndex(bytes(packed))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that versions stored as chains of VersionDeltas are rebuilt as the
+# PathLists that were stored, and that chains stop at the snapshot interval
+
+import os
+import sys
+import tempfile
+import unittest
+
+from utils import elixir_dir
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+def new_paths(entries):
+    paths = data.PathList()
+    for id, path in sorted(entries):
+        paths.append(id, path.encode())
+    return paths
+
+# Returns the PathList of the nth version of a project, in which a file is
+# changed and another one added at each version
+def version_paths(n):
+    entries = [(0, 'Makefile')]
+    entries += [(i + 1, 'file%d.c' % i) for i in range(n + 1) if i != n - 1]
+    if n:
+        entries.append((1000 + n, 'file%d.c' % (n - 1)))
+    return new_paths(entries)
+
+class VersionDeltaTest(unittest.TestCase):
+    def test_empty(self):
+        delta = data.VersionDelta.build(b'v1', data.PathList(), data.PathList(), 1)
+        loaded = data.VersionDelta(delta.pack())
+        self.assertEqual(loaded.apply(data.PathList()).data, b'')
+
+    def test_build(self):
+        base = new_paths([(1, 'a.c'), (2, 'b.c'), (9, 'z.c')])
+        paths = new_paths([(1, 'a.c'), (3, 'b.c'), (9, 'z.c'), (10, 'new.c')])
+        delta = data.VersionDelta.build(b'v1', base, paths, 3)
+        self.assertEqual(delta.removed, b'2 b.c\n')
+        self.assertEqual(delta.added, b'3 b.c\n10 new.c\n')
+
+        loaded = data.VersionDelta(delta.pack())
+        self.assertEqual((loaded.base, loaded.depth), (b'v1', 3))
+        # Entries are merged in PathList order, 10 after 9
+        self.assertEqual(loaded.apply(base).data, paths.data)
+
+        # Everything removed
+        delta = data.VersionDelta.build(b'v1', base, data.PathList(), 1)
+        self.assertEqual(data.VersionDelta(delta.pack()).apply(base).data, b'')
+
+class VersionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'versions.db')
+        self.store = data.VersionStore(self.filename, False)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def reopen(self, max_size=0):
+        self.store.close()
+        self.store = data.VersionStore(self.filename, True, max_size=max_size)
+
+    def test_missing(self):
+        self.assertIsNone(self.store.get(b'v1'))
+        self.assertEqual(len(self.store), 0)
+
+    def test_single_version(self):
+        self.store.put(b'v1', version_paths(0))
+        self.assertIsInstance(data.load_version(self.store.db.get(b'v1')), data.PathList)
+        self.reopen()
+        self.assertEqual(self.store.get(b'v1').data, version_paths(0).data)
+        self.assertEqual(self.store.get_keys(), [b'v1'])
+
+    def test_delta_chain(self):
+        count = data.VERSIONS_SNAPSHOT_INTERVAL + 3
+        self.store.put(b'v0', version_paths(0))
+        for n in range(1, count):
+            self.store.put(b'v%d' % n, version_paths(n), b'v%d' % (n - 1))
+
+        # v1 to v16 are deltas, v17 is a full PathList again
+        for n in range(count):
+            depth = n % (data.VERSIONS_SNAPSHOT_INTERVAL + 1)
+            self.assertEqual(self.store.get_depth(b'v%d' % n), depth)
+            obj = data.load_version(self.store.db.get(b'v%d' % n))
+            self.assertIsInstance(obj, data.VersionDelta if depth else data.PathList)
+
+        # Depths read from the values by another instance
+        self.reopen()
+        for n in range(count):
+            depth = n % (data.VERSIONS_SNAPSHOT_INTERVAL + 1)
+            self.assertEqual(self.store.get_depth(b'v%d' % n), depth)
+        self.assertEqual(self.store.get_depth(b'missing'), 0)
+
+        for max_size in (0, 1 << 20):
+            self.reopen(max_size)
+            # Latest version first, which rebuilds the whole chain
+            for n in reversed(range(count)):
+                self.assertEqual(self.store.get(b'v%d' % n).data, version_paths(n).data)
+
+        # Versions rebuilt are in the cache
+        self.assertEqual(len(self.store.cache), count)
+        self.assertEqual(self.store.cache_size,
+                         sum(len(version_paths(n).data) for n in range(count)))
+
+    def test_cache_size(self):
+        for n in range(3):
+            self.store.put(b'v%d' % n, version_paths(n))
+        size = len(version_paths(2).data)
+        self.reopen(size)
+        self.store.get(b'v0')
+        self.store.get(b'v2')
+        # v0 was evicted to make room for v2
+        self.assertEqual(list(self.store.cache), [b'v2'])
+        self.assertEqual(self.store.cache_size, size)
+
+    def test_missing_base(self):
+        self.store.put(b'v0', version_paths(0))
+        self.store.put(b'v1', version_paths(1), b'v0')
+        self.store.db.delete(b'v0')
+        self.reopen()
+        with self.assertRaises(ValueError):
+            self.store.get(b'v1')
+
+if __name__ == '__main__':
+    unittest.main()
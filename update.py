@@ -22,617 +22,929 @@
 # Throughout, an "idx" is the sequential number associated with a blob.
 # This is different from that blob's Git hash.
 
-from sys import argv
-from threading import Thread, Lock, Event, Condition
+# Tags are indexed one after the other. The blobs of a tag are parsed by a
+# pool of workers, processes by default, which only read the repository.
+# In the first pass, workers get batches of blobs, so that ctags only runs
+# once per family for a whole batch.
+# This process is the only one that writes to the databases: it merges the
+# results returned by the workers, in idx order.
+# Blobs go through two passes: definitions, doc comments and DT compatible
+# strings first, then references and DT bindings documentation, which are
+# filtered with what the first pass added to the databases.
+
+import os
+import argparse
+import multiprocessing
+import multiprocessing.pool
+import pickle
+import array
+import bisect
+import collections
+import resource
+import time
+import datetime
+import json
+from functools import lru_cache
 
 import elixir.lib as lib
 from elixir.lib import script, scriptLines
 import elixir.data as data
 from elixir.data import PathList
+from elixir.tokenizer import tokenize
 from find_compatible_dts import FindCompatibleDTS
+from find_definitions import FindDefinitions
 
 verbose = False
 
-dts_comp_support = int(script('dts-comp'))
-
-compatibles_parser = FindCompatibleDTS()
-
-db = data.DB(lib.getDataDir(), readonly=False, shared=True, dtscomp=dts_comp_support)
-
-# Number of cpu threads (+2 for version indexing)
-cpu = 10
-threads_list = []
-
-hash_file_lock = Lock() # Lock for db.hash and db.file
-blobs_lock = Lock() # Lock for db.blobs
-defs_lock = Lock() # Lock for db.defs
-refs_lock = Lock() # Lock for db.refs
-docs_lock = Lock() # Lock for db.docs
-comps_lock = Lock() # Lock for db.comps
-comps_docs_lock = Lock() # Lock for db.comps_docs
-tag_ready = Condition() # Waiting for new tags
-
-new_idxes = [] # (new idxes, Event idxes ready, Event defs ready, Event comps ready, Event vers ready)
-bindings_idxes = [] # DT bindings documentation files
-idx_key_mod = 1000000
-defs_idxes = {} # Idents definitions stored with (idx*idx_key_mod + line) as the key.
-
-tags_done = False # True if all tags have been added to new_idxes
+# Options are parsed first: with --swap, the databases are opened in a copy
+# of the data directory
+parser = argparse.ArgumentParser(description='Index the new tags of the project in $LXR_REPO_DIR.')
+parser.add_argument('threads', type=int, nargs='?', default=os.cpu_count(),
+                    help='number of parsing workers (default: %(default)s)')
+parser.add_argument('--pool', choices=['processes', 'threads'], default='processes',
+                    help='run parsing workers as processes, or as threads of this process (default: %(default)s)')
+parser.add_argument('--latest-first', action='store_true',
+                    help='index the latest release and the tags it descends from first, '
+                         'and make them visible before indexing the other tags')
+parser.add_argument('--watch', type=float, nargs='?', const=5, metavar='SECONDS',
+                    help='keep running, and index new tags as they are fetched, checking every '
+                         'SECONDS seconds (default: %(const)s)')
+parser.add_argument('--swap', action='store_true',
+                    help='write to a copy of the data directory, and make it the data directory '
+                         'once done, so that web processes never read databases being written')
+parser.add_argument('--snapshot', action='store_true',
+                    help='export the posting lists and versions to immutable files, read by web '
+                         'processes instead of the databases until the next update')
+parser.add_argument('--rebuild-defs-caches', action='store_true',
+                    help='rebuild the definitions caches from all definitions and exit')
+args = parser.parse_args()
+
+if args.swap and args.watch:
+    parser.error('--swap cannot be used with --watch')
+
+# Returns True if the repository has tags that are not versions of the data in dir
+def has_new_tags(dir):
+    if data.find_backend(dir) is None:
+        return True
+
+    env = data.open_env(dir, True, False)
+    try:
+        filename = os.path.join(dir, 'versions.db')
+        if not env.has_table(filename):
+            return True
+        vers = data.VersionStore(filename, True, env=env)
+        try:
+            return any(not vers.exists(tag) for tag in scriptLines('list-tags'))
+        finally:
+            vers.close()
+    finally:
+        env.close()
+
+data_dir = lib.getDataDir()
 
-# Progress variables [tags, finished threads]
-tags_defs = [0, 0]
-tags_defs_lock = Lock()
-tags_refs = [0, 0]
-tags_refs_lock = Lock()
-tags_docs = [0, 0]
-tags_docs_lock = Lock()
-tags_comps = [0, 0]
-tags_comps_lock = Lock()
-tags_comps_docs = [0, 0]
-tags_comps_docs_lock = Lock()
-
-class UpdateIds(Thread):
-    def __init__(self, tag_buf):
-        Thread.__init__(self, name="UpdateIdsElixir")
-        self.tag_buf = tag_buf
-
-    def run(self):
-        global new_idxes, tags_done, tag_ready
-        self.index = 0
-
-        for tag in self.tag_buf:
-
-            new_idxes.append((self.update_blob_ids(tag), Event(), Event(), Event(), Event()))
-
-            progress('ids: ' +  tag.decode() + ': ' + str(len(new_idxes[self.index][0])) +
-                        ' new blobs', self.index+1)
-
-            new_idxes[self.index][1].set() # Tell that the tag is ready
+dts_comp_support = int(script('dts-comp'))
 
-            self.index += 1
+if args.swap:
+    # Don't copy the data if there is nothing to do, unless an interrupted
+    # update left its copy
+    if (not os.path.isdir(data.get_next_generation_dir(data_dir)) and
+            not args.rebuild_defs_caches and not has_new_tags(data_dir) and
+            not (args.snapshot and not data.snapshot_is_current(data_dir, dts_comp_support))):
+        print(lib.currentProject() + ' - found 0 new tags')
+        exit(0)
 
-            # Wake up waiting threads
-            with tag_ready:
-                tag_ready.notify_all()
+    # This process, and the scripts it runs, use the copy
+    os.environ['LXR_DATA_DIR'] = data.prepare_next_generation(data_dir)
 
-        tags_done = True
-        progress('ids: Thread finished', self.index)
+compatibles_parser = FindCompatibleDTS()
 
-    def update_blob_ids(self, tag):
+definitions_parser = FindDefinitions()
 
-        global hash_file_lock, blobs_lock
+db = data.DB(lib.getDataDir(), readonly=False, shared=True, dtscomp=dts_comp_support)
 
-        if db.vars.exists('numBlobs'):
-            idx = db.vars.get('numBlobs')
+journal = data.Journal(os.path.join(lib.getDataDir(), 'update-journal'))
+
+git_readers = lib.getGitReaderPool(lib.getRepoDir())
+
+# Memory used to buffer database writes, in bytes
+buffer_budget = int(os.environ.get('ELIXIR_BUFFER_SIZE', 512)) * 1024 * 1024
+
+# At most 3 write buffers are used at the same time, by the first pass
+buffer_size = buffer_budget // 3
+
+# In watch mode, posting lists are only merged back when tags are published
+# once they have this many segments. They are all merged when exiting.
+watch_min_segments = 16
+
+
+class DefinitionLines:
+    '''Idents defined on each line of the new blobs of a tag, so that
+        definitions are not counted as references.
+        For each blob, lines are kept in a sorted array, with an array of
+        the ids of the idents defined on them. Idents are numbered once per
+        tag. The arrays of a blob are removed once its references are done.'''
+    def __init__(self):
+        self.ident_ids = {}
+        self.blobs = {}
+
+    # defs: [(ident, line)], the last ident of a line is the one that is kept
+    def add(self, idx, defs):
+        by_line = {}
+        for ident, line in defs:
+            by_line[line] = self.ident_ids.setdefault(ident, len(self.ident_ids))
+        if by_line:
+            lines = sorted(by_line)
+            self.blobs[idx] = (array.array('I', lines), array.array('I', (by_line[l] for l in lines)))
+
+    # Returns the lines of blob idx that are not the line of a definition of ident
+    def filter_references(self, idx, ident, lines):
+        ident_id = self.ident_ids.get(ident)
+        if ident_id is None or idx not in self.blobs:
+            return lines
+
+        def_lines, def_ids = self.blobs[idx]
+        result = []
+        for line in lines:
+            pos = bisect.bisect_left(def_lines, line)
+            if pos == len(def_lines) or def_lines[pos] != line or def_ids[pos] != ident_id:
+                result.append(line)
+        return result
+
+    def remove(self, idx):
+        self.blobs.pop(idx, None)
+
+
+# Workers
+
+def init_worker():
+    global git_readers
+    # Don't share the git processes of the parent
+    git_readers = lib.GitObjectReaderPool(lib.getRepoDir())
+
+def read_blob(hash):
+    with git_readers.reader() as reader:
+        _, content = reader.read(hash)
+    return content
+
+# Returns {ident: lines} for the DT compatible strings of a blob
+def parse_compatibles(content, family):
+    comps = {}
+    lines = content.split(b'\n')
+    del lines[-1]
+    for l in compatibles_parser.run(lines, family):
+        ident, line = l.split(' ')
+
+        if ident in comps:
+            comps[ident] += ',' + str(line)
         else:
-            idx = 0
-
-        # Get blob hashes and associated file names (without path)
-        blobs = scriptLines('list-blobs', '-f', tag)
-
-        new_idxes = []
-        for blob in blobs:
-            hash, filename = blob.split(b' ',maxsplit=1)
-            with blobs_lock:
-                blob_exist = db.blob.exists(hash)
-                if not blob_exist:
-                    db.blob.put(hash, idx)
-
-            if not blob_exist:
-                with hash_file_lock:
-                    db.hash.put(idx, hash)
-                    db.file.put(idx, filename)
-
-                new_idxes.append(idx)
-                if verbose:
-                    print(f"New blob #{idx} {hash}:{filename}")
-                idx += 1
-        db.vars.put('numBlobs', idx)
-        return new_idxes
-
-
-class UpdateVersions(Thread):
-    def __init__(self, tag_buf):
-        Thread.__init__(self, name="UpdateVersionsElixir")
-        self.tag_buf = tag_buf
-
-    def run(self):
-        global new_idxes, tag_ready
-
-        index = 0
-
-        while index < len(self.tag_buf):
-            if index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            tag = self.tag_buf[index]
-
-            new_idxes[index][1].wait() # Make sure the tag is ready
-
-            self.update_versions(tag)
-
-            new_idxes[index][4].set() # Tell that UpdateVersions processed the tag
-
-            progress('vers: ' + tag.decode() + ' done', index+1)
-
-            index += 1
-
-        progress('vers: Thread finished', index)
-
-    def update_versions(self, tag):
-        global blobs_lock
-
-        # Get blob hashes and associated file paths
-        blobs = scriptLines('list-blobs', '-p', tag)
-        buf = []
-
-        for blob in blobs:
+            comps[ident] = str(line)
+    return comps
+
+# First pass, returns [(idx, family, defs, docs, comps)] for a batch of (idx, hash, filename) blobs
+# defs: [(ident, type, line)], docs: [(ident, line)], comps: {ident: lines}
+# None for the kinds of data that are not looked for in a blob
+def parse_blobs(batch):
+    blobs = []
+    for idx, hash, filename in batch:
+        blobs.append((idx, filename, read_blob(hash), lib.getFileFamily(filename)))
+
+    # ctags is only run once per family for the whole batch, definitions
+    # and doc comments are found from the same results
+    batch_defs = definitions_parser.run([blob for blob in blobs if blob[3] not in [None, 'M']])
+
+    result = []
+    for idx, filename, content, family in blobs:
+        defs, docs, comps = None, None, None
+
+        if family not in [None, 'M']:
+            defs, docs = batch_defs[idx]
+
+        if dts_comp_support and family not in [None, 'K', 'M']:
+            comps = parse_compatibles(content, family)
+
+        result.append((idx, family, defs, docs, comps))
+    return result
+
+# Second pass, returns (idx, family, refs, comps_docs) for a (idx, hash, filename, binding) blob
+# refs: {ident: [line]}, for all the identifiers of the blob
+# comps_docs: {ident: lines}, only for DT bindings documentation files
+def parse_blob_references(blob):
+    idx, hash, filename, binding = blob
+    family = lib.getFileFamily(filename)
+    refs, comps_docs = None, None
+
+    if family is not None:
+        prefix = b''
+        # Kconfig values are saved as CONFIG_<value>
+        if family == 'K':
+            prefix = b'CONFIG_'
+
+        tokens = tokenize(read_blob(hash), family)
+        even = True
+        line_num = 1
+        refs = {}
+        for tok in tokens:
+            even = not even
+            if even:
+                tok = prefix + tok
+
+                # We only index CONFIG_??? in makefiles
+                if family != 'M' or tok.startswith(b'CONFIG_'):
+                    if tok in refs:
+                        refs[tok].append(line_num)
+                    else:
+                        refs[tok] = [line_num]
+            else:
+                line_num += tok.count(b'\1')
+
+    if binding:
+        comps_docs = parse_compatibles(read_blob(hash), 'B')
+
+    return idx, family, refs, comps_docs
+
+# Returns how many blobs are sent to a worker at once
+def get_chunk_size(num_blobs):
+    return max(1, min(64, num_blobs // (num_workers * 4)))
+
+# Returns the blobs split in batches of the chunk size
+def get_batches(blobs):
+    size = get_chunk_size(len(blobs))
+    return [blobs[i:i+size] for i in range(0, len(blobs), size)]
+
+
+# Writer
+
+# Returns the nearest ancestor of tag that is already indexed, or else the
+# version indexed before it by this run, or None
+def get_base_version(tag):
+    parents = collections.deque(parent_tags.get(tag, ()))
+    visited = set(parents)
+    # Give up on histories where many ancestors are not indexed
+    for _ in range(16):
+        if not parents:
+            break
+        parent = parents.popleft()
+        if db.vers.exists(parent):
+            return parent
+        for grandparent in parent_tags.get(parent, ()):
+            if grandparent not in visited:
+                visited.add(grandparent)
+                parents.append(grandparent)
+
+    # With --latest-first, older tags are indexed after the newer ones
+    # they are close to
+    return last_indexed_tag
+
+# Returns (base, blobs, removed)
+# base: the indexed version that blobs and removed are changes from, or None
+# if tag has no indexed ancestor, and blobs are all the blobs of tag
+# blobs: [(hash, path)] sorted by path
+# removed: set of the paths of base that are not in tag, or were changed
+def list_blobs(tag):
+    base = get_base_version(tag)
+    blobs = []
+    removed = set()
+
+    if base is None:
+        for blob in scriptLines('list-blobs', '-p', tag):
             hash, path = blob.split(b' ', maxsplit=1)
-            with blobs_lock:
-                idx = db.blob.get(hash)
-            buf.append((idx, path))
-
-        buf = sorted(buf)
-        obj = PathList()
-        for idx, path in buf:
-            obj.append(idx, path)
-
-            # Store DT bindings documentation files to parse them later
-            if path[:33] == b'Documentation/devicetree/bindings':
-                bindings_idxes.append(idx)
-
+            blobs.append((hash, path))
+        return base, blobs, removed
+
+    for change in scriptLines('diff-blobs', base, tag):
+        modes, path = change.split(b'\t', maxsplit=1)
+        old_mode, new_mode, old_hash, new_hash, _ = modes[1:].split(b' ')
+
+        # Submodules (160000) are not blobs, 000000 is for missing files
+        if old_mode not in (b'000000', b'160000'):
+            removed.add(path)
+        if new_mode not in (b'000000', b'160000'):
+            blobs.append((new_hash, path))
+
+    return base, blobs, removed
+
+# Returns the new blobs of tag, as (idx, hash, filename), sorted by idx
+def update_blob_ids(tag, blobs):
+    if db.vars.exists('numBlobs'):
+        idx = db.vars.get('numBlobs')
+    else:
+        idx = 0
+
+    # Blobs of the base version are all indexed already
+    new_blobs = {}
+    for hash, path in blobs:
+        if hash in new_blobs:
+            continue
+
+        if not db.blob.exists(hash):
+            # File name without its path
+            filename = path.rsplit(b'/', maxsplit=1)[-1]
+            new_blobs[hash] = (idx, filename)
             if verbose:
-                print(f"Tag {tag}: adding #{idx} {path}")
-        db.vers.put(tag, obj, sync=True)
+                print(f"New blob #{idx} {hash}:{filename}")
+            idx += 1
+
+    # A blob is known once it is in db.blob, which is written last: an
+    # interrupted run may leave ids in db.hash and db.file only
+    db.hash.put_many((i, hash) for hash, (i, _) in new_blobs.items())
+    db.file.put_many((i, filename) for hash, (i, filename) in new_blobs.items())
+    db.blob.put_many((hash, i) for hash, (i, _) in new_blobs.items())
+    db.vars.put('numBlobs', idx)
+
+    return [(i, hash, filename.decode()) for hash, (i, filename) in new_blobs.items()]
+
+# Returns the new blobs of a tag whose ids were assigned by a previous run,
+# from first_idx on, as (idx, hash, filename)
+def get_blob_ids(first_idx):
+    return [(idx, db.hash.get(idx), db.file.get(idx)) for idx in range(first_idx, db.vars.get('numBlobs'))]
+
+# Returns the PathList of tag, and the idxes of its DT bindings documentation files
+def build_version(tag, base, blobs, removed):
+    buf = []
+
+    # Unchanged paths of the base version keep their idx
+    if base is not None:
+        for p in db.vers.get(base).data.split(b'\n')[:-1]:
+            idx, path = p.split(b' ', maxsplit=1)
+            if path not in removed:
+                buf.append((int(idx), path))
+
+    idxes = {}
+    for hash, path in blobs:
+        if hash not in idxes:
+            idxes[hash] = db.blob.get(hash)
+        buf.append((idxes[hash], path))
+
+    buf = sorted(buf)
+    bindings_idxes = set()
+    obj = PathList()
+    for idx, path in buf:
+        obj.append(idx, path)
+
+        # Store DT bindings documentation files to parse them later
+        if path[:33] == b'Documentation/devicetree/bindings':
+            bindings_idxes.add(idx)
+
+        if verbose:
+            print(f"Tag {tag}: adding #{idx} {path}")
+
+    return obj, bindings_idxes
+
+def update_versions(tag, base, obj):
+    # Indexes are stored first, a version is only considered done
+    # once it is in db.vers
+    db.vers_index.put(tag, data.VersionIndex.build(obj))
+    db.vers_paths.put(tag, data.PathTable.build(obj))
+    db.vers.put(tag, obj, base=base, sync=True)
+
+# Idents of the blobs being indexed that can't be keys of a table (see
+# BsdDB.valid_key), and are not indexed
+skipped_idents = set()
+
+# Returns True if ident can be a key of table, or else adds it to skipped_idents
+def check_ident(table, ident):
+    if table.valid_key(ident):
+        return True
+    skipped_idents.add(ident)
+    return False
+
+def update_definitions(idx, family, defs, defs_buf, cache_keys, defs_lines):
+    defs_lines.add(idx, [(ident, line) for ident, _, line in defs])
+
+    for ident, type, line in defs:
+        if not check_ident(db.defs, ident):
+            continue
+        if not lib.isIdent(ident) and not defs_buf.exists(ident):
+            if not db.defs.exists(ident):
+                continue
 
+        defs_buf.append(ident, idx, type, line, family)
+        if type in data.defTypeD:
+            for cache_family in defs_cache_families(type, family):
+                cache_keys[cache_family].add(ident)
+        if verbose:
+            print(f"def {type} {ident} in #{idx} @ {line}")
+
+def update_doc_comments(idx, family, docs, docs_buf):
+    for ident, line in docs:
+        if not check_ident(db.docs, ident):
+            continue
+        docs_buf.append(ident, idx, str(line), family)
+        if verbose:
+            print(f"doc: {ident} in #{idx} @ {line}")
+
+def update_compatibles(idx, family, comps, comps_buf):
+    for ident, lines in comps.items():
+        if not check_ident(db.comps, ident):
+            continue
+        comps_buf.append(ident, idx, lines, family)
+        if verbose:
+            print(f"comps: {ident} in #{idx} @ {lines}")
+
+# known_idents caches db.defs.exists(), which does not change during the second pass
+def update_references(idx, family, refs, refs_buf, known_idents, defs_lines):
+    for ident, lines in refs.items():
+        known = known_idents.get(ident)
+        if known is None:
+            known = known_idents[ident] = db.defs.exists(ident)
+        if not known:
+            continue
+
+        # Don't count definitions as references
+        lines = [str(line) for line in defs_lines.filter_references(idx, ident, lines)]
+        if lines:
+            lines = ','.join(lines)
+            refs_buf.append(ident, idx, lines, family)
+            if verbose:
+                print(f"ref: {ident} in #{idx} @ {lines}")
 
+def update_compatibles_bindings(idx, comps_docs, comps_docs_buf):
+    for ident, lines in comps_docs.items():
+        if db.comps.exists(ident):
+            comps_docs_buf.append(ident, idx, lines, 'B')
+            if verbose:
+                print(f"comps_docs: {ident} in #{idx} @ {lines}")
+
+# Returns the DefinitionLines of the blobs
+def update_tag_definitions(tag, tag_index, blobs):
+    defs_buf = data.PostingBuffer(db.defs, buffer_size, journal=journal)
+    docs_buf = data.PostingBuffer(db.docs, buffer_size, journal=journal)
+    if dts_comp_support:
+        comps_buf = data.PostingBuffer(db.comps, buffer_size, journal=journal)
+    cache_keys = {family: set() for family in lib.CACHED_DEFINITIONS_FAMILIES}
+    defs_lines = DefinitionLines()
+
+    for results in pool.imap(parse_blobs, get_batches(blobs)):
+        for idx, family, defs, docs, comps in results:
+            if idx % 1000 == 0: progress('defs: ' + str(idx), tag_index)
+
+            if defs is not None:
+                update_definitions(idx, family, defs, defs_buf, cache_keys, defs_lines)
+            if docs is not None:
+                update_doc_comments(idx, family, docs, docs_buf)
+            if comps is not None:
+                update_compatibles(idx, family, comps, comps_buf)
+
+    defs_buf.flush()
+    update_defs_caches(cache_keys)
+    docs_buf.flush()
+    if dts_comp_support:
+        comps_buf.flush()
+    if skipped_idents:
+        progress('defs: ' + tag.decode() + ': ' + str(len(skipped_idents)) +
+                 ' identifiers too long to be stored, skipped', tag_index)
+        skipped_idents.clear()
+    progress('defs: ' + tag.decode() + ' done', tag_index)
+    return defs_lines
+
+def update_tag_references(tag, tag_index, blobs, bindings_idxes, defs_lines):
+    refs_buf = data.PostingBuffer(db.refs, buffer_size, journal=journal)
+    if dts_comp_support:
+        comps_docs_buf = data.PostingBuffer(db.comps_docs, buffer_size, journal=journal)
+    known_idents = {}
+
+    blobs = [(idx, hash, filename, dts_comp_support and idx in bindings_idxes)
+             for idx, hash, filename in blobs]
+    for idx, family, refs, comps_docs in pool.imap(parse_blob_references, blobs, get_chunk_size(len(blobs))):
+        if idx % 1000 == 0: progress('refs: ' + str(idx), tag_index)
+
+        if refs is not None:
+            update_references(idx, family, refs, refs_buf, known_idents, defs_lines)
+        if comps_docs is not None:
+            update_compatibles_bindings(idx, comps_docs, comps_docs_buf)
+        defs_lines.remove(idx)
+
+    refs_buf.flush()
+    if dts_comp_support:
+        comps_docs_buf.flush()
+    progress('refs: ' + tag.decode() + ' done', tag_index)
+
+def update_tag(tag, tag_index):
+    base, blobs, removed = list_blobs(tag)
+
+    stage, first_idx = get_checkpoint(tag)
+    if stage is None:
+        stage = STAGE_STARTED
+        first_idx = db.vars.get('numBlobs') if db.vars.exists('numBlobs') else 0
+        set_checkpoint(tag, stage, first_idx)
+    else:
+        progress('resuming ' + tag.decode() + ' after stage ' + stage_names[stage], tag_index)
+        rollback_tag(stage, first_idx, blobs)
+
+    if base is not None:
+        progress('diff: ' + tag.decode() + ': ' + str(len(blobs)) + ' changed files since ' + base.decode(), tag_index)
+
+    if stage < STAGE_IDS:
+        new_blobs = update_blob_ids(tag, blobs)
+        set_checkpoint(tag, STAGE_IDS, first_idx)
+    else:
+        new_blobs = get_blob_ids(first_idx)
+    progress('ids: ' + tag.decode() + ': ' + str(len(new_blobs)) + ' new blobs', tag_index)
+
+    obj, bindings_idxes = build_version(tag, base, blobs, removed)
+
+    if stage < STAGE_DEFS:
+        defs_lines = update_tag_definitions(tag, tag_index, new_blobs)
+        save_definition_lines(defs_lines)
+        set_checkpoint(tag, STAGE_DEFS, first_idx)
+    elif stage < STAGE_REFS:
+        defs_lines = load_definition_lines()
+
+    if stage < STAGE_REFS:
+        update_tag_references(tag, tag_index, new_blobs, bindings_idxes, defs_lines)
+        set_checkpoint(tag, STAGE_REFS, first_idx)
+
+    update_versions(tag, base, obj)
+    progress('vers: ' + tag.decode() + ' done', tag_index)
+    clear_checkpoint(tag)
+
+    global last_indexed_tag
+    last_indexed_tag = tag
+
+
+# Checkpoints: the last stage done for the tag being indexed is saved in
+# db.vars, with the idx of its first new blob. Each stage is committed with
+# its checkpoint: with Berkeley DB, recovery brings back the tables as they
+# were at the last checkpoint when a killed run left them half-written.
+# LMDB commits large stages in several transactions, so keys of the posting
+# lists are also written to the journal before entries are appended to them,
+# and a run removes what an interrupted one appended after its last
+# checkpoint before resuming from there. A tag is done once it is in db.vers.
+
+STAGE_STARTED, STAGE_IDS, STAGE_DEFS, STAGE_REFS = range(4)
+stage_names = ['start', 'ids', 'defs', 'refs']
+
+# Returns (stage, first idx) for tag, or (None, None) if it has no checkpoint
+def get_checkpoint(tag):
+    if not db.vars.exists(b'stage:' + tag):
+        return None, None
+    return db.vars.get(b'stage:' + tag), db.vars.get(b'firstBlob:' + tag)
+
+# The checkpoint is committed along with what the stage wrote
+def set_checkpoint(tag, stage, first_idx):
+    db.vars.put(b'firstBlob:' + tag, first_idx)
+    db.vars.put(b'stage:' + tag, stage)
+    db.sync()
+
+def clear_checkpoint(tag):
+    db.vars.delete(b'firstBlob:' + tag)
+    db.vars.delete(b'stage:' + tag)
+    db.vars.sync()
+    journal.clear()
+    remove_definition_lines()
+
+# Removes what was written after the checkpoint of a stage of a tag, whose
+# blobs are given as (hash, path)
+def rollback_tag(stage, first_idx, blobs):
+    if stage < STAGE_IDS:
+        # Ids are only assigned to the blobs of the tag, from first_idx on.
+        # Entries written to some tables but not to others are found too.
+        for hash, _ in blobs:
+            idx = db.blob.get(hash)
+            if idx is not None and idx >= first_idx:
+                db.blob.delete(hash)
+        for idx in range(first_idx, first_idx + len(blobs)):
+            db.file.delete(idx)
+            db.hash.delete(idx)
+        db.vars.put('numBlobs', first_idx)
+
+    tables = []
+    if stage < STAGE_DEFS:
+        tables += [db.defs, db.docs]
+        if dts_comp_support:
+            tables.append(db.comps)
+    if stage < STAGE_REFS:
+        tables.append(db.refs)
+        if dts_comp_support:
+            tables.append(db.comps_docs)
+
+    keys = journal.get_keys()
+    for table in tables:
+        for key in keys.get(os.path.basename(table.filename), ()):
+            table.remove_entries(key, first_idx)
+    db.sync()
+
+# Checkpoints done before the references stage of a tag keep the
+# DefinitionLines of its blobs, which are needed to filter references
+def get_definition_lines_filename():
+    return os.path.join(lib.getDataDir(), 'update-defs-lines')
+
+def save_definition_lines(defs_lines):
+    filename = get_definition_lines_filename()
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(defs_lines, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + '.tmp', filename)
+
+def load_definition_lines():
+    with open(get_definition_lines_filename(), 'rb') as f:
+        return pickle.load(f)
+
+def remove_definition_lines():
+    try:
+        os.remove(get_definition_lines_filename())
+    except FileNotFoundError:
+        pass
+
+# Removes the checkpoints of tags that are done, in case a run was
+# interrupted right after a tag was stored
+def clear_done_checkpoints():
+    for key in db.vars.get_keys():
+        if key.startswith(b'stage:') and db.vers.exists(key[len(b'stage:'):]):
+            clear_checkpoint(key[len(b'stage:'):])
+
+
+# Backward-compatibility: index the versions added by older versions of update.py
+# Returns the number of versions that were indexed
+def generate_versions_index():
+    count = 0
+    for tag in db.vers.get_keys():
+        if not db.vers_index.exists(tag) or not db.vers_paths.exists(tag):
+            paths = db.vers.get(tag)
+            db.vers_index.put(tag, data.VersionIndex.build(paths))
+            db.vers_paths.put(tag, data.PathTable.build(paths))
+            count += 1
+    return count
+
+# Rebuilds the defs caches from all the definitions
 def generate_defs_caches():
+    for family in lib.CACHED_DEFINITIONS_FAMILIES:
+        db.defs_cache[family].truncate()
+
     for key in db.defs.get_keys():
         value = db.defs.get(key)
-        for family in ['C', 'K', 'D', 'M']:
+        for family in lib.CACHED_DEFINITIONS_FAMILIES:
             if (lib.compatibleFamily(value.get_families(), family) or
                         lib.compatibleMacro(value.get_macros(), family)):
                 db.defs_cache[family].put(key, b'')
 
+# Returns the defs caches that should contain an ident with a definition
+# of the given type in a file of the given family.
+# The families and macros of a DefList only grow, so a cache never has to
+# drop an ident, and the new definitions of an ident are enough to know
+# the caches it should be added to.
+@lru_cache
+def defs_cache_families(type, family):
+    macros = [family] if type == 'macro' else []
+    return [cache_family for cache_family in lib.CACHED_DEFINITIONS_FAMILIES
+            if lib.compatibleFamily([family], cache_family) or lib.compatibleMacro(macros, cache_family)]
+
+# Adds the idents of cache_keys, a set by family, to the defs caches
+def update_defs_caches(cache_keys):
+    for family, keys in cache_keys.items():
+        db.defs_cache[family].put_many((key, b'') for key in keys)
+
+
+# Returns the new tags in the order they are indexed with --latest-first:
+# the latest release, the tags it descends from, then the other tags,
+# newest first
+def get_latest_first_order(tags):
+    new_tags = set(tags)
+    latest = None
+    for tag in scriptLines('get-latest-tags'):
+        if tag in new_tags:
+            latest = tag
+            break
+    if latest is None:
+        return tags[::-1], []
+
+    ancestors = set(scriptLines('list-ancestor-tags', latest))
+    first = [latest] + [tag for tag in reversed(tags) if tag in ancestors and tag != latest]
+    rest = [tag for tag in reversed(tags) if tag not in ancestors and tag != latest]
+    return first, rest
+
+# Merges back posting lists that were split in at least min_segments
+# segments while appending
+def merge_segments(min_segments=1):
+    db.defs.merge_segments(min_segments)
+    db.refs.merge_segments(min_segments)
+    db.docs.merge_segments(min_segments)
+    if dts_comp_support:
+        db.comps.merge_segments(min_segments)
+        db.comps_docs.merge_segments(min_segments)
+
+# Makes the tags indexed so far visible to web processes
+def publish(min_segments=1):
+    merge_segments(min_segments)
+    db.write_defs_tables()
+    db.sync()
+    data.bump_generation(lib.getDataDir())
+    print(project + ' - published ' + str(len(db.vers)) + ' versions')
+
+# Returns (tags, priority tags): the tags of the repository that are not
+# indexed yet, in the order they should be indexed, and those of them that
+# are published before the others
+def get_new_tags():
+    tags = [tag for tag in scriptLines('list-tags') if not db.vers.exists(tag)]
+
+    global parent_tags
+    parent_tags = {}
+    for line in scriptLines('list-parent-tags'):
+        tag, *parents = line.split(b' ')
+        parent_tags[tag] = parents
+
+    priority_tags = []
+    if args.latest_first:
+        priority_tags, tags = get_latest_first_order(tags)
+        tags = priority_tags + tags
+
+    # A tag interrupted by a previous run has to be finished first
+    resumed_tags = [tag for tag in tags if get_checkpoint(tag)[0] is not None]
+    tags = resumed_tags + [tag for tag in tags if tag not in resumed_tags]
+
+    return tags, priority_tags
+
+# Indexes tags, in order. With --latest-first, the latest release is
+# published as soon as it is indexed, then the tags it descends from.
+# In watch mode, tags found while watching are published one by one.
+def index_tags(tags, priority_tags, watching=False, found_time=None):
+    global num_tags, last_indexed_time
+    num_tags = len(tags)
+    start_time = time.monotonic()
+
+    for tag_index, tag in enumerate(tags, 1):
+        write_status('indexing', tag, num_tags - tag_index + 1, found_time)
+        tag_start_time = time.monotonic()
+        update_tag(tag, tag_index)
+        last_indexed_time = time.time()
+
+        now = time.monotonic()
+        eta = (now - start_time) / tag_index * (num_tags - tag_index)
+        progress(tag.decode() + ' indexed in ' + format_duration(now - tag_start_time) +
+                 ', ' + str(num_tags - tag_index) + ' tags left, ETA ' + format_duration(eta), tag_index)
+
+        # Merging all the lists appended to by each tag would rewrite the
+        # largest ones every time. With --swap, web processes only see the
+        # tags once they are all indexed.
+        if watching:
+            publish(watch_min_segments)
+        elif (not args.swap and tag_index < num_tags and priority_tags and
+              tag in (priority_tags[0], priority_tags[-1])):
+            publish()
+
+    write_status('idle')
+
+# Returns a value that changes when tags are added to the repository: the
+# stats of packed-refs, and of the loose tags and their directories
+def get_tags_stamp():
+    repo_dir = lib.getRepoDir()
+    paths = [os.path.join(repo_dir, 'packed-refs')]
+    for root, dirs, files in os.walk(os.path.join(repo_dir, 'refs', 'tags')):
+        paths.append(root)
+        paths += [os.path.join(root, name) for name in files]
+
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stamp.append((path, st.st_ino, st.st_mtime_ns, st.st_size))
+    return stamp
+
+# Indexes new tags as they appear in the repository, checking every
+# interval seconds, until interrupted
+def watch(interval):
+    print(project + ' - watching for new tags every ' + str(interval) + 's')
+    stamp = get_tags_stamp()
+    while True:
+        time.sleep(interval)
+        new_stamp = get_tags_stamp()
+        if new_stamp == stamp:
+            write_status('idle')
+            continue
+
+        # Tags added while listing them change the stamp again
+        stamp = new_stamp
+        found_time = time.time()
+        tags, _ = get_new_tags()
+        if tags:
+            print(project + ' - found ' + str(len(tags)) + ' new tags')
+            index_tags(tags, [], watching=True, found_time=found_time)
+
+# Status of update.py, for monitoring: what it is doing, the number of tags
+# left to index (queue) and how long ago the oldest of them was found (lag)
+def get_status_filename():
+    return os.path.join(lib.getDataDir(), 'update-status.json')
+
+def write_status(state, tag=None, queue=0, found_time=None):
+    now = time.time()
+    status = {
+        'pid': os.getpid(),
+        'state': state,
+        'tag': tag.decode() if tag is not None else None,
+        'queue': queue,
+        'lag': round(now - found_time, 1) if found_time is not None and queue else 0,
+        'last_indexed_tag': last_indexed_tag.decode() if last_indexed_tag is not None else None,
+        'last_indexed_time': last_indexed_time,
+        'time': now,
+    }
+    filename = get_status_filename()
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(status, f)
+        f.write('\n')
+    os.replace(filename + '.tmp', filename)
 
-class UpdateDefs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateDefsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of defs threads
-
-    def run(self):
-        global new_idxes, tags_done, tag_ready, tags_defs, tags_defs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-
-            with tags_defs_lock:
-                tags_defs[0] += 1
-
-            self.update_definitions(new_idxes[self.index][0])
-
-            new_idxes[self.index][2].set() # Tell that UpdateDefs processed the tag
-
-            self.index += self.inc
-
-        with tags_defs_lock:
-            tags_defs[1] += 1
-            progress('defs: Thread ' + str(tags_defs[1]) + '/' + str(self.inc) + ' finished', tags_defs[0])
-
-
-    def update_definitions(self, idxes):
-        global hash_file_lock, defs_lock, tags_defs
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('defs: ' + str(idx), tags_defs[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family in [None, 'M']: continue
-
-            lines = scriptLines('parse-defs', hash, filename, family)
-
-            with defs_lock:
-                for l in lines:
-                    ident, type, line = l.split(b' ')
-                    type = type.decode()
-                    line = int(line.decode())
-
-                    defs_idxes[idx*idx_key_mod + line] = ident
-
-                    if db.defs.exists(ident):
-                        obj = db.defs.get(ident)
-                    elif lib.isIdent(ident):
-                        obj = data.DefList()
-                    else:
-                        continue
-
-                    obj.append(idx, type, line, family)
-                    if verbose:
-                        print(f"def {type} {ident} in #{idx} @ {line}")
-                    db.defs.put(ident, obj)
-
-        generate_defs_caches()
-
-
-class UpdateRefs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateRefsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of refs threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_refs, tags_refs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-            new_idxes[self.index][2].wait() # Make sure UpdateDefs processed the tag
-
-            with tags_refs_lock:
-                tags_refs[0] += 1
-
-            self.update_references(new_idxes[self.index][0])
-
-            self.index += self.inc
-
-        with tags_refs_lock:
-            tags_refs[1] += 1
-            progress('refs: Thread ' + str(tags_refs[1]) + '/' + str(self.inc) + ' finished', tags_refs[0])
-
-    def update_references(self, idxes):
-        global hash_file_lock, defs_lock, refs_lock, tags_refs
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('refs: ' + str(idx), tags_refs[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family == None: continue
-
-            prefix = b''
-            # Kconfig values are saved as CONFIG_<value>
-            if family == 'K':
-                prefix = b'CONFIG_'
-
-            tokens = scriptLines('tokenize-file', '-b', hash, family)
-            even = True
-            line_num = 1
-            idents = {}
-            with defs_lock:
-                for tok in tokens:
-                    even = not even
-                    if even:
-                        tok = prefix + tok
-
-                        if (db.defs.exists(tok) and
-                            not ( (idx*idx_key_mod + line_num) in defs_idxes and
-                                defs_idxes[idx*idx_key_mod + line_num] == tok ) and
-                            (family != 'M' or tok.startswith(b'CONFIG_'))):
-                            # We only index CONFIG_??? in makefiles
-                            if tok in idents:
-                                idents[tok] += ',' + str(line_num)
-                            else:
-                                idents[tok] = str(line_num)
-
-                    else:
-                        line_num += tok.count(b'\1')
-
-            with refs_lock:
-                for ident, lines in idents.items():
-                    if db.refs.exists(ident):
-                        obj = db.refs.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, lines, family)
-                    if verbose:
-                        print(f"ref: {ident} in #{idx} @ {lines}")
-                    db.refs.put(ident, obj)
-
-
-class UpdateDocs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateDocsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of docs threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_docs, tags_docs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-
-            with tags_docs_lock:
-                tags_docs[0] += 1
-
-            self.update_doc_comments(new_idxes[self.index][0])
-
-            self.index += self.inc
-
-        with tags_docs_lock:
-            tags_docs[1] += 1
-            progress('docs: Thread ' + str(tags_docs[1]) + '/' + str(self.inc) + ' finished', tags_docs[0])
-
-    def update_doc_comments(self, idxes):
-        global hash_file_lock, docs_lock, tags_docs
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('docs: ' + str(idx), tags_docs[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family in [None, 'M']: continue
-
-            lines = scriptLines('parse-docs', hash, filename)
-            with docs_lock:
-                for l in lines:
-                    ident, line = l.split(b' ')
-                    line = int(line.decode())
-
-                    if db.docs.exists(ident):
-                        obj = db.docs.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, str(line), family)
-                    if verbose:
-                        print(f"doc: {ident} in #{idx} @ {line}")
-                    db.docs.put(ident, obj)
-
-
-class UpdateComps(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateCompsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of comps threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_comps, tags_comps_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-
-            with tags_comps_lock:
-                tags_comps[0] += 1
-
-            self.update_compatibles(new_idxes[self.index][0])
-
-            new_idxes[self.index][3].set() # Tell that UpdateComps processed the tag
-
-            self.index += self.inc
-
-        with tags_comps_lock:
-            tags_comps[1] += 1
-            progress('comps: Thread ' + str(tags_comps[1]) + '/' + str(self.inc) + ' finished', tags_comps[0])
-
-    def update_compatibles(self, idxes):
-        global hash_file_lock, comps_lock, tags_comps
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('comps: ' + str(idx), tags_comps[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family in [None, 'K', 'M']: continue
-
-            lines = compatibles_parser.run(scriptLines('get-blob', hash), family)
-            comps = {}
-            for l in lines:
-                ident, line = l.split(' ')
-
-                if ident in comps:
-                    comps[ident] += ',' + str(line)
-                else:
-                    comps[ident] = str(line)
-
-            with comps_lock:
-                for ident, lines in comps.items():
-                    if db.comps.exists(ident):
-                        obj = db.comps.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, lines, family)
-                    if verbose:
-                        print(f"comps: {ident} in #{idx} @ {line}")
-                    db.comps.put(ident, obj)
-
-
-class UpdateCompsDocs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateCompsDocsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of comps_docs threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_comps_docs, tags_comps_docs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-            new_idxes[self.index][3].wait() # Make sure UpdateComps processed the tag
-            new_idxes[self.index][4].wait() # Make sure UpdateVersions processed the tag
-
-            with tags_comps_docs_lock:
-                tags_comps_docs[0] += 1
-
-            self.update_compatibles_bindings(new_idxes[self.index][0])
-
-            self.index += self.inc
+def progress(msg, current):
+    print('{} - {} ({:.1%})'.format(project, msg, current/num_tags))
 
-        with tags_comps_docs_lock:
-            tags_comps_docs[1] += 1
-            progress('comps_docs: Thread ' + str(tags_comps_docs[1]) + '/' + str(self.inc) + ' finished', tags_comps_docs[0])
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
 
-    def update_compatibles_bindings(self, idxes):
-        global hash_file_lock, comps_lock, comps_docs_lock, tags_comps_docs, bindings_idxes
+# Closes the databases, and makes them visible to web processes if they were
+# updated. With --snapshot, they are exported first if they were updated, or
+# if their snapshot is out of date. With --swap, the data directory is
+# swapped to the updated copy.
+def close_databases(updated=True):
+    token = None
+    if args.snapshot and (updated or args.swap or not data.snapshot_is_current(db.dir, dts_comp_support)):
+        token = data.export_snapshot(db)
+        print(lib.currentProject() + ' - exported snapshot')
 
-        for idx in idxes:
-            if idx % 1000 == 0: progress('comps_docs: ' + str(idx), tags_comps_docs[0])
+    db.close()
+    journal.close()
+    if updated or args.swap or token is not None:
+        data.bump_generation(lib.getDataDir(), token)
+    if args.swap:
+        new_dir = data.swap_generation(data_dir)
+        print(lib.currentProject() + ' - swapped ' + data_dir + ' to ' + os.path.basename(new_dir))
 
-            if not idx in bindings_idxes: # Parse only bindings doc files
-                continue
 
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-
-            family = 'B'
-            lines = compatibles_parser.run(scriptLines('get-blob', hash), family)
-            comps_docs = {}
-            with comps_lock:
-                for l in lines:
-                    ident, line = l.split(' ')
-
-                    if db.comps.exists(ident):
-                        if ident in comps_docs:
-                            comps_docs[ident] += ',' + str(line)
-                        else:
-                            comps_docs[ident] = str(line)
-
-            with comps_docs_lock:
-                for ident, lines in comps_docs.items():
-                    if db.comps_docs.exists(ident):
-                        obj = db.comps_docs.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, lines, family)
-                    if verbose:
-                        print(f"comps_docs: {ident} in #{idx} @ {line}")
-                    db.comps_docs.put(ident, obj)
+# Main
 
 
-def progress(msg, current):
-    print('{} - {} ({:.1%})'.format(project, msg, current/num_tags))
+if args.rebuild_defs_caches:
+    generate_defs_caches()
+    db.write_defs_tables()
+    close_databases()
+    exit(0)
 
+num_workers = max(args.threads, 1)
 
-# Main
+clear_done_checkpoints()
 
-# Check number of threads arg
-if len(argv) >= 2 and argv[1].isdigit() :
-    cpu = int(argv[1])
-
-    if cpu < 5 :
-        cpu = 5
-
-# Distribute threads among functions using the following rules :
-# There are more (or equal) refs threads than others
-# There are more (or equal) defs threads than docs or comps threads
-# Example : if cpu=6 : defs=1, refs=2, docs=1, comps=1, comps_docs=1
-#           if cpu=7 : defs=2, refs=2, docs=1, comps=1, comps_docs=1
-#           if cpu=8 : defs=2, refs=3, docs=1, comps=1, comps_docs=1
-#           if cpu=11: defs=2, refs=3, docs=2, comps=2, comps_docs=2
-quo, rem = divmod(cpu, 5)
-num_th_refs = quo
-num_th_defs = quo
-num_th_docs = quo
-
-# If DT bindings support is enabled, use $quo threads for each of the 2 threads
-# Otherwise add them to the remaining threads
-if dts_comp_support:
-    num_th_comps = quo
-    num_th_comps_docs = quo
-else :
-    num_th_comps = 0
-    num_th_comps_docs = 0
-    rem += 2*quo
-
-quo, rem = divmod(rem, 2)
-num_th_defs += quo
-num_th_refs += quo + rem
-
-tag_buf = []
-for tag in scriptLines('list-tags'):
-    if not db.vers.exists(tag):
-        tag_buf.append(tag)
+project = lib.currentProject()
+last_indexed_tag = None
+# Tags of the nearest tagged ancestor of each tag, set by get_new_tags
+parent_tags = {}
+last_indexed_time = None
 
+tag_buf, priority_tags = get_new_tags()
 num_tags = len(tag_buf)
-project = lib.currentProject()
 
 print(project + ' - found ' + str(num_tags) + ' new tags')
 
+num_indexed = generate_versions_index()
+if num_indexed:
+    print(project + ' - indexed ' + str(num_indexed) + ' existing versions')
+
 if not num_tags:
+    updated = num_indexed > 0
     # Backward-compatibility: generate defs caches if they are empty.
-    if db.defs_cache['C'].db.stat()['nkeys'] == 0:
+    if len(db.defs_cache['C']) == 0:
         generate_defs_caches()
-    exit(0)
-
-threads_list.append(UpdateIds(tag_buf))
-threads_list.append(UpdateVersions(tag_buf))
-
-# Define defs threads
-for i in range(num_th_defs):
-    threads_list.append(UpdateDefs(i, num_th_defs))
-# Define refs threads
-for i in range(num_th_refs):
-    threads_list.append(UpdateRefs(i, num_th_refs))
-# Define docs threads
-for i in range(num_th_docs):
-    threads_list.append(UpdateDocs(i, num_th_docs))
-# Define comps threads
-for i in range(num_th_comps):
-    threads_list.append(UpdateComps(i, num_th_comps))
-# Define comps_docs threads
-for i in range(num_th_comps_docs):
-    threads_list.append(UpdateCompsDocs(i, num_th_comps_docs))
-
-
-# Start to process tags
-threads_list[0].start()
-
-# Wait until the first tag is ready
-with tag_ready:
-    tag_ready.wait()
-
-# Start remaining threads
-for i in range(1, len(threads_list)):
-    threads_list[i].start()
-
-# Make sure all threads finished
-for i in range(len(threads_list)):
-    threads_list[i].join()
+        updated = True
+    # Backward-compatibility: write the defs tables if they are missing.
+    if updated or not db.defs_tables_exist():
+        db.write_defs_tables()
+        updated = True
+    if not args.watch:
+        close_databases(updated)
+        exit(0)
+    if updated:
+        db.sync()
+        data.bump_generation(lib.getDataDir())
+
+if args.pool == 'processes':
+    # Workers are forked: they get the state of this module, including the
+    # parsers, but never use the database handles
+    pool = multiprocessing.get_context('fork').Pool(num_workers, initializer=init_worker)
+else:
+    pool = multiprocessing.pool.ThreadPool(num_workers)
+
+with pool:
+    index_tags(tag_buf, priority_tags)
+    if args.watch:
+        if num_tags:
+            publish()
+        try:
+            watch(args.watch)
+        except KeyboardInterrupt:
+            print(project + ' - stopped watching')
+
+merge_segments()
+db.write_defs_tables()
+
+hits, misses, _ = db.get_cache_stats()
+print(project + ' - database cache hits: ' + str(hits) + ', misses: ' + str(misses))
+
+# Peak resident memory of this process, and of its largest child process
+# (workers, git, ctags), in kilobytes on Linux
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+children_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+print(project + ' - peak memory: ' + str(peak_rss // 1024) + ' MB, largest child process: ' +
+      str(children_peak_rss // 1024) + ' MB')
+
+# Flush the databases before web processes reopen them
+close_databases()
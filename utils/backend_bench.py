@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the speed of data directories of the same project, e.g. a copy
+# made by utils/migrate.py to another storage backend, on the same queries:
+# the identifiers and prefixes are sampled once, from the first directory.
+# The tables are read from the databases, not from the snapshot, and the
+# versions are not cached, so that each run reads them from the backend.
+
+import os
+import sys
+import argparse
+import itertools
+import random
+from time import perf_counter
+
+ELIXIR_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+sys.path = [ ELIXIR_DIR ] + sys.path
+
+from elixir import data
+
+def sample_idents(dir, count, seed):
+    db = data.DB(dir, readonly=True, snapshot=False)
+    try:
+        idents = sorted(db.defs.get_keys())
+    finally:
+        db.close()
+    return random.Random(seed).sample(idents, min(count, len(idents)))
+
+def get_versions(dir):
+    db = data.DB(dir, readonly=True, snapshot=False)
+    try:
+        return sorted(db.vers.get_keys())
+    finally:
+        db.close()
+
+# Returns the durations of func(arg) for each arg, in milliseconds
+def measure(func, args, runs):
+    results = []
+    for i in range(runs):
+        for arg in args:
+            start_time = perf_counter()
+            func(arg)
+            results.append((perf_counter() - start_time) * 1000)
+    return results
+
+def bench(dir, idents, prefixes, versions, runs):
+    start_time = perf_counter()
+    db = data.DB(dir, readonly=True, snapshot=False)
+    results = {'open': [(perf_counter() - start_time) * 1000]}
+    try:
+        results['defs get'] = measure(db.defs.get, idents, runs)
+        results['refs get'] = measure(db.refs.get, idents, runs)
+        # Like autocomplete.py
+        results['prefix scan'] = measure(lambda p: list(itertools.islice(db.defs.iter_keys(p), 11)),
+                                         prefixes, runs)
+        results['versions get'] = measure(db.vers.get, versions, runs)
+    finally:
+        db.close()
+    return results
+
+def print_results(dirs, results):
+    for num, dir in enumerate(dirs, 1):
+        print('{}: {} ({})'.format(num, dir, data.find_backend(dir)))
+    print('{:16} {}'.format('', ' '.join('{:>24}'.format(num) for num in range(1, len(dirs) + 1))))
+    for name in results[0]:
+        cols = []
+        for r in results:
+            values = sorted(r[name])
+            average = sum(values) / len(values)
+            p95 = values[int(len(values) * 0.95) - 1 if len(values) > 1 else 0]
+            cols.append('{:>24}'.format('{:.3f} / {:.3f} ms'.format(average, p95)))
+        print('{:16} {}'.format(name, ' '.join(cols)))
+    print('(average / 95th percentile)')
+
+
+# Main
+
+parser = argparse.ArgumentParser(description='Compare the speed of data directories of the same '
+                                             'project, e.g. stored by different storage backends.')
+parser.add_argument('dirs', nargs='+', help='data directories')
+parser.add_argument('--idents', type=int, default=1000,
+                    help='number of identifiers to look up (default: %(default)s)')
+parser.add_argument('--runs', type=int, default=3,
+                    help='number of times each lookup is made (default: %(default)s)')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the sampling of identifiers (default: %(default)s)')
+args = parser.parse_args()
+
+os.environ['ELIXIR_VERSIONS_CACHE_SIZE'] = '0'
+
+dirs = [os.path.realpath(dir) for dir in args.dirs]
+idents = sample_idents(dirs[0], args.idents, args.seed)
+prefixes = sorted(set(ident[:3] for ident in idents))
+versions = get_versions(dirs[0])
+
+print('{} identifiers, {} prefixes, {} versions, {} runs'.format(len(idents), len(prefixes),
+                                                                len(versions), args.runs))
+results = [bench(dir, idents, prefixes, versions, args.runs) for dir in dirs]
+print_results(dirs, results)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copies the data directory of a project to a new one, stored by another
+# storage backend (see elixir/storage.py). The tables are copied as they are,
+# the other files of the data directory (generation, snapshot, tables of
+# definitions) are copied along.
+# update.py must not be running on the source directory.
+
+import os
+import sys
+import argparse
+import fnmatch
+import shutil
+
+ELIXIR_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+sys.path = [ ELIXIR_DIR ] + sys.path
+
+from elixir import data, storage
+
+# Number of items written at a time
+batch_size = 10000
+
+# Files of the backends, which are not copied as they are
+backend_files = ('*.db', storage.LMDB_DATA_FILE, storage.LMDB_LOCK_FILE, '__db.*', '*.tmp')
+
+def is_backend_file(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in backend_files)
+
+def has_dtscomp(dir):
+    env = data.open_env(dir, True, False)
+    try:
+        return env.has_table(dir + '/compatibledts.db')
+    finally:
+        env.close()
+
+# Copies the items of table src to table dst, both BsdDB, and returns
+# (items copied, items whose keys dst can't store)
+def copy_table(src, dst):
+    count = 0
+    skipped = 0
+    batch = []
+    for key, value in src.db.iter_range(b''):
+        key = bytes(key)
+        # Segments are copied along with the value they are part of
+        if not dst.valid_key(key.split(data.SEGMENT_SEPARATOR, 1)[0] if dst.segmented else key):
+            skipped += 1
+            continue
+        batch.append((key, bytes(value)))
+        if len(batch) >= batch_size:
+            dst.db.put_many(batch)
+            count += len(batch)
+            batch = []
+    dst.db.put_many(batch)
+    count += len(batch)
+    dst.sync()
+    return count, skipped
+
+def migrate(src_dir, dst_dir, backend):
+    dtscomp = has_dtscomp(src_dir)
+    src = data.DB(src_dir, readonly=True, dtscomp=dtscomp, snapshot=False)
+    dst = data.DB(dst_dir, readonly=False, dtscomp=dtscomp, backend=backend)
+    ok = True
+    try:
+        print('{} ({}) -> {} ({})'.format(src_dir, src.env.name, dst_dir, dst.env.name))
+        # Tables missing from older data are created empty
+        dst_tables = {os.path.basename(table.filename): table for table in dst.get_tables()}
+        for src_table in src.get_tables():
+            name = os.path.basename(src_table.filename)
+            copied, skipped = copy_table(src_table, dst_tables[name])
+            print('{}: {} items'.format(name, copied))
+            if skipped:
+                # LMDB can't store keys longer than its maximum key size
+                print('{}: warning, {} items could not be copied'.format(name, skipped))
+                ok = False
+    finally:
+        src.close()
+        dst.close()
+
+    for name in sorted(os.listdir(src_dir)):
+        path = os.path.join(src_dir, name)
+        if os.path.isfile(path) and not is_backend_file(name):
+            shutil.copy2(path, os.path.join(dst_dir, name))
+            print(name + ': copied')
+
+    return ok
+
+
+# Main
+
+parser = argparse.ArgumentParser(description='Copy the data directory of a project to a new one, '
+                                             'stored by another storage backend.')
+parser.add_argument('src', help='data directory to copy, not being updated')
+parser.add_argument('dst', help='new data directory, created if missing, must be empty')
+parser.add_argument('--backend', choices=storage.BACKENDS, required=True,
+                    help='storage backend of the new data directory')
+args = parser.parse_args()
+
+src_dir = os.path.realpath(args.src)
+if data.find_backend(src_dir) is None:
+    parser.error(args.src + ' is not a data directory')
+os.makedirs(args.dst, exist_ok=True)
+if os.listdir(args.dst):
+    parser.error(args.dst + ' is not empty')
+
+if not migrate(src_dir, args.dst, args.backend):
+    exit(1)
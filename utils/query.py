@@ -9,6 +9,11 @@ def cmd_stats(q, **kwargs):
     print("Definitions: ", len(q.db.defs))
     print("References: ", len(q.db.refs))
 
+    hits, misses, files = q.db.get_cache_stats()
+    print("Cache hits/misses: ", hits, misses)
+    for name, (file_hits, file_misses) in sorted(files.items()):
+        print("  {}: {} {}".format(name, file_hits, file_misses))
+
 def cmd_versions(q, **kwargs):
     for major in q.get_versions().values():
         for minor in major.values():
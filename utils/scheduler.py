@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Copyright (C) 2017--2020 Mikaël Bouillot <mikael.bouillot@bootlin.com>
+#  and contributors
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Updates all the projects of an Elixir data path, several at a time.
+# Each project is fetched and indexed by `utils/index <root> <project>`,
+# which is given a share of the CPUs (the number of update.py workers) and
+# of the memory (the update.py write buffers) of the whole run.
+
+import os
+import sys
+import argparse
+import json
+import subprocess
+import time
+
+ELIXIR_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+sys.path = [ ELIXIR_DIR ] + sys.path
+
+from elixir import data
+
+index_script = os.path.join(ELIXIR_DIR, 'utils', 'index')
+
+# Smallest write buffers given to a project, in megabytes
+min_buffer_size = 64
+
+class Job:
+    '''A project to update, and the process updating it'''
+    def __init__(self, name, dir, priority, last_duration):
+        self.name = name
+        self.dir = dir
+        self.priority = priority
+        self.last_duration = last_duration
+        self.process = None
+        self.log = None
+        self.workers = 0
+        self.buffer_size = 0
+        self.start_time = None
+        self.end_time = None
+        self.blobs_before = None
+        self.blobs_after = None
+
+    def start(self, workers, buffer_size):
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.blobs_before = get_num_blobs(self.dir)
+        env = {
+            **os.environ,
+            'ELIXIR_THREADS': str(workers),
+            'ELIXIR_BUFFER_SIZE': str(buffer_size),
+        }
+        # The output of parallel updates would be interleaved, keep it per project
+        self.log = open(get_log_filename(self.dir), 'w')
+        self.start_time = time.time()
+        self.process = subprocess.Popen((index_script, os.path.dirname(self.dir), self.name),
+                                        stdin=subprocess.DEVNULL, stdout=self.log,
+                                        stderr=subprocess.STDOUT, env=env)
+
+    def poll(self):
+        if self.process.poll() is None:
+            return False
+
+        self.end_time = time.time()
+        self.log.close()
+        self.blobs_after = get_num_blobs(self.dir)
+        return True
+
+    def summary(self):
+        s = {
+            'priority': self.priority,
+            'status': 'not run',
+        }
+        if self.start_time is not None:
+            s.update({
+                'workers': self.workers,
+                'buffer_size': self.buffer_size,
+                'start_time': self.start_time,
+            })
+        if self.end_time is not None:
+            s.update({
+                'status': 'ok' if self.process.returncode == 0 else 'failed',
+                'returncode': self.process.returncode,
+                'end_time': self.end_time,
+                'duration': round(self.end_time - self.start_time, 1),
+                'blobs_before': self.blobs_before,
+                'blobs_after': self.blobs_after,
+                'new_blobs': (self.blobs_after or 0) - (self.blobs_before or 0),
+            })
+        return s
+
+def get_log_filename(dir):
+    return os.path.join(dir, 'index.log')
+
+# Returns the number of blobs indexed in project dir, or None if it has no databases yet
+def get_num_blobs(dir):
+    data_dir = os.path.join(dir, 'data')
+    if not os.path.isdir(data_dir) or data.find_backend(data_dir) is None:
+        return None
+
+    try:
+        env = data.open_env(data_dir, True, False)
+    except Exception:
+        return None
+    try:
+        vars = data.BsdDB(os.path.join(data_dir, 'variables.db'), True, lambda x: int(x.decode()), env=env)
+        try:
+            return vars.get('numBlobs') if vars.exists('numBlobs') else 0
+        finally:
+            vars.close()
+    except Exception:
+        return None
+    finally:
+        env.close()
+
+# Returns the summary of the previous run, or an empty one
+def load_summary(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_summary(filename, summary):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(summary, f, indent=1)
+        f.write('\n')
+    os.replace(filename + '.tmp', filename)
+
+# Splits total into count shares that differ by at most 1, larger first
+def split(total, count):
+    return [total // count + (1 if i < total % count else 0) for i in range(count)]
+
+def parse_priorities(values):
+    priorities = {}
+    for value in values:
+        name, sep, priority = value.rpartition('=')
+        if not sep or not name:
+            parser.error('invalid priority "' + value + '", expected NAME=PRIORITY')
+        try:
+            priorities[name] = int(priority)
+        except ValueError:
+            parser.error('invalid priority "' + value + '", expected an integer')
+    return priorities
+
+def get_jobs(root, priorities, last_summary):
+    last_projects = last_summary.get('projects', {})
+    jobs = []
+    for name in sorted(os.listdir(root)):
+        dir = os.path.join(root, name)
+        if not os.path.isdir(dir):
+            continue
+        last_duration = last_projects.get(name, {}).get('duration')
+        jobs.append(Job(name, dir, priorities.get(name, 0), last_duration))
+
+    # Highest priorities first, then the projects that took the least time last
+    # time, so that small projects don't wait behind large ones. New projects
+    # go first, to get them online as soon as possible.
+    jobs.sort(key=lambda job: (-job.priority, job.last_duration or 0))
+    return jobs
+
+def run(jobs, cpus, memory, max_jobs, summary_filename, interval=1):
+    queue = list(jobs)
+    running = []
+    free_cpus = cpus
+    free_memory = memory
+
+    summary = {
+        'cpus': cpus,
+        'memory': memory,
+        'jobs': max_jobs,
+        'start_time': time.time(),
+        'end_time': None,
+        'projects': {},
+    }
+
+    def update_summary():
+        summary['projects'] = {job.name: job.summary() for job in jobs}
+        write_summary(summary_filename, summary)
+
+    while queue or running:
+        # Share the free CPUs and memory between the projects that can start now
+        count = min(len(queue), max_jobs - len(running), free_cpus,
+                    free_memory // min_buffer_size)
+        if count > 0:
+            for workers, buffer_size in zip(split(free_cpus, count), split(free_memory, count)):
+                job = queue.pop(0)
+                job.start(workers, buffer_size)
+                running.append(job)
+                free_cpus -= workers
+                free_memory -= buffer_size
+                print('{} - started with {} workers and {} MB of buffers'.format(job.name, workers, buffer_size))
+            update_summary()
+
+        time.sleep(interval)
+
+        for job in [job for job in running if job.poll()]:
+            running.remove(job)
+            free_cpus += job.workers
+            free_memory += job.buffer_size
+            s = job.summary()
+            print('{} - {} in {}s, {} new blobs, log in {}'.format(job.name, s['status'], s['duration'],
+                                                                 s['new_blobs'], get_log_filename(job.dir)))
+            update_summary()
+
+    summary['end_time'] = time.time()
+    update_summary()
+
+    return all(job.process.returncode == 0 for job in jobs)
+
+
+# Main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update all the projects of an Elixir data path, '
+                                                 'several at a time.')
+    parser.add_argument('root', help='Elixir data path, with one directory per project')
+    parser.add_argument('--cpus', type=int, default=int(os.environ.get('ELIXIR_THREADS') or os.cpu_count()),
+                        help='number of update.py workers shared by all projects (default: %(default)s)')
+    parser.add_argument('--memory', type=int,
+                        help='megabytes of update.py write buffers shared by all projects '
+                             '(default: $ELIXIR_BUFFER_SIZE or 512 per project run at a time)')
+    parser.add_argument('--jobs', type=int,
+                        help='maximum number of projects updated at a time (default: half of --cpus, at most 4)')
+    parser.add_argument('--priority', action='append', default=[], metavar='NAME=PRIORITY',
+                        help='update project NAME before the projects with lower priorities (default: 0), '
+                             'can be given several times')
+    parser.add_argument('--summary', metavar='FILE',
+                        help='JSON file where durations and blob counts are written '
+                             '(default: ROOT/index-summary.json)')
+    args = parser.parse_args()
+
+    cpus = max(args.cpus, 1)
+    max_jobs = max(args.jobs or min(cpus // 2, 4), 1)
+    memory = args.memory or int(os.environ.get('ELIXIR_BUFFER_SIZE', 512)) * max_jobs
+    memory = max(memory, min_buffer_size)
+    summary_filename = args.summary or os.path.join(args.root, 'index-summary.json')
+
+    jobs = get_jobs(args.root, parse_priorities(args.priority), load_summary(summary_filename))
+    if not run(jobs, cpus, memory, max_jobs, summary_filename):
+        exit(1)